@@ -0,0 +1,153 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Retrieval of candidate terms for negative pairs using character trigram TF-IDF vectors"""
+
+from collections import namedtuple
+import numpy as np
+from scipy import sparse
+
+
+# number of query terms whose similarities to all terms are computed in one matrix product
+QUERY_BLOCK_SIZE = 1024
+
+# padding character put around each term so that trigrams capture the term boundaries
+PADDING = ' '
+
+# trigrams occurring in a larger share of the terms are dropped from the vectors,
+# they hardly change the ranking but make the similarity matrices dense
+MAX_DOCUMENT_FREQUENCY = 0.01
+
+# vocabularies below this size keep all trigrams
+MIN_TERMS_FOR_PRUNING = 10000
+
+# positive pairs of a dataset as term ids, with the neighbours of each term in CSR form
+# (sources of pairs with the term as target and targets of pairs with the term as source)
+PairGraph = namedtuple('PairGraph', ['sources', 'targets', 'indptr', 'neighbours'])
+
+
+# TF-IDF weighted character trigram vectors of all terms, one L2 normalised row per term id
+def create_trigram_vectors(term_features):
+    number_of_terms = len(term_features.normalized)
+    padded_lengths = term_features.lengths + 2
+
+    # encode each trigram as one integer from the code points of its characters,
+    # computed for all positions of the concatenated padded terms at once
+    padded_terms = "".join(PADDING + term + PADDING for term in term_features.normalized)
+    code_points = np.frombuffer(padded_terms.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+    trigram_keys = (code_points[:-2] << 42) | (code_points[1:-1] << 21) | code_points[2:]
+
+    # only trigrams starting within a term and ending in the same term are used
+    term_starts = np.cumsum(padded_lengths) - padded_lengths
+    trigrams_per_term = padded_lengths - 2
+    term_ids = np.repeat(np.arange(number_of_terms), trigrams_per_term)
+    offsets_in_term = np.arange(len(term_ids)) - np.repeat(np.cumsum(trigrams_per_term) - trigrams_per_term,
+                                                           trigrams_per_term)
+    positions = np.repeat(term_starts, trigrams_per_term) + offsets_in_term
+
+    trigrams, trigram_ids = np.unique(trigram_keys[positions], return_inverse=True)
+    counts = sparse.csr_matrix((np.ones(len(term_ids), dtype=np.float32), (term_ids, trigram_ids.ravel())),
+                               shape=(number_of_terms, len(trigrams)))
+    counts.sum_duplicates()
+
+    # smoothed inverse document frequency of each trigram
+    document_frequencies = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + number_of_terms) / (1 + document_frequencies)) + 1
+    if number_of_terms >= MIN_TERMS_FOR_PRUNING:
+        idf[document_frequencies > MAX_DOCUMENT_FREQUENCY * number_of_terms] = 0
+    vectors = counts.multiply(idf.astype(np.float32)).tocsr()
+    vectors.eliminate_zeros()
+
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(vectors).tocsr().astype(np.float32)
+
+
+# ids of the k terms with highest cosine similarity for each query term id (excluding the term
+# itself), most similar first, computed with one sparse matrix product per block of queries
+def top_k_similar_terms(vectors, query_ids, k):
+    top_k = {}
+    vectors_transposed = vectors.T.tocsr()
+
+    for start in range(0, len(query_ids), QUERY_BLOCK_SIZE):
+        block_ids = query_ids[start:start + QUERY_BLOCK_SIZE]
+        similarities = vectors[block_ids].dot(vectors_transposed).tocsr()
+
+        for row, term_id in enumerate(block_ids):
+            row_start, row_end = similarities.indptr[row], similarities.indptr[row + 1]
+            candidate_ids = similarities.indices[row_start:row_end]
+            scores = similarities.data[row_start:row_end]
+
+            not_self = candidate_ids != term_id
+            candidate_ids, scores = candidate_ids[not_self], scores[not_self]
+
+            if len(scores) > k:
+                best = np.argpartition(-scores, k)[:k]
+                candidate_ids, scores = candidate_ids[best], scores[best]
+            # ties are ordered by term id to keep the retrieval deterministic
+            order = np.lexsort((candidate_ids, -scores))
+            top_k[term_id] = candidate_ids[order]
+
+    return top_k
+
+
+def create_pair_graph(positive_instances, term_features):
+    sources = np.fromiter((term_features.index[label] for label in positive_instances['source']),
+                          dtype=np.int64, count=positive_instances.shape[0])
+    targets = np.fromiter((term_features.index[label] for label in positive_instances['target']),
+                          dtype=np.int64, count=positive_instances.shape[0])
+
+    ends = np.concatenate([sources, targets])
+    neighbours = np.concatenate([targets, sources])
+    order = np.argsort(ends, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=len(term_features.normalized)))])
+
+    return PairGraph(sources, targets, indptr, neighbours[order])
+
+
+def _neighbours(pair_graph, term_id):
+    return pair_graph.neighbours[pair_graph.indptr[term_id]:pair_graph.indptr[term_id + 1]]
+
+
+# the same exclusions as get_possible_targets() of the advanced strategy, expressed on the pair graph:
+# the synonyms of the source term (its targets and the term itself) and every term paired with
+# a synonym in another pair are excluded, and a term can be used if it occurs in a pair
+# that contains none of these excluded terms
+def excluded_terms(pair_graph, term_id, synonym_ids):
+    excluded = set(synonym_ids)
+    excluded.add(term_id)
+    for synonym_id in list(excluded):
+        excluded.update(_neighbours(pair_graph, synonym_id).tolist())
+    return excluded
+
+
+def is_usable_target(pair_graph, candidate_id, excluded):
+    if candidate_id in excluded:
+        return False
+    return any(neighbour not in excluded for neighbour in _neighbours(pair_graph, candidate_id).tolist())
+
+
+# all usable target term ids of a source term, in term id order
+def all_usable_targets(pair_graph, excluded):
+    excluded_mask = np.zeros(len(pair_graph.indptr) - 1, dtype=bool)
+    excluded_mask[list(excluded)] = True
+
+    # pairs of the source term itself are excluded as the term is excluded
+    usable_pairs = ~excluded_mask[pair_graph.sources] & ~excluded_mask[pair_graph.targets]
+    usable = np.zeros(len(excluded_mask), dtype=bool)
+    usable[pair_graph.sources[usable_pairs]] = True
+    usable[pair_graph.targets[usable_pairs]] = True
+
+    return np.flatnonzero(usable)
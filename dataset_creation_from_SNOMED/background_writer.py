@@ -0,0 +1,92 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Writing of finished datasets in the background while the next dataset is created"""
+
+import functools
+import queue
+import threading
+
+
+class BackgroundWriter:
+    # writing jobs are executed one after another in a single thread in the order they
+    # were submitted, so appending to the same file (e.g. statistics) stays deterministic
+    # at most max_pending jobs are queued, submitting more blocks until a job is finished
+    # the first failing job stops all further writing and its error is raised
+    # on the next submit, flush or close
+
+    def __init__(self, max_pending=4):
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='background-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    job()
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise Exception('Writing datasets failed') from self._error
+
+    def submit(self, function, *args, **kwargs):
+        self._raise_error()
+        self._jobs.put(functools.partial(function, *args, **kwargs))
+
+    # wait until all submitted jobs are written, e.g. before reading files written earlier
+    def flush(self):
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the original error behind a writing error
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
+# write in the background if a writer is given, otherwise write immediately
+def write_in_background(writer, function, *args, **kwargs):
+    if writer is None:
+        function(*args, **kwargs)
+    else:
+        writer.submit(function, *args, **kwargs)
+
+
+def wait_for_writes(writer):
+    if writer is not None:
+        writer.flush()
@@ -22,42 +22,209 @@ import argparse
 sys.path.append('..')
 
 from dataset_creation_from_SNOMED.positive_instances_from_labels import positive_instances_from_labels
+from dataset_creation_from_SNOMED.positive_instances_from_labels import DESCRIPTION_FILE
+from dataset_creation_from_SNOMED.positive_instances_from_labels import CONCEPT_FILE
+from dataset_creation_from_SNOMED.positive_instances_from_labels import DESCRIPTION_COLUMNS
+from dataset_creation_from_SNOMED.rf2_reader import read_rf2_snapshot
 from dataset_creation_from_SNOMED.positive_instances_from_substitutions import positive_instances_from_substitutions
 from dataset_creation_from_SNOMED.negative_sampling_from_positive_instances import negative_instances
+from dataset_creation_from_SNOMED.background_writer import BackgroundWriter
+from dataset_creation_from_SNOMED.is_a_hierarchy import RELATIONSHIP_FILE
+from dataset_creation_from_SNOMED.is_a_hierarchy import load_is_a_hierarchy
+from dataset_creation_from_SNOMED.sharded_creation import plan_shards
+from dataset_creation_from_SNOMED.sharded_creation import run_shard
+from dataset_creation_from_SNOMED.sharded_creation import merge_shards
+from dataset_creation_from_SNOMED.sharded_creation import STAGES
+from dataset_creation_from_SNOMED.reference_engine import ENGINES
+from dataset_creation_from_SNOMED.reference_engine import FAST_ENGINE
+from dataset_creation_from_SNOMED.engine_verification import verify_engines
+from dataset_creation_from_SNOMED.distance_cache import distance_cache
+from dataset_creation_from_SNOMED.distance_cache import CACHE_SIZE
+
+
+# a language is given as NAME:LANGUAGE_REFSET_ID
+def language(value):
+    name, refset_id = value.rsplit(":", 1)
+    return name, int(refset_id)
 
 
 parser = argparse.ArgumentParser(description='Similarity dataset creation from SNOMED')
 
+parser.add_argument("command", type=str, nargs='?', default='all',
+                    choices=['all', 'plan', 'run-shard', 'merge'],
+                    help="Create all datasets on this machine (default), or plan, run and merge "
+                         "the shards of a creation on several machines")
+parser.add_argument("--shared_path", type=str, default=None,
+                    help="Folder shared by all machines for the plan, manifests and shard results")
+parser.add_argument("--shards", type=int, default=None,
+                    help="Number of shards per stage (plan)")
+parser.add_argument("--stage", type=str, default=None, choices=STAGES,
+                    help="Stage to run a shard of or to merge (run-shard, merge)")
+parser.add_argument("--shard", type=int, default=None,
+                    help="Shard to run (run-shard)")
+
 parser.add_argument("--snomed_path", type=str, default="../SNOMED_files/",
                     help="Path to input folder containing SNOMED files")
 parser.add_argument("--dataset_path", type=str, default="SNOMED_datasets/",
                     help="Path to output folder for new datasets")
+parser.add_argument("--description_files", type=str, nargs='+', default=[DESCRIPTION_FILE],
+                    help="SNOMED description files used for positive instances from labels")
+parser.add_argument("--concept_files", type=str, nargs='+', default=[CONCEPT_FILE],
+                    help="SNOMED concept files used for positive instances from labels")
+parser.add_argument("--language_refset_files", type=str, nargs='*', default=[],
+                    help="SNOMED language refset files used to select the descriptions of each language")
+parser.add_argument("--languages", type=language, nargs='*', default=[],
+                    help="Languages (NAME:LANGUAGE_REFSET_ID) to create datasets for, "
+                         "each in its own subfolder of the dataset path")
+parser.add_argument("--relationship_file", type=str, default=RELATIONSHIP_FILE,
+                    help="SNOMED relationship file used by the hierarchy-aware sampling strategies")
+parser.add_argument("--substitution_chains", action='store_true',
+                    help="Also create a dataset pairing each deleted concept with the terminal active concept "
+                         "of its chain of substitutions")
+parser.add_argument("--processes", type=int, default=None,
+                    help="Number of languages whose datasets are created in parallel")
 
 # Changing these arguments results in a different dataset!
 parser.add_argument("--easy_hard_split", type=bool, default=True,
                     help="Split into easy/hard datasets")
 parser.add_argument("--split_distance", type=int, default=5,
                     help="Max Levenshtein distance for easy instances")
-parser.add_argument("--neg_sampling_strategies", type=list, default=['advanced', 'simple'],
+parser.add_argument("--neg_sampling_strategies", type=str, nargs='+', default=['advanced', 'simple'],
+                    choices=['advanced', 'simple', 'approx_advanced',
+                             'advanced_without_hierarchy', 'advanced_hierarchy_neighbours'],
                     help="Strategies to use for negative sampling")
+parser.add_argument("--approx_candidates", type=int, default=50,
+                    help="Number of candidates retrieved per term by the approx_advanced strategy")
+parser.add_argument("--approx_recall_sample", type=int, default=100,
+                    help="Number of terms on which approx_advanced is compared to the exact search")
+
+# The reference engine uses the implementations the published datasets were created with
+parser.add_argument("--engine", type=str, default=FAST_ENGINE, choices=ENGINES,
+                    help="Implementation of duplicate removal and of the simple and advanced strategies")
+parser.add_argument("--verify", action='store_true',
+                    help="Instead of creating the datasets, create them with both engines "
+                         "from a sample of the concepts and compare the files")
+parser.add_argument("--verify_sample", type=int, default=1000,
+                    help="Number of concepts sampled for --verify (0 for all concepts)")
+parser.add_argument("--verify_path", type=str, default=None,
+                    help="Folder to keep the sample and the datasets of --verify in")
+
+# Levenshtein distances are cached in memory and optionally in a file reused by later runs
+parser.add_argument("--distance_cache", type=str, default=None,
+                    help="SQLite file to keep computed Levenshtein distances in for later runs")
+parser.add_argument("--distance_cache_size", type=int, default=CACHE_SIZE,
+                    help="Number of Levenshtein distances kept in memory (0 for no cache)")
 
 params = parser.parse_args()
 
-if not os.path.isdir(params.dataset_path):
-    os.mkdir(params.dataset_path)
+if params.command != 'all' and params.shared_path is None:
+    parser.error('--shared_path is required for %s' % params.command)
+
+if params.languages and not params.language_refset_files:
+    parser.error('--language_refset_files are required for --languages')
+
+if params.distance_cache is not None and not params.distance_cache_size:
+    parser.error('--distance_cache is loaded into memory, so it requires a --distance_cache_size above 0')
+
+if params.command == 'plan':
+    if params.shards is None:
+        parser.error('--shards is required for plan')
+    if params.languages:
+        parser.error('the creation of datasets per language can not be sharded')
+    plan_shards(params.shared_path, params.shards,
+                {name: getattr(params, name) for name in ['snomed_path', 'dataset_path',
+                                                          'description_files', 'concept_files',
+                                                          'relationship_file',
+                                                          'easy_hard_split', 'split_distance',
+                                                          'neg_sampling_strategies',
+                                                          'approx_candidates', 'approx_recall_sample',
+                                                          'engine', 'substitution_chains']})
+
+elif params.command == 'run-shard':
+    if params.stage is None or params.shard is None:
+        parser.error('--stage and --shard are required for run-shard')
+    with distance_cache(params.distance_cache_size, params.distance_cache):
+        run_shard(params.shared_path, params.stage, params.shard)
+
+elif params.command == 'merge':
+    if params.stage is None:
+        parser.error('--stage is required for merge')
+    with distance_cache(params.distance_cache_size, params.distance_cache):
+        merge_shards(params.shared_path, params.stage)
+
+elif params.verify:
+    different_files = verify_engines(params.snomed_path,
+                                     params.concept_files,
+                                     params.neg_sampling_strategies,
+                                     params.easy_hard_split,
+                                     params.split_distance,
+                                     params.verify_sample or None,
+                                     params.verify_path,
+                                     params.description_files,
+                                     params.language_refset_files,
+                                     params.languages)
+    if different_files:
+        sys.exit('The engines created %d different files' % len(different_files))
+    print('The engines created identical files')
+
+else:
+    if not os.path.isdir(params.dataset_path):
+        os.mkdir(params.dataset_path)
+
+    # the is-a hierarchy is only loaded for the hierarchy-aware sampling strategies
+    hierarchy = None
+    if {'advanced_without_hierarchy', 'advanced_hierarchy_neighbours'} & set(params.neg_sampling_strategies):
+        print('*** Loading the is-a hierarchy ***\n')
+        hierarchy = load_is_a_hierarchy(params.snomed_path,
+                                        read_rf2_snapshot(params.snomed_path, params.description_files,
+                                                          usecols=DESCRIPTION_COLUMNS),
+                                        params.relationship_file)
+
+    # finished datasets are written in the background while the next one is created
+    with distance_cache(params.distance_cache_size, params.distance_cache), BackgroundWriter() as writer:
 
-print('*** Starting creation of positive instances from concept labels ***\n')
-positive_instances_from_labels(easy_hard_split=params.easy_hard_split,
-                               split_distance=params.split_distance,
-                               snomed_path=params.snomed_path,
-                               dataset_path=params.dataset_path)
+        print('*** Starting creation of positive instances from concept labels ***\n')
+        positive_instances_from_labels(easy_hard_split=params.easy_hard_split,
+                                       split_distance=params.split_distance,
+                                       snomed_path=params.snomed_path,
+                                       dataset_path=params.dataset_path,
+                                       writer=writer,
+                                       description_files=params.description_files,
+                                       concept_files=params.concept_files,
+                                       language_refset_files=params.language_refset_files,
+                                       languages=params.languages,
+                                       processes=params.processes,
+                                       engine=params.engine)
 
-print('*** Starting creation of positive instances from concept substitutions ***\n')
-positive_instances_from_substitutions(easy_hard_split=params.easy_hard_split,
-                                      split_distance=params.split_distance,
-                                      snomed_path=params.snomed_path,
-                                      dataset_path=params.dataset_path)
+        if params.languages:
+            # substitutions are based on the English fully specified names,
+            # so per language only the datasets from labels are created
+            for language_name, _ in params.languages:
+                print('*** Starting creation of negative instances for language %s ***\n' % language_name)
+                negative_instances(dataset_path=os.path.join(params.dataset_path, language_name, ''),
+                                   strategies=params.neg_sampling_strategies,
+                                   writer=writer,
+                                   approx_candidates=params.approx_candidates,
+                                   approx_recall_sample=params.approx_recall_sample,
+                                   hierarchy=hierarchy,
+                                   engine=params.engine)
+        else:
+            print('*** Starting creation of positive instances from concept substitutions ***\n')
+            positive_instances_from_substitutions(easy_hard_split=params.easy_hard_split,
+                                                  split_distance=params.split_distance,
+                                                  snomed_path=params.snomed_path,
+                                                  dataset_path=params.dataset_path,
+                                                  writer=writer,
+                                                  engine=params.engine,
+                                                  resolve_chains=params.substitution_chains,
+                                                  description_files=params.description_files,
+                                                  concept_files=params.concept_files)
 
-print('*** Starting creation of negative instances ***\n')
-negative_instances(dataset_path=params.dataset_path,
-                   strategies=params.neg_sampling_strategies)
+            print('*** Starting creation of negative instances ***\n')
+            negative_instances(dataset_path=params.dataset_path,
+                               strategies=params.neg_sampling_strategies,
+                               writer=writer,
+                               approx_candidates=params.approx_candidates,
+                               approx_recall_sample=params.approx_recall_sample,
+                               hierarchy=hierarchy,
+                               engine=params.engine)
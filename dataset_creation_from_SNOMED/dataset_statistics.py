@@ -0,0 +1,208 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Statistics of the created datasets, written as JSON
+
+Can also be run on an existing dataset folder:
+    python3 dataset_statistics.py --dataset_path SNOMED_datasets/
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+sys.path.append('..')
+
+from dataset_creation_from_SNOMED.distance_cache import cached_distance
+
+
+STATISTICS_FILE = "dataset_statistics.json"
+
+NEGATIVES_INFIX = "_with_neg_"
+
+
+# count, mean, median, min and max of the values counted in a histogram
+# (the median of an even number of values is the mean of the two middle values)
+def histogram_summary(histogram):
+    counts = np.cumsum(histogram)
+    number_of_values = int(counts[-1]) if len(counts) else 0
+    summary = {'count': number_of_values, 'histogram': [int(c) for c in histogram]}
+    if number_of_values == 0:
+        return summary
+
+    values = np.arange(len(histogram))
+    lower_median = np.searchsorted(counts, (number_of_values - 1) // 2, side='right')
+    upper_median = np.searchsorted(counts, number_of_values // 2, side='right')
+    summary.update({'mean': float(np.dot(values, histogram) / number_of_values),
+                    'median': (int(lower_median) + int(upper_median)) / 2,
+                    'min': int(np.flatnonzero(histogram)[0]),
+                    'max': int(np.flatnonzero(histogram)[-1])})
+    return summary
+
+
+# all datasets of a folder as one frame of term pairs with their label and dataset,
+# positive instances (.tsv) have a header and no scores, datasets with negatives have a score column
+def read_datasets(dataset_path):
+    positive_files = sorted(glob.glob(os.path.join(dataset_path, '*.tsv')))
+    negative_files = sorted(glob.glob(os.path.join(dataset_path, '*' + NEGATIVES_INFIX + '*.txt')))
+
+    datasets = []
+    for file_name in positive_files + negative_files:
+        has_scores = file_name.endswith('.txt')
+        pairs = pd.read_csv(file_name, sep="\t", quoting=csv.QUOTE_NONE, keep_default_na=False,
+                            header=None if has_scores else 0,
+                            names=['source', 'target', 'trueScore'] if has_scores else ['source', 'target'])
+        if not has_scores:
+            pairs['trueScore'] = 1
+        pairs['dataset'] = len(datasets)
+        datasets.append(pairs)
+
+    names = [os.path.basename(f).rsplit(".", 1)[0] for f in positive_files + negative_files]
+    return names, pd.concat(datasets, axis=0, ignore_index=True) if datasets else None
+
+
+# number of shared elements for every two different datasets, from a sparse
+# dataset x element incidence matrix
+def overlap_matrix(names, dataset_ids, element_ids, number_of_elements):
+    incidence = sparse.csr_matrix((np.ones(len(dataset_ids), dtype=np.int64), (dataset_ids, element_ids)),
+                                  shape=(len(names), number_of_elements))
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    overlap = incidence.dot(incidence.T).toarray()
+
+    return {names[i]: {names[j]: int(overlap[i, j]) for j in range(len(names)) if j != i}
+            for i in range(len(names))}
+
+
+# sampling_statistics: statistics reported by the negative sampling strategies,
+# as {dataset name: {statistic name: value}}
+def create_dataset_statistics(dataset_path, sampling_statistics=None):
+    names, pairs = read_datasets(dataset_path)
+    if pairs is None:
+        return {}
+    sampling_statistics = sampling_statistics or {}
+
+    # integer encoding of all terms and of all pairs (a pair and its reverse share the same key)
+    term_ids, terms = pd.factorize(pd.concat([pairs['source'], pairs['target']], ignore_index=True))
+    source_ids, target_ids = term_ids[:len(pairs)].astype(np.int64), term_ids[len(pairs):].astype(np.int64)
+    pair_keys = np.minimum(source_ids, target_ids) * len(terms) + np.maximum(source_ids, target_ids)
+    dataset_ids = pairs['dataset'].values
+    is_positive = pairs['trueScore'].values == 1
+
+    # Levenshtein distance of the lowercased terms, computed once per distinct pair
+    unique_keys, pair_key_ids = np.unique(pair_keys, return_inverse=True)
+    pair_key_ids = pair_key_ids.ravel()
+    normalized_terms = [term.lower() for term in terms]
+    unique_distances = np.fromiter((cached_distance(normalized_terms[key // len(terms)],
+                                                    normalized_terms[key % len(terms)])
+                                    for key in unique_keys.tolist()),
+                                   dtype=np.int64, count=len(unique_keys))
+    distances = unique_distances[pair_key_ids]
+    term_lengths = np.fromiter((len(term) for term in normalized_terms), dtype=np.int64, count=len(terms))
+
+    # pairs which are positive instances in any dataset
+    positive_keys = np.zeros(len(unique_keys), dtype=bool)
+    positive_keys[pair_key_ids[is_positive]] = True
+
+    positive_datasets = [i for i, name in enumerate(names) if NEGATIVES_INFIX not in name]
+    statistics = {'datasets': {}}
+    for i in positive_datasets:
+        in_dataset = dataset_ids == i
+        vocabulary = np.unique(np.concatenate([source_ids[in_dataset], target_ids[in_dataset]]))
+        statistics['datasets'][names[i]] = {
+            'positive_instances': int(in_dataset.sum()),
+            'vocabulary_size': len(vocabulary),
+            'term_lengths': histogram_summary(np.bincount(term_lengths[vocabulary])),
+            'positive_distances': histogram_summary(np.bincount(distances[in_dataset])),
+            'negative_sampling': {}
+        }
+
+    strategies = sorted({name.split(NEGATIVES_INFIX, 1)[1] for name in names if NEGATIVES_INFIX in name})
+    for i, name in enumerate(names):
+        if NEGATIVES_INFIX not in name:
+            continue
+        positive_name, strategy = name.split(NEGATIVES_INFIX, 1)
+        negatives = (dataset_ids == i) & ~is_positive
+        strategy_statistics = {
+            'negative_instances': int(negatives.sum()),
+            'negative_distances': histogram_summary(np.bincount(distances[negatives])),
+            # negative pairs that are positive instances in any dataset
+            'negatives_positive_elsewhere': int(positive_keys[pair_key_ids[negatives]].sum())
+        }
+        strategy_statistics.update(sampling_statistics.get(name, {}))
+        statistics['datasets'].setdefault(positive_name, {'negative_sampling': {}})\
+            ['negative_sampling'][strategy] = strategy_statistics
+
+    # overlap of the vocabularies and of the positive pairs of all datasets of positive instances
+    from_positive_datasets = np.isin(dataset_ids, positive_datasets)
+    positive_names = [names[i] for i in positive_datasets]
+    positive_dataset_index = np.searchsorted(positive_datasets, dataset_ids[from_positive_datasets])
+    statistics['vocabulary_overlap'] = \
+        overlap_matrix(positive_names,
+                       np.concatenate([positive_dataset_index, positive_dataset_index]),
+                       np.concatenate([source_ids[from_positive_datasets], target_ids[from_positive_datasets]]),
+                       len(terms))
+    statistics['positive_pair_overlap'] = overlap_matrix(positive_names, positive_dataset_index,
+                                                         pair_key_ids[from_positive_datasets],
+                                                         len(unique_keys))
+
+    # overlap of the negative pairs of the datasets of each strategy
+    statistics['negative_pair_overlap'] = {}
+    for strategy in strategies:
+        strategy_datasets = [i for i, name in enumerate(names) if name.endswith(NEGATIVES_INFIX + strategy)]
+        negatives = np.isin(dataset_ids, strategy_datasets) & ~is_positive
+        statistics['negative_pair_overlap'][strategy] = \
+            overlap_matrix([names[i].split(NEGATIVES_INFIX, 1)[0] for i in strategy_datasets],
+                           np.searchsorted(strategy_datasets, dataset_ids[negatives]),
+                           pair_key_ids[negatives],
+                           len(unique_keys))
+
+    # leakage between the easy and hard split of each dataset, i.e. pairs in both splits
+    statistics['split_leakage'] = {}
+    for name in positive_names:
+        if '_easy_' not in name:
+            continue
+        hard_name = name.replace('_easy_', '_hard_', 1)
+        if hard_name not in positive_names:
+            continue
+        leakage = {'positive': statistics['positive_pair_overlap'][name][hard_name]}
+        for strategy in strategies:
+            strategy_overlap = statistics['negative_pair_overlap'][strategy]
+            if name in strategy_overlap and hard_name in strategy_overlap[name]:
+                leakage['negative_' + strategy] = strategy_overlap[name][hard_name]
+        statistics['split_leakage'][name.replace('_easy_', '_', 1)] = leakage
+
+    return statistics
+
+
+def write_dataset_statistics(dataset_path, sampling_statistics=None):
+    statistics = create_dataset_statistics(dataset_path, sampling_statistics)
+    with open(os.path.join(dataset_path, STATISTICS_FILE), 'w') as statistics_file:
+        json.dump(statistics, statistics_file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Statistics of the created datasets')
+    parser.add_argument("--dataset_path", type=str, default="SNOMED_datasets/",
+                        help="Path to folder containing the created datasets")
+    params = parser.parse_args()
+
+    write_dataset_statistics(params.dataset_path)
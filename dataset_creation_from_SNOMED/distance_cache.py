@@ -0,0 +1,181 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Cache of the Levenshtein distances of term pairs
+
+Distances are cached by the pair of lowercased terms in canonical order (a pair and its reverse share
+an entry), which does not depend on the vocabulary of a dataset, so the easy/hard split, the distance
+groups of all datasets and sampling strategies and the dataset statistics share the distances of the
+same pairs. The cache has a bounded in-memory LRU tier and optionally an SQLite file: the file is
+loaded into memory when the cache is opened and new distances are written to it in batches, so later
+runs reuse them (distances do not depend on the SNOMED release).
+While a cache is open, cached_distance() uses it, otherwise distances are computed directly.
+"""
+
+import os
+import time
+import itertools
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from Levenshtein import distance as levenshtein_distance
+
+
+# number of distances kept in memory (about 150 bytes each, besides the terms)
+CACHE_SIZE = 1000000
+
+# number of new distances written to the cache file at once
+DISK_BATCH_SIZE = 100000
+
+# number of cached distances computed again to time a computation if no distance was computed
+TIMING_SAMPLE_SIZE = 1000
+
+
+class DistanceCache:
+
+    def __init__(self, max_size=CACHE_SIZE, path=None):
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self.counters = {'hits': 0, 'computed': 0, 'loaded': 0, 'evicted': 0}
+        self.computation_seconds = 0.0
+
+        # the file is only used by the process which opened it (e.g. not by forked worker processes)
+        self._pid = os.getpid()
+        self._connection = None
+        self._new_rows = []
+        if path is not None:
+            self._open_file(path)
+
+    # the most recently written distances of the file are loaded into the memory tier
+    def _open_file(self, path):
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS distances "
+                                 "(term1 TEXT, term2 TEXT, distance INTEGER, PRIMARY KEY (term1, term2)) "
+                                 "WITHOUT ROWID")
+        rows = self._connection.execute("SELECT term1, term2, distance FROM distances LIMIT ?", (self.max_size,))
+        for term1, term2, distance in rows:
+            self._memory[(term1, term2)] = distance
+        self.counters['loaded'] = len(self._memory)
+
+    def is_usable(self):
+        return os.getpid() == self._pid
+
+    # Levenshtein distance of two lowercased terms
+    def distance(self, term1, term2):
+        key = (term1, term2) if term1 <= term2 else (term2, term1)
+        memory = self._memory
+        distance = memory.get(key)
+        if distance is not None:
+            memory.move_to_end(key)
+            self.counters['hits'] += 1
+            return distance
+
+        start = time.perf_counter()
+        distance = levenshtein_distance(term1, term2)
+        self.computation_seconds += time.perf_counter() - start
+        self.counters['computed'] += 1
+        self._store(key, distance)
+        return distance
+
+    # keeps a distance computed elsewhere (e.g. for many targets at once)
+    def remember(self, term1, term2, distance):
+        key = (term1, term2) if term1 <= term2 else (term2, term1)
+        if key not in self._memory:
+            self._store(key, distance)
+
+    def _store(self, key, distance):
+        memory = self._memory
+        memory[key] = distance
+        if len(memory) > self.max_size:
+            memory.popitem(last=False)
+            self.counters['evicted'] += 1
+
+        if self._connection is not None:
+            self._new_rows.append((key[0], key[1], distance))
+            if len(self._new_rows) >= DISK_BATCH_SIZE:
+                self.flush()
+
+    # writes the new distances to the cache file
+    def flush(self):
+        if self._connection is None:
+            return
+        with self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO distances VALUES (?, ?, ?)", self._new_rows)
+        self._new_rows = []
+
+    def close(self):
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+
+    def _mean_computation_seconds(self):
+        if self.counters['computed']:
+            return self.computation_seconds / self.counters['computed']
+
+        # e.g. all distances were loaded from the file
+        sample = list(itertools.islice(self._memory, TIMING_SAMPLE_SIZE))
+        if not sample:
+            return 0.0
+        start = time.perf_counter()
+        for term1, term2 in sample:
+            levenshtein_distance(term1, term2)
+        return (time.perf_counter() - start) / len(sample)
+
+    # counters and the computation time saved by the hits, estimated from the mean computation time
+    def statistics(self):
+        statistics = dict(self.counters)
+        statistics['computation_seconds'] = round(self.computation_seconds, 3)
+        statistics['saved_seconds'] = round(self.counters['hits'] * self._mean_computation_seconds(), 3)
+        return statistics
+
+
+# the cache used by cached_distance()
+_active_cache = None
+
+
+# the open distance cache, None if there is none (or it was opened by another process)
+def active_distance_cache():
+    if _active_cache is None or not _active_cache.is_usable():
+        return None
+    return _active_cache
+
+
+# Levenshtein distance of two lowercased terms, from the open cache if there is one
+def cached_distance(term1, term2):
+    cache = active_distance_cache()
+    if cache is None:
+        return levenshtein_distance(term1, term2)
+    return cache.distance(term1, term2)
+
+
+# uses a distance cache for all distances computed within the context,
+# the counters are printed when the context is left,
+# without memory tier (max_size 0) no cache is used
+@contextmanager
+def distance_cache(max_size=CACHE_SIZE, path=None):
+    global _active_cache
+    if not max_size:
+        yield None
+        return
+
+    cache = DistanceCache(max_size, path)
+    _active_cache = cache
+    try:
+        yield cache
+    finally:
+        _active_cache = None
+        cache.close()
+        print('Levenshtein distance cache: %s' % cache.statistics())
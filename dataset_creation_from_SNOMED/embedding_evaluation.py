@@ -0,0 +1,213 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Evaluation of word embeddings on the created datasets
+
+Each term is represented by the mean of the embeddings of its words, and each pair is scored by the
+cosine similarity of its terms. AUC and accuracy are reported for every dataset with negative instances:
+    python3 embedding_evaluation.py --embeddings vectors.txt --dataset_path SNOMED_datasets/
+    python3 embedding_evaluation.py --embeddings vectors.npy --vocabulary vectors.vocab --dataset_path SNOMED_datasets/
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import rankdata
+
+
+# number of pairs scored at once, bounds the memory used for term vectors
+PAIR_CHUNK_SIZE = 65536
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# index: word -> row of the word in vectors
+# vectors: embedding matrix (possibly memory-mapped)
+Embeddings = namedtuple('Embeddings', ['index', 'vectors'])
+
+
+# word2vec text format: an optional header line with the number of words and dimensions,
+# then one line per word with the word and its vector, separated by spaces
+def load_text_embeddings(file_name):
+    with open(file_name, encoding='utf-8') as embeddings_file:
+        has_header = len(embeddings_file.readline().split()) == 2
+
+    table = pd.read_csv(file_name, sep=" ", header=None, skiprows=1 if has_header else 0,
+                        quoting=csv.QUOTE_NONE, keep_default_na=False, na_filter=False,
+                        dtype={0: str}, encoding='utf-8')
+    # trailing spaces at the end of lines result in an empty last column
+    if table[table.columns[-1]].dtype == object:
+        table = table.iloc[:, :-1]
+
+    words = table[0].tolist()
+    return Embeddings({word: i for i, word in reversed(list(enumerate(words)))},
+                      table.iloc[:, 1:].values.astype(np.float32))
+
+
+# .npy matrix with one row per word of the vocabulary file (one word per line), memory-mapped
+def load_numpy_embeddings(file_name, vocabulary_file):
+    with open(vocabulary_file, encoding='utf-8') as vocabulary:
+        words = [line.rstrip('\n') for line in vocabulary]
+    vectors = np.load(file_name, mmap_mode='r')
+    if len(words) != vectors.shape[0]:
+        raise Exception('Vocabulary has %d words but there are %d embeddings' % (len(words), vectors.shape[0]))
+
+    return Embeddings({word: i for i, word in reversed(list(enumerate(words)))}, vectors)
+
+
+def load_embeddings(file_name, vocabulary_file=None):
+    if file_name.endswith('.npy'):
+        if vocabulary_file is None:
+            raise Exception('A vocabulary file is required for .npy embeddings')
+        return load_numpy_embeddings(file_name, vocabulary_file)
+    return load_text_embeddings(file_name)
+
+
+# the rows of the words of a term in the embeddings, words without embedding are skipped
+def term_word_ids(embeddings, term, lowercase):
+    if lowercase:
+        term = term.lower()
+    return [embeddings.index[word] for word in TOKEN_PATTERN.findall(term) if word in embeddings.index]
+
+
+# L2 normalised mean word embedding of each term, computed as one sparse (terms x words) matrix product,
+# terms without any known word get a zero vector
+def create_term_vectors(embeddings, terms, lowercase=True):
+    word_ids = [term_word_ids(embeddings, term, lowercase) for term in terms]
+    numbers_of_words = np.fromiter((len(ids) for ids in word_ids), dtype=np.int64, count=len(terms))
+
+    weights = np.repeat(1 / np.maximum(numbers_of_words, 1), numbers_of_words).astype(np.float32)
+    composition = sparse.csr_matrix((weights, np.fromiter((i for ids in word_ids for i in ids), dtype=np.int64,
+                                                          count=numbers_of_words.sum()),
+                                     np.concatenate([[0], np.cumsum(numbers_of_words)])),
+                                    shape=(len(terms), embeddings.vectors.shape[0]))
+
+    # only the used rows of (memory-mapped) embeddings are read
+    used_words = np.unique(composition.indices)
+    composition = sparse.csr_matrix((composition.data, np.searchsorted(used_words, composition.indices),
+                                     composition.indptr), shape=(len(terms), len(used_words)))
+    term_vectors = np.asarray(composition.dot(np.asarray(embeddings.vectors[used_words], dtype=np.float32)))
+
+    norms = np.linalg.norm(term_vectors, axis=1)
+    norms[norms == 0] = 1
+    return term_vectors / norms[:, None], numbers_of_words > 0
+
+
+# cosine similarity of all pairs of a dataset file and their labels, scored in chunks of pairs
+def score_dataset(embeddings, file_name, lowercase=True, chunk_size=PAIR_CHUNK_SIZE):
+    scores, labels = [], []
+    number_of_terms, unknown_terms = 0, 0
+
+    for chunk in pd.read_csv(file_name, sep="\t", header=None, names=['source', 'target', 'trueScore'],
+                             quoting=csv.QUOTE_NONE, keep_default_na=False, chunksize=chunk_size):
+        term_ids, terms = pd.factorize(pd.concat([chunk['source'], chunk['target']], ignore_index=True))
+        term_vectors, known = create_term_vectors(embeddings, terms, lowercase)
+        number_of_terms += len(terms)
+        unknown_terms += int((~known).sum())
+
+        source_vectors = term_vectors[term_ids[:chunk.shape[0]]]
+        target_vectors = term_vectors[term_ids[chunk.shape[0]:]]
+        scores.append(np.einsum('ij,ij->i', source_vectors, target_vectors))
+        labels.append(chunk['trueScore'].values.astype(np.int8))
+
+    scores = np.concatenate(scores) if scores else np.empty(0, dtype=np.float32)
+    labels = np.concatenate(labels) if labels else np.empty(0, dtype=np.int8)
+    # terms are counted once per chunk they occur in
+    return scores, labels, unknown_terms / max(number_of_terms, 1)
+
+
+# area under the ROC curve from the ranks of the scores (Mann-Whitney U statistic, ties get mean ranks)
+def auc(scores, labels):
+    number_of_positives = int(labels.sum())
+    number_of_negatives = len(labels) - number_of_positives
+    if number_of_positives == 0 or number_of_negatives == 0:
+        return None
+    ranks = rankdata(scores)
+    return float((ranks[labels == 1].sum() - number_of_positives * (number_of_positives + 1) / 2)
+                 / (number_of_positives * number_of_negatives))
+
+
+# accuracy when pairs with a score of at least the threshold are classified as similar
+def accuracy(scores, labels, threshold):
+    return float(np.mean((scores >= threshold) == (labels == 1))) if len(labels) else None
+
+
+# the threshold with the highest accuracy on the dataset (an upper bound of what a tuned threshold achieves)
+def best_threshold(scores, labels):
+    if len(labels) == 0:
+        return None, None
+    order = np.argsort(-scores, kind='mergesort')
+    sorted_scores, sorted_labels = scores[order], labels[order]
+
+    # classifying the first k pairs as similar, only cutting between different scores
+    true_positives = np.cumsum(sorted_labels)
+    false_positives = np.arange(1, len(labels) + 1) - true_positives
+    correct = true_positives + (len(labels) - int(labels.sum()) - false_positives)
+    cuts = np.flatnonzero(np.concatenate([sorted_scores[1:] != sorted_scores[:-1], [True]]))
+
+    accuracies = np.concatenate([[len(labels) - int(labels.sum())], correct[cuts]]) / len(labels)
+    best = int(np.argmax(accuracies))
+    threshold = float(np.nextafter(sorted_scores[0], np.inf)) if best == 0 else float(sorted_scores[cuts[best - 1]])
+    return float(accuracies[best]), threshold
+
+
+def evaluate_embeddings(embeddings, dataset_path, threshold=0.5, lowercase=True, chunk_size=PAIR_CHUNK_SIZE):
+    results = {}
+    for file_name in sorted(glob.glob(os.path.join(dataset_path, '*_with_neg_*.txt'))):
+        scores, labels, unknown_term_share = score_dataset(embeddings, file_name, lowercase, chunk_size)
+        best_accuracy, tuned_threshold = best_threshold(scores, labels)
+        results[os.path.basename(file_name).rsplit(".", 1)[0]] = {
+            'pairs': len(labels),
+            'positive_pairs': int(labels.sum()),
+            'terms_without_embedding': unknown_term_share,
+            'auc': auc(scores, labels),
+            'accuracy': accuracy(scores, labels, threshold),
+            'best_accuracy': best_accuracy,
+            'best_threshold': tuned_threshold
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluation of word embeddings on the created datasets')
+    parser.add_argument("--embeddings", type=str, required=True,
+                        help="Embeddings as word2vec text file or .npy matrix")
+    parser.add_argument("--vocabulary", type=str, default=None,
+                        help="Words of the rows of .npy embeddings, one per line")
+    parser.add_argument("--dataset_path", type=str, default="SNOMED_datasets/",
+                        help="Path to folder containing the created datasets")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="Cosine similarity from which pairs are classified as similar")
+    parser.add_argument("--keep_case", action='store_true',
+                        help="Look up words in their original case instead of lowercased")
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSON file for the results (printed if not given)")
+    params = parser.parse_args()
+
+    evaluation = evaluate_embeddings(load_embeddings(params.embeddings, params.vocabulary),
+                                     params.dataset_path,
+                                     params.threshold,
+                                     not params.keep_case)
+    if params.output is None:
+        print(json.dumps(evaluation, indent=2))
+    else:
+        with open(params.output, 'w') as output:
+            json.dump(evaluation, output, indent=2)
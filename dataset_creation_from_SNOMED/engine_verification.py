@@ -0,0 +1,220 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Differential check of the fast engine against the reference engine
+
+The datasets are created with both engines from a sample of the SNOMED concepts,
+and every created file is compared by its content hash.
+"""
+
+import csv
+import glob
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import pandas as pd
+
+from dataset_creation_from_SNOMED.background_writer import BackgroundWriter
+from dataset_creation_from_SNOMED.rf2_reader import CHUNK_SIZE
+from dataset_creation_from_SNOMED.reference_engine import ENGINES
+from dataset_creation_from_SNOMED.positive_instances_from_labels import positive_instances_from_labels
+from dataset_creation_from_SNOMED.positive_instances_from_labels import DESCRIPTION_FILE
+from dataset_creation_from_SNOMED.positive_instances_from_substitutions import positive_instances_from_substitutions
+from dataset_creation_from_SNOMED.positive_instances_from_substitutions import ASSOCIATION_FILE
+from dataset_creation_from_SNOMED.negative_sampling_from_positive_instances import negative_instances
+from dataset_creation_from_SNOMED.is_a_hierarchy import RELATIONSHIP_FILE
+
+
+# the sampling strategies which have a reference implementation
+VERIFIED_STRATEGIES = ['advanced', 'simple']
+
+# size of the blocks in which files are hashed
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def read_rf2_chunks(file_name):
+    # ids are kept as text, so that sampled files contain exactly the original rows
+    return pd.read_csv(file_name, sep="\t", header=0, dtype=str, chunksize=CHUNK_SIZE,
+                       quoting=csv.QUOTE_NONE, keep_default_na=False, na_filter=False)
+
+
+# copies the rows of an RF2 file whose id columns all contain a sampled concept (or other component),
+# returns the ids of the copied rows
+def write_sampled_rf2_file(file_name, sampled_file_name, id_columns, concept_ids):
+    sampled_row_ids = set()
+    with open(sampled_file_name, 'w') as sampled_file:
+        for i, chunk in enumerate(read_rf2_chunks(file_name)):
+            in_sample = chunk[id_columns[0]].isin(concept_ids)
+            for id_column in id_columns[1:]:
+                in_sample &= chunk[id_column].isin(concept_ids)
+            chunk[in_sample].to_csv(sampled_file, sep="\t", index=False, header=i == 0,
+                                    quoting=csv.QUOTE_NONE)
+            sampled_row_ids.update(chunk.loc[in_sample, 'id'])
+    return sampled_row_ids
+
+
+# writes the SNOMED files restricted to a random sample of the concepts
+# (and the concepts they are substituted by) to sample_path,
+# the language refset files restricted to the descriptions of these concepts
+def sample_snomed_files(snomed_path, sample_path, concept_files, number_of_concepts,
+                        description_files=(DESCRIPTION_FILE,), language_refset_files=(), seed=42):
+    concept_ids = set()
+    for concept_file in concept_files:
+        for chunk in read_rf2_chunks(os.path.join(snomed_path, concept_file)):
+            concept_ids.update(chunk['id'])
+    sampled_ids = set(random.Random(seed).sample(sorted(concept_ids), min(number_of_concepts, len(concept_ids))))
+
+    # the substituting concepts are needed for the labels of the substitution pairs,
+    # and as their own substitutions are sampled too, chains of substitutions are followed to their end
+    association_file = os.path.join(snomed_path, ASSOCIATION_FILE)
+    if os.path.exists(association_file):
+        substitutions = pd.concat([chunk[['referencedComponentId', 'targetComponentId']]
+                                   for chunk in read_rf2_chunks(association_file)])
+        new_ids = set(sampled_ids)
+        while new_ids:
+            new_ids = set(substitutions.loc[substitutions['referencedComponentId'].isin(new_ids),
+                                            'targetComponentId']) - sampled_ids
+            sampled_ids.update(new_ids)
+
+    sampled_files = [(concept_file, ['id']) for concept_file in concept_files] + \
+                    [(ASSOCIATION_FILE, ['referencedComponentId']),
+                     (RELATIONSHIP_FILE, ['sourceId', 'destinationId'])]
+    for file_name, id_columns in sampled_files:
+        if os.path.exists(os.path.join(snomed_path, file_name)):
+            write_sampled_rf2_file(os.path.join(snomed_path, file_name), os.path.join(sample_path, file_name),
+                                   id_columns, sampled_ids)
+
+    sampled_description_ids = set()
+    for description_file in description_files:
+        sampled_description_ids.update(write_sampled_rf2_file(os.path.join(snomed_path, description_file),
+                                                              os.path.join(sample_path, description_file),
+                                                              ['conceptId'], sampled_ids))
+
+    for language_refset_file in language_refset_files:
+        write_sampled_rf2_file(os.path.join(snomed_path, language_refset_file),
+                               os.path.join(sample_path, language_refset_file),
+                               ['referencedComponentId'], sampled_description_ids)
+
+    return len(sampled_ids)
+
+
+def create_datasets_with_engine(snomed_path, dataset_path, concept_files, strategies,
+                                easy_hard_split, split_distance, engine,
+                                description_files=(DESCRIPTION_FILE,), language_refset_files=(), languages=()):
+    os.makedirs(dataset_path)
+
+    with BackgroundWriter() as writer:
+        positive_instances_from_labels(easy_hard_split=easy_hard_split,
+                                       split_distance=split_distance,
+                                       snomed_path=snomed_path,
+                                       dataset_path=dataset_path,
+                                       writer=writer,
+                                       description_files=description_files,
+                                       concept_files=concept_files,
+                                       language_refset_files=language_refset_files,
+                                       languages=languages,
+                                       engine=engine)
+
+        # as in create_datasets, only the datasets from labels are created per language
+        if languages:
+            for language_name, _ in languages:
+                negative_instances(dataset_path=os.path.join(dataset_path, language_name, ''),
+                                   strategies=strategies,
+                                   writer=writer,
+                                   engine=engine)
+        else:
+            positive_instances_from_substitutions(easy_hard_split=easy_hard_split,
+                                                  split_distance=split_distance,
+                                                  snomed_path=snomed_path,
+                                                  dataset_path=dataset_path,
+                                                  writer=writer,
+                                                  engine=engine,
+                                                  description_files=description_files,
+                                                  concept_files=concept_files)
+            negative_instances(dataset_path=dataset_path,
+                               strategies=strategies,
+                               writer=writer,
+                               engine=engine)
+
+
+# SHA-256 of a file, read block by block
+def file_digest(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# compares the files created by the engines (including those of the language subfolders)
+# as {file name relative to the dataset path: {engine: hash or None if missing}}
+def compare_dataset_files(dataset_paths):
+    file_names = sorted({os.path.relpath(f, dataset_path) for dataset_path in dataset_paths.values()
+                         for f in glob.glob(os.path.join(dataset_path, '**', '*'), recursive=True)
+                         if os.path.isfile(f)})
+    return {file_name: {engine: file_digest(os.path.join(dataset_path, file_name))
+                        if os.path.exists(os.path.join(dataset_path, file_name)) else None
+                        for engine, dataset_path in dataset_paths.items()}
+            for file_name in file_names}
+
+
+# number_of_concepts: size of the concept sample, all concepts are used if it is None
+# verification_path: folder for the sample and the datasets of both engines,
+#     a temporary folder which is removed afterwards if it is None
+# returns the names of the files which differ between the engines
+def verify_engines(snomed_path,
+                   concept_files,
+                   strategies,
+                   easy_hard_split,
+                   split_distance,
+                   number_of_concepts=None,
+                   verification_path=None,
+                   description_files=(DESCRIPTION_FILE,),
+                   language_refset_files=(),
+                   languages=()):
+    strategies = [strategy for strategy in strategies if strategy in VERIFIED_STRATEGIES]
+    keep_files = verification_path is not None
+    if verification_path is None:
+        verification_path = tempfile.mkdtemp(prefix='medisim_verification_')
+
+    try:
+        if number_of_concepts is not None:
+            sample_path = os.path.join(verification_path, 'snomed_sample')
+            os.makedirs(sample_path)
+            print('*** Sampling %d concepts ***\n'
+                  % sample_snomed_files(snomed_path, sample_path, concept_files, number_of_concepts,
+                                        description_files, language_refset_files))
+            snomed_path = sample_path
+
+        dataset_paths = {engine: os.path.join(verification_path, engine, '') for engine in ENGINES}
+        for engine, dataset_path in dataset_paths.items():
+            print('*** Creating datasets with the %s engine ***\n' % engine)
+            create_datasets_with_engine(snomed_path, dataset_path, concept_files, strategies,
+                                        easy_hard_split, split_distance, engine,
+                                        description_files, language_refset_files, languages)
+
+        different_files = []
+        for file_name, digests in compare_dataset_files(dataset_paths).items():
+            identical = len(set(digests.values())) == 1 and None not in digests.values()
+            print('%s %s' % ('identical' if identical else 'DIFFERENT', file_name))
+            if not identical:
+                different_files.append(file_name)
+        return different_files
+
+    finally:
+        if not keep_files:
+            shutil.rmtree(verification_path, ignore_errors=True)
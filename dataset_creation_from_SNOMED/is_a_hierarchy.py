@@ -0,0 +1,203 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Transitive closure of the active SNOMED is-a hierarchy for ancestor/descendant queries"""
+
+import itertools
+from collections import namedtuple
+import numpy as np
+
+from dataset_creation_from_SNOMED.snomed_id import SnomedID
+from dataset_creation_from_SNOMED.rf2_reader import read_rf2_snapshot
+from dataset_creation_from_SNOMED.positive_instances_utils import clean_pref_term
+
+
+RELATIONSHIP_FILE = "sct2_Relationship_Full_INT_20190131.txt"
+
+# concept_index: SNOMED concept ID -> integer concept id
+# ancestors_indptr, ancestors: sorted integer ids of all ancestors of each concept in CSR form,
+#     i.e. ancestors[ancestors_indptr[c]:ancestors_indptr[c + 1]] are the ancestors of concept c
+# descendants_indptr, descendants: the same for all descendants of each concept
+# term_concepts: term -> integer ids of the concepts having this term as label
+# ancestor_sets, descendant_sets: integer concept id -> set of its ancestors/descendants,
+#     filled from the CSR rows when a concept is first queried
+IsAHierarchy = namedtuple('IsAHierarchy', ['concept_index',
+                                           'ancestors_indptr', 'ancestors',
+                                           'descendants_indptr', 'descendants',
+                                           'term_concepts',
+                                           'ancestor_sets', 'descendant_sets'])
+
+
+# the most recent entry of each relationship decides if it is active
+def read_active_is_a_relationships(snomed_path, relationship_file=RELATIONSHIP_FILE):
+    latest_entries = read_rf2_snapshot(snomed_path,
+                                       [relationship_file],
+                                       usecols=['id', 'effectiveTime', 'active',
+                                                'sourceId', 'destinationId', 'typeId'],
+                                       row_filter=lambda chunk: chunk['typeId'] == SnomedID.IS_A.value)
+    latest_entries = latest_entries[latest_entries['active'].astype(bool)]
+
+    return latest_entries['sourceId'].values, latest_entries['destinationId'].values
+
+
+# computes the ancestors of all concepts in topological order (parents before children),
+# each concept's ancestors being the union of its parents and their ancestors
+def create_ancestor_closure(child_ids, parent_ids, number_of_concepts):
+    order = np.argsort(child_ids, kind='mergesort')
+    parents_indptr = np.concatenate([[0], np.cumsum(np.bincount(child_ids, minlength=number_of_concepts))])
+    parents = parent_ids[order]
+
+    children = [[] for _ in range(number_of_concepts)]
+    for child, parent in zip(child_ids.tolist(), parent_ids.tolist()):
+        children[parent].append(child)
+    missing_parents = np.diff(parents_indptr)
+
+    ancestors = [None] * number_of_concepts
+    ready = [c for c in range(number_of_concepts) if missing_parents[c] == 0]
+    while ready:
+        concept = ready.pop()
+        concept_parents = parents[parents_indptr[concept]:parents_indptr[concept + 1]]
+        if len(concept_parents):
+            ancestors[concept] = np.unique(np.concatenate([concept_parents] +
+                                                          [ancestors[p] for p in concept_parents]))
+        else:
+            ancestors[concept] = np.empty(0, dtype=np.int64)
+
+        for child in children[concept]:
+            missing_parents[child] -= 1
+            if missing_parents[child] == 0:
+                ready.append(child)
+
+    if any(a is None for a in ancestors):
+        raise Exception('The is-a hierarchy contains a cycle')
+
+    indptr = np.concatenate([[0], np.cumsum([len(a) for a in ancestors])])
+    return indptr, np.concatenate(ancestors).astype(np.int64)
+
+
+# the descendants of each concept in CSR form, by inverting the ancestor closure
+def invert_closure(indptr, ancestors, number_of_concepts):
+    concepts = np.repeat(np.arange(number_of_concepts), np.diff(indptr))
+    order = np.lexsort((concepts, ancestors))
+    descendants_indptr = np.concatenate([[0], np.cumsum(np.bincount(ancestors,
+                                                                    minlength=number_of_concepts))])
+    return descendants_indptr, concepts[order]
+
+
+# maps all current labels of concepts to the concepts, as they occur in the datasets
+# (fully specified names also with their semantic type removed)
+def create_term_concepts(labels, concept_index):
+    latest_entries = labels.sort_values('effectiveTime', kind='mergesort').drop_duplicates('id', keep='last')
+    latest_entries = latest_entries[latest_entries['active'].astype(bool)
+                                    & latest_entries['conceptId'].isin(list(concept_index))]
+
+    term_concepts = {}
+    for concept, term, type_id in zip(latest_entries['conceptId'].tolist(),
+                                      latest_entries['term'].tolist(),
+                                      latest_entries['typeId'].tolist()):
+        terms = [term]
+        if type_id == SnomedID.FSN_DESCRIPTION.value:
+            terms.append(clean_pref_term(term))
+        for t in terms:
+            term_concepts.setdefault(t, set()).add(concept_index[concept])
+
+    return {term: tuple(sorted(concepts)) for term, concepts in term_concepts.items()}
+
+
+def load_is_a_hierarchy(snomed_path, labels, relationship_file=RELATIONSHIP_FILE):
+    source_ids, destination_ids = read_active_is_a_relationships(snomed_path, relationship_file)
+
+    concept_ids = np.unique(np.concatenate([source_ids, destination_ids]))
+    concept_index = {concept: i for i, concept in enumerate(concept_ids.tolist())}
+    ancestors_indptr, ancestors = create_ancestor_closure(np.searchsorted(concept_ids, source_ids),
+                                                          np.searchsorted(concept_ids, destination_ids),
+                                                          len(concept_ids))
+    descendants_indptr, descendants = invert_closure(ancestors_indptr, ancestors, len(concept_ids))
+
+    return IsAHierarchy(concept_index,
+                        ancestors_indptr, ancestors,
+                        descendants_indptr, descendants,
+                        create_term_concepts(labels, concept_index),
+                        {}, {})
+
+
+def get_ancestors(hierarchy, concept):
+    return hierarchy.ancestors[hierarchy.ancestors_indptr[concept]:hierarchy.ancestors_indptr[concept + 1]]
+
+
+def get_descendants(hierarchy, concept):
+    return hierarchy.descendants[hierarchy.descendants_indptr[concept]:
+                                 hierarchy.descendants_indptr[concept + 1]]
+
+
+def get_ancestor_set(hierarchy, concept):
+    ancestor_set = hierarchy.ancestor_sets.get(concept)
+    if ancestor_set is None:
+        ancestor_set = hierarchy.ancestor_sets[concept] = frozenset(get_ancestors(hierarchy, concept).tolist())
+    return ancestor_set
+
+
+def get_descendant_set(hierarchy, concept):
+    descendant_set = hierarchy.descendant_sets.get(concept)
+    if descendant_set is None:
+        descendant_set = hierarchy.descendant_sets[concept] = \
+            frozenset(get_descendants(hierarchy, concept).tolist())
+    return descendant_set
+
+
+# whether other_concept is an ancestor of concept, in constant time once concept was queried
+def is_ancestor(hierarchy, other_concept, concept):
+    return other_concept in get_ancestor_set(hierarchy, concept)
+
+
+# whether other_concept is a descendant of concept, in constant time once concept was queried
+def is_descendant(hierarchy, other_concept, concept):
+    return other_concept in get_descendant_set(hierarchy, concept)
+
+
+# the concepts of each term of a vocabulary (see term_features) in CSR form,
+# i.e. concepts[indptr[t]:indptr[t + 1]] are the concepts of the term with term id t
+def create_term_concept_entries(hierarchy, term_features):
+    term_concepts = [hierarchy.term_concepts.get(term, ()) for term in term_features.terms]
+    indptr = np.concatenate([[0], np.cumsum([len(concepts) for concepts in term_concepts])]).astype(np.int64)
+    concepts = np.fromiter(itertools.chain.from_iterable(term_concepts), dtype=np.int64, count=indptr[-1])
+    return indptr, concepts
+
+
+# marks the target terms (term ids of a vocabulary) with a concept that is an ancestor or descendant
+# of a concept of the given term, only looking up the concepts of the targets
+def hierarchy_neighbour_terms(hierarchy, term_concept_entries, term, target_ids):
+    indptr, entry_concepts = term_concept_entries
+    neighbour_terms = np.zeros(len(target_ids), dtype=bool)
+    concepts = hierarchy.term_concepts.get(term, ())
+    if not concepts:
+        return neighbour_terms
+
+    # the concepts of all targets, target by target
+    counts = indptr[target_ids + 1] - indptr[target_ids]
+    entries = np.repeat(indptr[target_ids] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    target_concepts = entry_concepts[entries]
+
+    # the ancestors and descendants of the term's concepts, each target concept is looked up in these sets
+    neighbour_sets = [neighbour_set for concept in concepts
+                      for neighbour_set in (get_ancestor_set(hierarchy, concept),
+                                            get_descendant_set(hierarchy, concept))
+                      if neighbour_set]
+    is_neighbour = np.fromiter((any(target_concept in neighbour_set for neighbour_set in neighbour_sets)
+                                for target_concept in target_concepts.tolist()),
+                               dtype=bool, count=len(target_concepts))
+
+    neighbour_terms[np.repeat(np.arange(len(target_ids)), counts)[is_neighbour]] = True
+    return neighbour_terms
@@ -0,0 +1,235 @@
+/* Copyright 2020 Babylon Partners. All Rights Reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ * ==============================================================================
+ *
+ * Levenshtein distances of one term to many terms with the bit-parallel algorithm of Myers,
+ * in the block-based form of Hyyrö for terms longer than 64 characters.
+ *
+ * Terms are given as unicode code points, the candidate terms as ids into one concatenated
+ * buffer of all terms. The bit vectors of the characters of the query (the pattern) are
+ * computed once per call: directly indexed for ASCII characters, in a sorted table for others.
+ */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define WORD_BITS 64
+#define ASCII_SIZE 128
+
+typedef struct {
+    int64_t words;              /* number of 64 bit blocks of the pattern */
+    uint64_t *ascii;            /* ASCII_SIZE x words bit vectors */
+    uint32_t *other_chars;      /* sorted non-ASCII characters of the pattern */
+    uint64_t *other;            /* their bit vectors, words each */
+    int64_t other_size;
+} Pattern;
+
+static int compare_code_points(const void *a, const void *b)
+{
+    uint32_t x = *(const uint32_t *) a, y = *(const uint32_t *) b;
+    return (x > y) - (x < y);
+}
+
+static int create_pattern(Pattern *pattern, const uint32_t *query, int64_t length)
+{
+    int64_t i, j;
+    int64_t words = (length + WORD_BITS - 1) / WORD_BITS;
+
+    pattern->words = words;
+    pattern->ascii = calloc(ASCII_SIZE * words, sizeof(uint64_t));
+    pattern->other_chars = malloc(length * sizeof(uint32_t) + 1);
+    pattern->other = NULL;
+    pattern->other_size = 0;
+    if (pattern->ascii == NULL || pattern->other_chars == NULL)
+        return -1;
+
+    for (i = 0; i < length; i++) {
+        if (query[i] < ASCII_SIZE)
+            pattern->ascii[query[i] * words + i / WORD_BITS] |= (uint64_t) 1 << (i % WORD_BITS);
+        else
+            pattern->other_chars[pattern->other_size++] = query[i];
+    }
+
+    /* distinct non-ASCII characters */
+    qsort(pattern->other_chars, pattern->other_size, sizeof(uint32_t), compare_code_points);
+    for (i = 0, j = 0; i < pattern->other_size; i++)
+        if (j == 0 || pattern->other_chars[j - 1] != pattern->other_chars[i])
+            pattern->other_chars[j++] = pattern->other_chars[i];
+    pattern->other_size = j;
+
+    pattern->other = calloc(pattern->other_size * words + 1, sizeof(uint64_t));
+    if (pattern->other == NULL)
+        return -1;
+    for (i = 0; i < length; i++) {
+        if (query[i] >= ASCII_SIZE) {
+            uint32_t *found = bsearch(&query[i], pattern->other_chars, pattern->other_size,
+                                      sizeof(uint32_t), compare_code_points);
+            pattern->other[(found - pattern->other_chars) * words + i / WORD_BITS] |=
+                (uint64_t) 1 << (i % WORD_BITS);
+        }
+    }
+    return 0;
+}
+
+static void free_pattern(Pattern *pattern)
+{
+    free(pattern->ascii);
+    free(pattern->other_chars);
+    free(pattern->other);
+}
+
+/* bit vectors of a character of a candidate term, NULL if it is not in the pattern */
+static const uint64_t *character_vectors(const Pattern *pattern, uint32_t character)
+{
+    const uint32_t *found;
+
+    if (character < ASCII_SIZE)
+        return pattern->ascii + character * pattern->words;
+    if (pattern->other_size == 0)
+        return NULL;
+    found = bsearch(&character, pattern->other_chars, pattern->other_size,
+                    sizeof(uint32_t), compare_code_points);
+    return found == NULL ? NULL : pattern->other + (found - pattern->other_chars) * pattern->words;
+}
+
+/* distance of a pattern of at most 64 characters to one term (Myers) */
+static int64_t single_word_distance(const Pattern *pattern, int64_t length,
+                                    const uint32_t *text, int64_t text_length)
+{
+    uint64_t last_bit = (uint64_t) 1 << (length - 1);
+    uint64_t pv = ~(uint64_t) 0, mv = 0;
+    int64_t score = length;
+    int64_t i;
+
+    for (i = 0; i < text_length; i++) {
+        uint64_t eq, xv, xh, ph, mh;
+
+        if (text[i] < ASCII_SIZE) {
+            eq = pattern->ascii[text[i]];
+        } else {
+            const uint64_t *vectors = character_vectors(pattern, text[i]);
+            eq = vectors == NULL ? 0 : *vectors;
+        }
+        xv = eq | mv;
+        xh = (((eq & pv) + pv) ^ pv) | eq;
+        ph = mv | ~(xh | pv);
+        mh = pv & xh;
+        score += (ph & last_bit) != 0;
+        score -= (mh & last_bit) != 0;
+        /* the first row of the distance matrix increases by one in each column */
+        ph = (ph << 1) | 1;
+        mh <<= 1;
+        pv = mh | ~(xv | ph);
+        mv = ph & xv;
+    }
+    return score;
+}
+
+/* distance of the pattern (of the given length) to one term (Hyyrö's blocks of 64 characters) */
+static int64_t pattern_distance(const Pattern *pattern, int64_t length,
+                                const uint32_t *text, int64_t text_length,
+                                uint64_t *positive_vertical, uint64_t *negative_vertical)
+{
+    int64_t words = pattern->words;
+    uint64_t last_bit = (uint64_t) 1 << ((length - 1) % WORD_BITS);
+    int64_t score = length;
+    int64_t i, b;
+
+    for (b = 0; b < words; b++) {
+        positive_vertical[b] = ~(uint64_t) 0;
+        negative_vertical[b] = 0;
+    }
+
+    for (i = 0; i < text_length; i++) {
+        const uint64_t *vectors = character_vectors(pattern, text[i]);
+        /* the first row of the distance matrix increases by one in each column */
+        int horizontal_in = 1;
+
+        for (b = 0; b < words; b++) {
+            uint64_t pv = positive_vertical[b], mv = negative_vertical[b];
+            uint64_t eq = vectors == NULL ? 0 : vectors[b];
+            uint64_t xv = eq | mv;
+            uint64_t xh, ph, mh;
+            uint64_t high_bit = b == words - 1 ? last_bit : (uint64_t) 1 << (WORD_BITS - 1);
+            int horizontal_out = 0;
+
+            if (horizontal_in < 0)
+                eq |= 1;
+            xh = (((eq & pv) + pv) ^ pv) | eq;
+            ph = mv | ~(xh | pv);
+            mh = pv & xh;
+
+            if (ph & high_bit)
+                horizontal_out = 1;
+            else if (mh & high_bit)
+                horizontal_out = -1;
+
+            ph <<= 1;
+            mh <<= 1;
+            if (horizontal_in < 0)
+                mh |= 1;
+            else if (horizontal_in > 0)
+                ph |= 1;
+
+            positive_vertical[b] = mh | ~(xv | ph);
+            negative_vertical[b] = ph & xv;
+            horizontal_in = horizontal_out;
+        }
+        score += horizontal_in;
+    }
+    return score;
+}
+
+/* distances[k] = Levenshtein distance of the query to the term term_ids[k], whose code points are
+ * code_points[offsets[term_ids[k]]:offsets[term_ids[k] + 1]], returns 0 or -1 if out of memory */
+int levenshtein_one_to_many(const uint32_t *query, int64_t length,
+                            const uint32_t *code_points, const int64_t *offsets,
+                            const int64_t *term_ids, int64_t number_of_terms,
+                            int64_t *distances)
+{
+    Pattern pattern;
+    uint64_t *positive_vertical, *negative_vertical;
+    int64_t k;
+
+    if (length == 0) {
+        for (k = 0; k < number_of_terms; k++)
+            distances[k] = offsets[term_ids[k] + 1] - offsets[term_ids[k]];
+        return 0;
+    }
+
+    memset(&pattern, 0, sizeof(pattern));
+    positive_vertical = malloc(2 * ((length + WORD_BITS - 1) / WORD_BITS) * sizeof(uint64_t));
+    if (positive_vertical == NULL || create_pattern(&pattern, query, length) != 0) {
+        free(positive_vertical);
+        free_pattern(&pattern);
+        return -1;
+    }
+    negative_vertical = positive_vertical + pattern.words;
+
+    for (k = 0; k < number_of_terms; k++) {
+        int64_t start = offsets[term_ids[k]];
+        int64_t text_length = offsets[term_ids[k] + 1] - start;
+
+        if (pattern.words == 1)
+            distances[k] = single_word_distance(&pattern, length, code_points + start, text_length);
+        else
+            distances[k] = pattern_distance(&pattern, length, code_points + start, text_length,
+                                            positive_vertical, negative_vertical);
+    }
+
+    free(positive_vertical);
+    free_pattern(&pattern);
+    return 0;
+}
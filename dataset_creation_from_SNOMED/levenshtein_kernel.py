@@ -0,0 +1,98 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Native bit-parallel Levenshtein distances of one term to many terms
+
+The kernel (levenshtein_kernel.c) is compiled with the C compiler of the system the first time
+it is needed, next to its source or, if that folder is not writable, in the temporary folder.
+The library name contains a hash of the source, so a changed source is compiled again.
+Without a C compiler, one_to_many_distances() returns None and the distances are computed
+term by term with python-Levenshtein instead.
+"""
+
+import os
+import sys
+import ctypes
+import hashlib
+import tempfile
+import subprocess
+import numpy as np
+
+
+KERNEL_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'levenshtein_kernel.c')
+
+COMPILER = os.environ.get('CC', 'cc')
+COMPILER_FLAGS = ['-O3', '-shared', '-fPIC']
+
+# the loaded kernel function, False if it could not be built
+_kernel = None
+
+
+def library_name():
+    with open(KERNEL_SOURCE, 'rb') as source:
+        source_hash = hashlib.sha1(source.read()).hexdigest()[:12]
+    return '_levenshtein_kernel_%s.so' % source_hash
+
+
+# compiles the kernel into the folder unless it is there already, returns the path of the library
+def build_kernel(folder):
+    library_path = os.path.join(folder, library_name())
+    if not os.path.exists(library_path):
+        # compiled under a temporary name, so that processes building it at the same time
+        # never load a partially written library
+        temporary_path = '%s.%d.tmp' % (library_path, os.getpid())
+        subprocess.run([COMPILER] + COMPILER_FLAGS + ['-o', temporary_path, KERNEL_SOURCE],
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.replace(temporary_path, library_path)
+    return library_path
+
+
+def load_kernel():
+    global _kernel
+    if _kernel is None:
+        _kernel = False
+        for folder in [os.path.dirname(KERNEL_SOURCE), tempfile.gettempdir()]:
+            try:
+                library = ctypes.CDLL(build_kernel(folder))
+            except (OSError, subprocess.CalledProcessError) as error:
+                last_error = error
+                continue
+            kernel = library.levenshtein_one_to_many
+            kernel.restype = ctypes.c_int
+            kernel.argtypes = [ctypes.c_void_p, ctypes.c_int64, ctypes.c_void_p, ctypes.c_void_p,
+                               ctypes.c_void_p, ctypes.c_int64, ctypes.c_void_p]
+            _kernel = kernel
+            break
+        else:
+            print('Levenshtein kernel not available (%s), using python-Levenshtein' % last_error,
+                  file=sys.stderr)
+    return _kernel or None
+
+
+# Levenshtein distances of the term query_id to the terms target_ids (int64 array),
+# with the code points of term i being code_points[offsets[i]:offsets[i + 1]],
+# None if the kernel is not available
+def one_to_many_distances(code_points, offsets, query_id, target_ids):
+    kernel = load_kernel()
+    if kernel is None:
+        return None
+
+    target_ids = np.ascontiguousarray(target_ids, dtype=np.int64)
+    query = np.ascontiguousarray(code_points[offsets[query_id]:offsets[query_id + 1]])
+    distances = np.empty(len(target_ids), dtype=np.int64)
+    if kernel(query.ctypes.data, len(query), code_points.ctypes.data, offsets.ctypes.data,
+              target_ids.ctypes.data, len(target_ids), distances.ctypes.data) != 0:
+        raise MemoryError('not enough memory for the Levenshtein kernel')
+    return distances
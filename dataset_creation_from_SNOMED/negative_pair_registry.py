@@ -0,0 +1,51 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Bookkeeping of negative pairs already created for other datasets"""
+
+from collections import namedtuple
+
+from dataset_creation_from_SNOMED.pair_store import PairSet
+
+
+# negative pairs are kept in a pair store (shared with the positive pairs), each negative dataset
+# with its own bit, and each group of datasets is the bitmask of its datasets, so that
+# the datasets to consider for a new dataset can be combined without copying any pairs
+SUBSTITUTION_LAYER = 'substitution'
+FSN_SYN_LAYER = 'FSN_SYN'
+SYN_SYN_LAYER = 'SYN_SYN'
+
+NegativePairRegistry = namedtuple('NegativePairRegistry', ['store', 'layer_masks'])
+
+
+def create_negative_pair_registry(pair_store):
+    return NegativePairRegistry(pair_store, {SUBSTITUTION_LAYER: 0, FSN_SYN_LAYER: 0, SYN_SYN_LAYER: 0})
+
+
+# a pair and its reverse share the same key
+def pair_key(label1, label2):
+    return (label1, label2) if label1 <= label2 else (label2, label1)
+
+
+def add_negative_pairs(registry, layer, dataset_name, pairs):
+    registry.layer_masks[layer] |= registry.store.add_pairs(dataset_name, pairs)
+
+
+# the negative pairs of the given layers, to be checked with is_in_pair_set()
+def negative_pairs_to_consider(registry, layers):
+    mask = 0
+    for layer in layers:
+        mask |= registry.layer_masks[layer]
+    return PairSet(registry.store, mask)
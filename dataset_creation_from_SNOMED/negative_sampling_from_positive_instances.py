@@ -17,35 +17,36 @@
 
 import random
 import os
-import statistics
 import csv
-import operator
-from collections import OrderedDict
 from tqdm import tqdm
-from Levenshtein import distance as levenshtein_distance
+import numpy as np
 import pandas as pd
 
-
-def is_existing_pair(existing_pairs, label1, label2):
-    return (not existing_pairs.loc[
-        (existing_pairs['source'] == label1) & (existing_pairs['target'] == label2)].empty or \
-    not existing_pairs.loc[
-        (existing_pairs['target'] == label1) & (existing_pairs['source'] == label2)].empty)
-
-
-# write some statistics about the negative instances (mean, max, min Levenshtein distance)
-def write_statistics_to_file(statistics_filename,
-                             distances,
-                             no_of_positive_instances,
-                             dataset_name):
-    with open(statistics_filename, 'a') as stats:
-        stats.write(dataset_name + "\n")
-        stats.write("Number of positive instances: " + str(no_of_positive_instances) + "\n")
-        stats.write("Mean Levenshtein Distance: " + str(statistics.mean(distances)) + "\n")
-        stats.write("Median Levenshtein Distance: " + str(statistics.median(distances)) + "\n")
-        stats.write("Max Levenshtein Distance: " + str(max(distances)) + "\n")
-        stats.write("Min Levenshtein Distance: " + str(min(distances)) + "\n")
-        stats.write("\n")
+from dataset_creation_from_SNOMED.background_writer import write_in_background
+from dataset_creation_from_SNOMED.background_writer import wait_for_writes
+from dataset_creation_from_SNOMED.dataset_statistics import write_dataset_statistics
+from dataset_creation_from_SNOMED.negative_pair_registry import SUBSTITUTION_LAYER
+from dataset_creation_from_SNOMED.negative_pair_registry import FSN_SYN_LAYER
+from dataset_creation_from_SNOMED.negative_pair_registry import SYN_SYN_LAYER
+from dataset_creation_from_SNOMED.negative_pair_registry import create_negative_pair_registry
+from dataset_creation_from_SNOMED.negative_pair_registry import add_negative_pairs
+from dataset_creation_from_SNOMED.negative_pair_registry import negative_pairs_to_consider
+from dataset_creation_from_SNOMED.negative_pair_registry import pair_key
+from dataset_creation_from_SNOMED.pair_store import PairStore
+from dataset_creation_from_SNOMED.pair_store import PairSet
+from dataset_creation_from_SNOMED.pair_store import is_in_pair_set
+from dataset_creation_from_SNOMED.term_features import create_term_features
+from dataset_creation_from_SNOMED.term_features import normalized_term
+from dataset_creation_from_SNOMED.term_features import levenshtein_distance_groups
+from dataset_creation_from_SNOMED.approximate_candidates import create_trigram_vectors
+from dataset_creation_from_SNOMED.approximate_candidates import top_k_similar_terms
+from dataset_creation_from_SNOMED.approximate_candidates import create_pair_graph
+from dataset_creation_from_SNOMED.approximate_candidates import excluded_terms
+from dataset_creation_from_SNOMED.approximate_candidates import is_usable_target
+from dataset_creation_from_SNOMED.approximate_candidates import all_usable_targets
+from dataset_creation_from_SNOMED.is_a_hierarchy import create_term_concept_entries
+from dataset_creation_from_SNOMED.is_a_hierarchy import hierarchy_neighbour_terms
+from dataset_creation_from_SNOMED import reference_engine
 
 
 ##################################################################
@@ -53,17 +54,18 @@ def write_statistics_to_file(statistics_filename,
 ##################################################################
 def create_random_pairs(positive_instances,
                         positive_pairs_all_datasets,
-                        existing_negatives):
+                        existing_negatives,
+                        term_features):
 
     random.seed(42)
-    # holds the Levenshtein distance of each concept pair
-    distances = []
-
     # tracks already created negative pairs as tuples, i.e. (l1,l2), to avoid duplicate creation
     new_negative_pairs = []
+    # the same pairs as keys shared with their reverse pairs, for constant time lookup
+    new_negative_keys = set()
 
     for i, row in tqdm(positive_instances.iterrows(), total=positive_instances.shape[0]):
         label1 = row['source']
+        label1_normalized = normalized_term(term_features, label1)
 
         # initialise random index
         random_index = i
@@ -71,10 +73,10 @@ def create_random_pairs(positive_instances,
         # make sure that no term pair duplicates or reverse duplicates are created
         # comparing to both positive and negative concept pairs
         while random_index == i or\
-            is_existing_pair(positive_pairs_all_datasets, label1, label2) or\
-            is_existing_pair(existing_negatives, label1, label2) or\
-            (label1, label2) in new_negative_pairs or (label2, label1) in new_negative_pairs\
-            or label1.lower() == label2.lower():
+            is_in_pair_set(positive_pairs_all_datasets, label1, label2) or\
+            is_in_pair_set(existing_negatives, label1, label2) or\
+            pair_key(label1, label2) in new_negative_keys\
+            or label1_normalized == normalized_term(term_features, label2):
 
             # choose a new random index and source vs target and get a new pairing term
 
@@ -82,10 +84,10 @@ def create_random_pairs(positive_instances,
             source_or_target = random.choice(['source', 'target'])
             label2 = positive_instances.loc[random_index][source_or_target]
 
-        distances.append(levenshtein_distance(label1.lower(), label2.lower()))
         new_negative_pairs.append((label1, label2))
+        new_negative_keys.add(pair_key(label1, label2))
 
-    return new_negative_pairs, distances
+    return new_negative_pairs
 
 
 
@@ -94,16 +96,22 @@ def create_random_pairs(positive_instances,
 # Levenshtein strategy for negative sampling
 ##################################################################
 
+# distance_groups: optional precomputed distance groups of the source terms (see precompute_distance_groups())
 def create_minimal_distance_pairs(positive_instances,
                                   positive_pairs_all_datasets,
-                                  existing_negatives):
+                                  existing_negatives,
+                                  term_features,
+                                  distance_groups=None):
     random.seed(42)
 
-    # holds the Levenshtein distance of each concept pair
-    distances = []
-
     # tracks already created negative pairs as tuples, i.e. (l1,l2), to avoid duplicate creation
     new_negative_pairs = []
+    # term ids of the sources of the already created negative pairs by target term id,
+    # to avoid reverse duplicates
+    new_negative_sources = {}
+
+    # the positive pairs as term ids, so that the possible targets are found without comparing labels
+    pair_graph = create_pair_graph(positive_instances, term_features)
 
     # find all instances of each source concept
     unique_source_concepts = positive_instances.groupby('source')
@@ -111,214 +119,539 @@ def create_minimal_distance_pairs(positive_instances,
     # for each concept, create a list of usable concepts that are not positive similarity instances
     # and choose the ones with smallest Levenshtein distance as a difficult negative sample
     for label1, group in tqdm(unique_source_concepts, total=unique_source_concepts.ngroups):
-
-        possible_targets = get_possible_targets(group, new_negative_pairs, positive_instances)
-        distances_possible_terms, possible_targets = \
-            get_levenshtein_possible_targets(possible_targets, label1)
+        term_id = term_features.index[label1]
 
         # find the N minimal distances (for N positive pairs of the concept)
-        # and the respective pairing concept with this minimal distance
-        sorted_targets_and_distances = \
-            [(label, d) for d, label in sorted(zip(distances_possible_terms, possible_targets),
-                                               key=operator.itemgetter(0))]
+        # and the respective pairing concept with this minimal distance,
+        # distances are only computed as far as needed
+        if distance_groups is None:
+            possible_targets = get_possible_targets(pair_graph,
+                                                    group.index.values,
+                                                    new_negative_sources.get(term_id, set()))
+            sorted_targets_and_distances = \
+                levenshtein_distance_groups(term_features, term_id, possible_targets)
+        else:
+            sorted_targets_and_distances = \
+                precomputed_distance_groups(term_features, pair_graph, group,
+                                            distance_groups[label1],
+                                            new_negative_sources.get(term_id, set()))
+
+        for label2 in choose_min_distance_targets(label1,
+                                                  len(group),
+                                                  sorted_targets_and_distances,
+                                                  positive_pairs_all_datasets,
+                                                  existing_negatives):
+            new_negative_pairs.append((label1, label2))
+            new_negative_sources.setdefault(term_features.index[label2], set()).add(term_id)
 
-        min_dist_tuples = []
-        for i in range(0, len(group)):
+    return new_negative_pairs
 
-            # get the smallest Levenshtein distance
-            if not min_dist_tuples:
-                min_dist_tuples, sorted_targets_and_distances = \
-                    get_min_distance_tuples(sorted_targets_and_distances)
 
-            # choose a random term with minimal distance
-            label2, distance = min_dist_tuples.pop(random.randint(0, len(min_dist_tuples)-1))
+# number of possible targets beyond the number of negative pairs of a source term
+# for which distance groups are precomputed, as some of them will be excluded
+PRECOMPUTED_EXTRA_TARGETS = 20
+
+
+# the first distance groups of the possible targets of the given source terms,
+# computed independently of the other source terms (e.g. on other machines)
+# as {source term: (list of (distance, list of targets), whether all groups are included)}
+# the targets excluded by negative pairs created before for other source terms are removed later
+def precompute_distance_groups(positive_instances, term_features, source_labels):
+    distance_groups = {}
+    groups_by_source = positive_instances.groupby('source')
+    pair_graph = create_pair_graph(positive_instances, term_features)
+
+    for label1 in tqdm(source_labels):
+        group = groups_by_source.get_group(label1)
+        possible_targets = get_possible_targets(pair_graph, group.index.values, set())
+
+        label1_groups = []
+        number_of_targets = 0
+        complete = True
+        for distance_group in levenshtein_distance_groups(term_features, term_features.index[label1],
+                                                          possible_targets):
+            label1_groups.append((distance_group[0][1], [label for label, _ in distance_group]))
+            number_of_targets += len(distance_group)
+            if number_of_targets >= len(group) + PRECOMPUTED_EXTRA_TARGETS:
+                complete = False
+                break
+        distance_groups[label1] = (label1_groups, complete)
+
+    return distance_groups
+
+
+# yields the same distance groups as levenshtein_distance_groups() on the possible targets,
+# starting with the precomputed groups and continuing with the exact search if they are used up
+def precomputed_distance_groups(term_features, pair_graph, group,
+                                label1_distance_groups, excluded_target_ids):
+    precomputed_groups, complete = label1_distance_groups
+
+    last_distance = 0
+    for distance, labels in precomputed_groups:
+        distance_group = [(label, distance) for label in labels
+                          if term_features.index[label] not in excluded_target_ids]
+        if distance_group:
+            yield distance_group
+        last_distance = distance
+
+    if complete:
+        return
+
+    possible_targets = get_possible_targets(pair_graph, group.index.values, excluded_target_ids)
+    term_id = pair_graph.sources[group.index.values[0]]
+    for distance_group in levenshtein_distance_groups(term_features, term_id, possible_targets):
+        if distance_group[0][1] > last_distance:
+            yield distance_group
+
+
+# choose N targets (for N positive pairs of the concept) with minimal distance,
+# picking randomly among targets with the same distance
+def choose_min_distance_targets(label1,
+                                number_of_pairs,
+                                sorted_targets_and_distances,
+                                positive_pairs_all_datasets,
+                                existing_negatives):
+    chosen_targets = []
 
-            while is_existing_pair(positive_pairs_all_datasets, label1, label2) or \
-            is_existing_pair(existing_negatives, label1, label2):
+    min_dist_tuples = []
+    for i in range(0, number_of_pairs):
 
-                if not min_dist_tuples:
-                    min_dist_tuples, sorted_targets_and_distances = \
-                        get_min_distance_tuples(sorted_targets_and_distances)
+        # get the smallest Levenshtein distance
+        if not min_dist_tuples:
+            min_dist_tuples, sorted_targets_and_distances = \
+                get_min_distance_tuples(sorted_targets_and_distances)
 
-                label2, distance = min_dist_tuples.pop(random.randint(0, len(min_dist_tuples) - 1))
+        # choose a random term with minimal distance
+        label2, _ = min_dist_tuples.pop(random.randint(0, len(min_dist_tuples)-1))
 
-            new_negative_pairs.append((label1, label2))
-            distances.append(distance)
+        while is_in_pair_set(positive_pairs_all_datasets, label1, label2) or \
+        is_in_pair_set(existing_negatives, label1, label2):
 
-    return new_negative_pairs, distances
+            if not min_dist_tuples:
+                min_dist_tuples, sorted_targets_and_distances = \
+                    get_min_distance_tuples(sorted_targets_and_distances)
 
+            label2, _ = min_dist_tuples.pop(random.randint(0, len(min_dist_tuples) - 1))
+
+        chosen_targets.append(label2)
+
+    return chosen_targets
 
-def get_min_distance_tuples(sorted_targets_and_distances):
-    min_dist_tuples = []
-    min_label, min_distance = sorted_targets_and_distances.pop(0)
-    min_dist_tuples.append((min_label, min_distance))
 
-    # find all terms with the same minimal dinstance
-    while sorted_targets_and_distances[0][1] == min_distance:
-        min_dist_tuples.append(sorted_targets_and_distances.pop(0))
+# get all terms with the next smallest distance
+def get_min_distance_tuples(sorted_targets_and_distances):
+    min_dist_tuples = next(sorted_targets_and_distances, None)
+    if min_dist_tuples is None:
+        raise Exception('No possible targets left to create a negative pair')
 
     return min_dist_tuples, sorted_targets_and_distances
 
 
-def get_possible_targets(group, new_negative_pairs, positive_instances):
+# term ids of the terms that can be paired with the source term of the given rows (the group of
+# the source term) of the positive pairs, in the order in which they occur in the remaining pairs,
+# all sources before the targets
+def get_possible_targets(pair_graph, rows, excluded_target_ids):
+    number_of_terms = len(pair_graph.indptr) - 1
 
     # exclude the similarity pairs of this concept from table to be used to create negative pair
-    usable_labels = positive_instances.drop(group.index)
+    usable_pairs = np.ones(len(pair_graph.sources), dtype=bool)
+    usable_pairs[rows] = False
 
     # all targets of the current concept are synonyms
     # that should not be paired with the current concept,
     # so is of course the current concept itself
-    synonyms = group['target'].tolist()
-    label1 = positive_instances.loc[group.index.tolist()[0], 'source']
-    synonyms.append(label1)
+    synonyms = np.zeros(number_of_terms, dtype=bool)
+    synonyms[pair_graph.targets[rows]] = True
+    synonyms[pair_graph.sources[rows[0]]] = True
 
     # find all concepts that are paired with the synonyms (as source or target)
-    concepts_to_exclude = \
-        usable_labels[usable_labels.target.isin(synonyms)]['source'].tolist()
-    concepts_to_exclude = \
-        concepts_to_exclude + usable_labels[usable_labels.source.isin(synonyms)]['target'].tolist()
+    concepts_to_exclude = np.zeros(number_of_terms, dtype=bool)
+    concepts_to_exclude[pair_graph.sources[usable_pairs & synonyms[pair_graph.targets]]] = True
+    concepts_to_exclude[pair_graph.targets[usable_pairs & synonyms[pair_graph.sources]]] = True
 
     # exclude all concept pairs containing a concept that's also paired with a synonym
-    usable_labels = usable_labels[
-        ~usable_labels.source.isin(concepts_to_exclude)]
-    usable_labels = usable_labels[~usable_labels.target.isin(concepts_to_exclude)]
+    usable_pairs &= ~concepts_to_exclude[pair_graph.sources] & ~concepts_to_exclude[pair_graph.targets]
 
     # the sources and targets of the remaining pairs can be paired with the current concept
-    usable_list = \
-        usable_labels['source'].unique().tolist() + usable_labels['target'].unique().tolist()
-    usable_list = list(OrderedDict.fromkeys(usable_list))
+    usable_list = pd.unique(np.concatenate([pair_graph.sources[usable_pairs],
+                                            pair_graph.targets[usable_pairs]]))
 
     # make sure no reverse duplicates are created,
     # i.e. if (X, lab1) already occurs in the negative instances,
     # exlude X - note that (lab1, X) won't occur in the neg samples
     # since same concepts are handled together
-    labels_from_existing_negative_instances = \
-        [lab for (lab, l) in new_negative_pairs if l == label1]
-    usable_list_final = \
-        [x for x in usable_list if x not in labels_from_existing_negative_instances]
+    if excluded_target_ids:
+        usable_list = usable_list[~np.isin(usable_list, list(excluded_target_ids))]
 
-    return usable_list_final
+    return usable_list
 
 
-# for each potential pairing of terms, compute their Levenshtein distance and store it in a list
-# record labels that have Levenshtein distance 0 (i.e. only the casing of the concepts is different)
-# to exlcude them later
-def get_levenshtein_possible_targets(possible_targets, label1):
+##################################################################
+# Approximate Levenshtein strategy for negative sampling
+##################################################################
 
-    distances_possible_terms = []
-    distance0 = []
+def create_approximate_minimal_distance_pairs(positive_instances,
+                                              positive_pairs_all_datasets,
+                                              existing_negatives,
+                                              term_features,
+                                              number_of_candidates,
+                                              recall_sample_size):
+    # find all instances of each source concept
+    unique_source_concepts = positive_instances.groupby('source')
 
-    for i, label2 in enumerate(possible_targets):
-        d = levenshtein_distance(label2.lower(), label1.lower())
-        if d == 0:
-            distance0.append(i)
-        else:
-            distances_possible_terms.append(d)
+    # retrieve the most similar terms of every source concept by character trigrams,
+    # only these candidates are ranked by their exact Levenshtein distance
+    pair_graph = create_pair_graph(positive_instances, term_features)
+    source_ids = np.array([term_features.index[label] for label in unique_source_concepts.groups],
+                          dtype=np.int64)
+    candidates = top_k_similar_terms(create_trigram_vectors(term_features),
+                                     source_ids,
+                                     number_of_candidates)
+
+    recall = approximate_recall(unique_source_concepts, term_features, pair_graph,
+                                candidates, recall_sample_size)
+    print("Recall of minimal Levenshtein distance (sample of %d source concepts): %s"
+          % (min(recall_sample_size, unique_source_concepts.ngroups), recall))
+
+    random.seed(42)
+
+    # tracks already created negative pairs as tuples, i.e. (l1,l2), to avoid duplicate creation
+    new_negative_pairs = []
+    # term ids of the sources of the already created negative pairs by target term id,
+    # to avoid reverse duplicates
+    new_negative_sources = {}
+
+    for label1, group in tqdm(unique_source_concepts, total=unique_source_concepts.ngroups):
+
+        term_id = term_features.index[label1]
+        excluded = excluded_terms(pair_graph, term_id,
+                                  [term_features.index[label] for label in group['target']])
+
+        sorted_targets_and_distances = \
+            get_approximate_distance_groups(term_features,
+                                            pair_graph,
+                                            term_id,
+                                            excluded,
+                                            new_negative_sources.get(term_id, set()),
+                                            candidates[term_id])
+
+        for label2 in choose_min_distance_targets(label1,
+                                                  len(group),
+                                                  sorted_targets_and_distances,
+                                                  positive_pairs_all_datasets,
+                                                  existing_negatives):
+            new_negative_pairs.append((label1, label2))
+            new_negative_sources.setdefault(term_features.index[label2], set()).add(term_id)
+
+    return new_negative_pairs, recall
+
+
+# yields the usable retrieved candidates grouped by Levenshtein distance in increasing order,
+# followed by all other usable targets in case the candidates are used up
+def get_approximate_distance_groups(term_features,
+                                    pair_graph,
+                                    term_id,
+                                    excluded,
+                                    excluded_target_ids,
+                                    candidate_ids):
+
+    possible_targets = np.array([candidate_id for candidate_id in candidate_ids.tolist()
+                                 if is_usable_target(pair_graph, candidate_id, excluded)
+                                 and candidate_id not in excluded_target_ids], dtype=np.int64)
+    yield from levenshtein_distance_groups(term_features, term_id, possible_targets)
+
+    remaining_targets = all_usable_targets(pair_graph, excluded)
+    remaining_targets = remaining_targets[~np.isin(remaining_targets, possible_targets) &
+                                          ~np.isin(remaining_targets, list(excluded_target_ids))]
+    yield from levenshtein_distance_groups(term_features, term_id, remaining_targets)
 
-    new_possible_targets = [x for i, x in enumerate(possible_targets) if i not in distance0]
 
-    return distances_possible_terms, new_possible_targets
+# share of sampled source concepts for which the retrieved candidates contain a target
+# with the same minimal Levenshtein distance as the exact search over all usable targets
+def approximate_recall(unique_source_concepts, term_features, pair_graph, candidates, sample_size):
+    sample = random.Random(42).sample(list(unique_source_concepts.groups),
+                                      min(sample_size, unique_source_concepts.ngroups))
+    if not sample:
+        return None
 
+    found = 0
+    for label1 in sample:
+        term_id = term_features.index[label1]
+        excluded = excluded_terms(pair_graph, term_id,
+                                  [term_features.index[label]
+                                   for label in unique_source_concepts.get_group(label1)['target']])
 
+        exact_targets = all_usable_targets(pair_graph, excluded)
+        approximate_targets = [candidate_id for candidate_id in candidates[term_id].tolist()
+                               if is_usable_target(pair_graph, candidate_id, excluded)]
+
+        exact_groups = levenshtein_distance_groups(term_features, term_id, exact_targets)
+        approximate_groups = levenshtein_distance_groups(term_features, term_id, approximate_targets)
+        exact_min = next(exact_groups, [(None, None)])[0][1]
+        approximate_min = next(approximate_groups, [(None, None)])[0][1]
+
+        if exact_min is None or exact_min == approximate_min:
+            found += 1
+
+    return found / len(sample)
+
+
+##################################################################
+# Hierarchy-aware Levenshtein strategies for negative sampling
 ##################################################################
 
-def negative_sampling(strategy,
-                      full_new_dataset_path,
-                      positive_instances,
-                      statistics_path,
-                      positive_pairs_all_datasets,
-                      existing_negatives):
+# like the Levenshtein strategy, but terms of concepts that are ancestors or descendants
+# of a concept of the source term are either excluded (target_neighbours=False) or
+# preferred as negative pairs (target_neighbours=True)
+def create_hierarchy_minimal_distance_pairs(positive_instances,
+                                            positive_pairs_all_datasets,
+                                            existing_negatives,
+                                            term_features,
+                                            hierarchy,
+                                            target_neighbours):
+    random.seed(42)
 
-    # create negative instances according to chosen strategy
-    if strategy == 'simple':
-        new_negative_pairs, distances =\
-            create_random_pairs(positive_instances, positive_pairs_all_datasets, existing_negatives)
+    # tracks already created negative pairs as tuples, i.e. (l1,l2), to avoid duplicate creation
+    new_negative_pairs = []
+    # term ids of the sources of the already created negative pairs by target term id,
+    # to avoid reverse duplicates
+    new_negative_sources = {}
 
-    elif strategy == 'advanced':
-        new_negative_pairs, distances = \
-            create_minimal_distance_pairs(positive_instances,
-                                          positive_pairs_all_datasets,
-                                          existing_negatives)
-    else:
-        raise Exception('Unknown negative sampling strategy chosen!')
+    # source terms for which not enough of the preferred targets were left
+    fallback_sources = set()
+
+    term_concept_entries = create_term_concept_entries(hierarchy, term_features)
+    pair_graph = create_pair_graph(positive_instances, term_features)
+
+    # find all instances of each source concept
+    unique_source_concepts = positive_instances.groupby('source')
+
+    for label1, group in tqdm(unique_source_concepts, total=unique_source_concepts.ngroups):
+        term_id = term_features.index[label1]
+
+        possible_targets = get_possible_targets(pair_graph,
+                                                group.index.values,
+                                                new_negative_sources.get(term_id, set()))
+
+        neighbour_terms = hierarchy_neighbour_terms(hierarchy,
+                                                    term_concept_entries,
+                                                    label1,
+                                                    possible_targets)
+        neighbours = possible_targets[neighbour_terms]
+        others = possible_targets[~neighbour_terms]
+
+        # the other kind of terms is only used if there are not enough of the preferred ones,
+        # e.g. if the concept of the source term is an ancestor or descendant of all other concepts
+        if target_neighbours:
+            preferred_targets, fallback_targets = neighbours, others
+        else:
+            preferred_targets, fallback_targets = others, neighbours
+        sorted_targets_and_distances = \
+            fallback_distance_groups(levenshtein_distance_groups(term_features, term_id, preferred_targets),
+                                     levenshtein_distance_groups(term_features, term_id, fallback_targets),
+                                     fallback_sources,
+                                     label1)
+
+        for label2 in choose_min_distance_targets(label1,
+                                                  len(group),
+                                                  sorted_targets_and_distances,
+                                                  positive_pairs_all_datasets,
+                                                  existing_negatives):
+            new_negative_pairs.append((label1, label2))
+            new_negative_sources.setdefault(term_features.index[label2], set()).add(term_id)
+
+    return new_negative_pairs, len(fallback_sources)
+
+
+# yields the preferred distance groups followed by the fallback groups,
+# the source term is recorded if the fallback groups are used
+def fallback_distance_groups(preferred_groups, fallback_groups, fallback_sources, label1):
+    yield from preferred_groups
+    fallback_sources.add(label1)
+    yield from fallback_groups
+
+
+##################################################################
+
+def write_dataset_with_negatives(file_name, positive_instances, new_negative_pairs, random_state):
 
     # positive instances
-    positive_pairs_with_scores = []
-    for i, row in positive_instances.iterrows():
-        positive_pairs_with_scores.append(row['source'] + "\t" + row['target'] + "\t1\n")
+    positive_pairs_with_scores = \
+        (positive_instances['source'] + "\t" + positive_instances['target'] + "\t1\n").tolist()
 
     # negative instances
     new_negative_pairs_with_scores = \
         [label1 + "\t" + label2 + "\t0\n" for (label1, label2) in new_negative_pairs]
 
     new_dataset_with_scores = positive_pairs_with_scores + new_negative_pairs_with_scores
-    random.shuffle(new_dataset_with_scores)
+    shuffle_random = random.Random()
+    shuffle_random.setstate(random_state)
+    shuffle_random.shuffle(new_dataset_with_scores)
 
     # save newly created dataset
-    with open(full_new_dataset_path + '_' + strategy + '.txt', "w") as output:
+    with open(file_name, "w") as output:
         output.writelines(new_dataset_with_scores)
 
-    # save statistics about new negative instances
-    write_statistics_to_file(statistics_path + '_' + strategy + '.txt',
-                             distances, positive_instances.shape[0],
-                             full_new_dataset_path + '_' + strategy)
 
-    return new_negative_pairs
+# returns the new negative pairs and the statistics reported by the strategy
+def negative_sampling(strategy,
+                      full_new_dataset_path,
+                      positive_instances,
+                      positive_pairs_all_datasets,
+                      existing_negatives,
+                      writer=None,
+                      approx_candidates=50,
+                      approx_recall_sample=100,
+                      hierarchy=None,
+                      distance_groups=None,
+                      engine=reference_engine.FAST_ENGINE):
+
+    # lowercased terms and distance features of the dataset vocabulary, computed once
+    term_features = create_term_features(pd.concat([positive_instances['source'],
+                                                    positive_instances['target']]))
+
+    # statistics only reported by some strategies (see dataset_statistics for all others)
+    sampling_statistics = {}
+
+    # create negative instances according to chosen strategy
+    # the reference engine uses the implementations the published datasets were created with
+    if strategy == 'simple' and engine == reference_engine.REFERENCE_ENGINE:
+        new_negative_pairs, _ = \
+            reference_engine.create_random_pairs(positive_instances,
+                                                 positive_pairs_all_datasets,
+                                                 existing_negatives)
+
+    elif strategy == 'advanced' and engine == reference_engine.REFERENCE_ENGINE:
+        new_negative_pairs, _ = \
+            reference_engine.create_minimal_distance_pairs(positive_instances,
+                                                           positive_pairs_all_datasets,
+                                                           existing_negatives)
+
+    elif strategy == 'simple':
+        new_negative_pairs =\
+            create_random_pairs(positive_instances, positive_pairs_all_datasets,
+                                existing_negatives, term_features)
+
+    elif strategy == 'advanced':
+        new_negative_pairs = \
+            create_minimal_distance_pairs(positive_instances,
+                                          positive_pairs_all_datasets,
+                                          existing_negatives,
+                                          term_features,
+                                          distance_groups)
+
+    elif strategy == 'approx_advanced':
+        new_negative_pairs, recall = \
+            create_approximate_minimal_distance_pairs(positive_instances,
+                                                      positive_pairs_all_datasets,
+                                                      existing_negatives,
+                                                      term_features,
+                                                      approx_candidates,
+                                                      approx_recall_sample)
+        sampling_statistics['min_distance_recall'] = recall
+
+    elif strategy in ('advanced_without_hierarchy', 'advanced_hierarchy_neighbours'):
+        if hierarchy is None:
+            raise Exception('The is-a hierarchy is required for strategy %s' % strategy)
+        new_negative_pairs, sampling_statistics['hierarchy_fallback_sources'] = \
+            create_hierarchy_minimal_distance_pairs(positive_instances,
+                                                    positive_pairs_all_datasets,
+                                                    existing_negatives,
+                                                    term_features,
+                                                    hierarchy,
+                                                    strategy == 'advanced_hierarchy_neighbours')
+    else:
+        raise Exception('Unknown negative sampling strategy chosen!')
 
+    # the dataset is shuffled with the current random state, but in the background writer,
+    # so that sampling for the next dataset can start right away
+    write_in_background(writer, write_dataset_with_negatives,
+                        full_new_dataset_path + '_' + strategy + '.txt',
+                        positive_instances, new_negative_pairs, random.getstate())
 
-def read_existing_positive_instances(positive_instance_datasets, dataset_path):
+    return new_negative_pairs, sampling_statistics
 
-    # get all positive instances
-    li = []
+
+# adds the pairs of all positive instance datasets to the pair store, each dataset with its own bit,
+# returns the set of all positive pairs
+def read_existing_positive_instances(positive_instance_datasets, dataset_path, pair_store):
+    mask = 0
     for f in positive_instance_datasets:
-        # all positive instances in the FSN_SYN datasets are also in the SYN_SYN datasets,
-        # so no need to load them
-        if "FSN_SYN" in f or f.startswith('._'):
+        if f.startswith('._'):
             continue
-        df = pd.read_csv(os.path.join(dataset_path, f), sep="\t",
-                         quoting=csv.QUOTE_NONE, keep_default_na=False,
-                         header=0, names=['source', 'target'])
-        li.append(df)
-    return pd.concat(li, axis=0, ignore_index=True)
+        df = read_positive_instances(dataset_path, f)
+        mask |= pair_store.add_pairs(f, zip(df['source'].values, df['target'].values))
+    return PairSet(pair_store, mask)
+
+
+# ORDER MATTERS!
+POSITIVE_INSTANCE_DATASETS = [
+    'possibly_equivalent_to_easy_distance5.tsv',
+    'possibly_equivalent_to_hard_distance5.tsv',
+    'replaced_by_easy_distance5.tsv',
+    'replaced_by_hard_distance5.tsv',
+    'same_as_easy_distance5.tsv',
+    'same_as_hard_distance5.tsv',
+    'resolved_substitutions_easy_distance5.tsv',
+    'resolved_substitutions_hard_distance5.tsv',
+    'FSN_SYN_easy_distance5.tsv',
+    'FSN_SYN_hard_distance5.tsv',
+    'SYN_SYN_easy_distance5.tsv',
+    'SYN_SYN_hard_distance5.tsv'
+]
+
+
+# the datasets of positive instances to create negative instances for, in order
+# (datasets for other languages only contain the positive instances from labels)
+def get_positive_instance_datasets(dataset_path):
+    return [f for f in POSITIVE_INSTANCE_DATASETS if os.path.exists(os.path.join(dataset_path, f))]
+
+
+def read_positive_instances(dataset_path, positive_dataset):
+    return pd.read_csv(os.path.join(dataset_path, positive_dataset),
+                       sep="\t",
+                       quoting=csv.QUOTE_NONE,
+                       keep_default_na=False,
+                       header=0,
+                       names=['source', 'target'])
 
 
 ##################################################################
 # MAIN
 ##################################################################
 
-def negative_instances(dataset_path, strategies):
-
-    # path to save statistics
-    statistics_path = dataset_path + "negative_sampling_statistics"
-
-    # ORDER MATTERS!
-    positive_instance_datasets = [
-        'possibly_equivalent_to_easy_distance5.tsv',
-        'possibly_equivalent_to_hard_distance5.tsv',
-        'replaced_by_easy_distance5.tsv',
-        'replaced_by_hard_distance5.tsv',
-        'same_as_easy_distance5.tsv',
-        'same_as_hard_distance5.tsv',
-        'FSN_SYN_easy_distance5.tsv',
-        'FSN_SYN_hard_distance5.tsv',
-        'SYN_SYN_easy_distance5.tsv',
-        'SYN_SYN_hard_distance5.tsv'
-    ]
+# load_distance_groups: optional function returning the precomputed distance groups
+# of a dataset for the advanced strategy (see precompute_distance_groups())
+def negative_instances(dataset_path,
+                       strategies,
+                       writer=None,
+                       approx_candidates=50,
+                       approx_recall_sample=100,
+                       hierarchy=None,
+                       load_distance_groups=None,
+                       engine=reference_engine.FAST_ENGINE):
+
+    # positive instances may still be being written in the background
+    wait_for_writes(writer)
+
+    positive_instance_datasets = get_positive_instance_datasets(dataset_path)
 
+    # all positive and negative pairs are kept once, with the datasets they belong to
+    pair_store = PairStore()
     positive_pairs_all_datasets = read_existing_positive_instances(positive_instance_datasets,
-                                                                   dataset_path)
+                                                                   dataset_path,
+                                                                   pair_store)
+
+    # statistics reported by the strategies for each created dataset
+    sampling_statistics = {}
 
     # consider the random and advanced strategy separately
     # as negative instances are considered separately
     for strategy in strategies:
 
-        # dataframes to keep track of already created negative instances (to prevent duplicates)
-        existing_negatives_to_consider = \
-            pd.DataFrame(columns=['source', 'target', 'trueScore'])
-        existing_negatives_from_substitution = \
-            pd.DataFrame(columns=['source', 'target', 'trueScore'])
-        existing_negatives_SYN_SYN = \
-            pd.DataFrame(columns=['source', 'target', 'trueScore'])
+        # keeps track of already created negative instances (to prevent duplicates)
+        negative_pair_registry = create_negative_pair_registry(pair_store)
+        existing_negatives_to_consider = negative_pairs_to_consider(negative_pair_registry, [])
 
         for positive_dataset in positive_instance_datasets:
 
@@ -326,49 +659,55 @@ def negative_instances(dataset_path, strategies):
             new_dataset_name = dataset_path + positive_dataset.rsplit(".", 1)[0] + "_with_neg"
 
             # read the positive instances into a dataframe
-            positive_instances = pd.read_csv(os.path.join(dataset_path, positive_dataset),
-                                             sep="\t",
-                                             quoting=csv.QUOTE_NONE,
-                                             keep_default_na=False,
-                                             header=0,
-                                             names=['source', 'target'])
+            positive_instances = read_positive_instances(dataset_path, positive_dataset)
 
-            # create negative instances for this dataset
-            new_negative_pairs = negative_sampling(strategy,
-                                                   new_dataset_name,
-                                                   positive_instances,
-                                                   statistics_path,
-                                                   positive_pairs_all_datasets,
-                                                   existing_negatives_to_consider)
+            # distance groups of the advanced strategy may have been precomputed
+            distance_groups = None
+            if strategy == 'advanced' and load_distance_groups is not None:
+                distance_groups = load_distance_groups(positive_dataset)
 
-            # turn these negative instances into a dataframe
-            new_negatives = pd.DataFrame(new_negative_pairs, columns=['source', 'target'])
-            new_negatives['trueScore'] = 0
+            # create negative instances for this dataset
+            negative_dataset_name = os.path.basename(new_dataset_name) + '_' + strategy
+            new_negative_pairs, sampling_statistics[negative_dataset_name] = \
+                negative_sampling(strategy,
+                                  new_dataset_name,
+                                  positive_instances,
+                                  positive_pairs_all_datasets,
+                                  existing_negatives_to_consider,
+                                  writer,
+                                  approx_candidates,
+                                  approx_recall_sample,
+                                  hierarchy,
+                                  distance_groups,
+                                  engine)
 
             # substitution datasets are processed first,
             # so existing negative pairs are only those constructed
             # in the other substitution datasets
             if not 'SYN' in positive_dataset:
-                existing_negatives_from_substitution = \
-                    pd.concat([existing_negatives_from_substitution, new_negatives],
-                              axis=0, ignore_index=True)
-                existing_negatives_to_consider = existing_negatives_from_substitution
+                add_negative_pairs(negative_pair_registry, SUBSTITUTION_LAYER, negative_dataset_name, new_negative_pairs)
+                existing_negatives_to_consider = \
+                    negative_pairs_to_consider(negative_pair_registry, [SUBSTITUTION_LAYER])
 
             # FSN_SYN are processed second,
             # existing negative pairs are from substitutions plus FSN_SYN so far
             elif 'FSN_SYN' in positive_dataset:
+                add_negative_pairs(negative_pair_registry, FSN_SYN_LAYER, negative_dataset_name, new_negative_pairs)
                 existing_negatives_to_consider = \
-                    pd.concat([existing_negatives_to_consider, new_negatives],
-                              axis=0, ignore_index=True)
+                    negative_pairs_to_consider(negative_pair_registry,
+                                               [SUBSTITUTION_LAYER, FSN_SYN_LAYER])
 
             # all datasets are processed third, here prefToAlt negatives are not considered,
             # so only deletion and negatives in all datasets so far
             elif 'SYN_SYN' in positive_dataset:
-                existing_negatives_SYN_SYN = pd.concat([existing_negatives_SYN_SYN, new_negatives],
-                                                       axis=0, ignore_index=True)
+                add_negative_pairs(negative_pair_registry, SYN_SYN_LAYER, negative_dataset_name, new_negative_pairs)
                 existing_negatives_to_consider = \
-                    pd.concat([existing_negatives_from_substitution, existing_negatives_SYN_SYN],
-                              axis=0, ignore_index=True)
+                    negative_pairs_to_consider(negative_pair_registry,
+                                               [SUBSTITUTION_LAYER, SYN_SYN_LAYER])
 
             else:
                 raise Exception('unknown dataset %s' % positive_dataset)
+
+    # statistics of all datasets, once they are written
+    wait_for_writes(writer)
+    write_dataset_statistics(dataset_path, sampling_statistics)
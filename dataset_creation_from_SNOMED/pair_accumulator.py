@@ -0,0 +1,79 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Columnar collection of term pairs without duplicates"""
+
+import numpy as np
+import pandas as pd
+
+
+# number of pairs per block of the pair columns
+BLOCK_SIZE = 65536
+
+
+# collects term pairs as term ids in int32 columns that grow block by block (no reallocation),
+# a pair is only added if neither the pair nor its reverse has been added before,
+# so the first occurrence of each pair is kept
+class PairAccumulator:
+
+    def __init__(self, column_names, block_size=BLOCK_SIZE):
+        self.column_names = tuple(column_names)
+        self._block_size = block_size
+        self._terms = []
+        self._term_ids = {}
+        self._pair_keys = set()
+        self._blocks = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _term_id(self, term):
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = len(self._terms)
+            self._term_ids[term] = term_id
+            self._terms.append(term)
+        return term_id
+
+    # adds the pair (term1, term2) as (first column, second column), returns if it was added
+    def add(self, term1, term2):
+        term_id1 = self._term_id(term1)
+        term_id2 = self._term_id(term2)
+
+        # a pair and its reverse share the same key
+        key = (min(term_id1, term_id2) << 32) | max(term_id1, term_id2)
+        if key in self._pair_keys:
+            return False
+        self._pair_keys.add(key)
+
+        position = self._size % self._block_size
+        if position == 0:
+            self._blocks.append(np.empty((self._block_size, 2), dtype=np.int32))
+        self._blocks[-1][position] = (term_id1, term_id2)
+        self._size += 1
+        return True
+
+    # the pair columns as term ids, in the order in which the pairs were added
+    def term_id_columns(self):
+        if not self._blocks:
+            return np.empty((0, 2), dtype=np.int32)
+        return np.concatenate(self._blocks)[:self._size]
+
+    def to_dataframe(self):
+        terms = np.array(self._terms, dtype=object)
+        columns = self.term_id_columns()
+        return pd.DataFrame({name: terms[columns[:, i]] for i, name in enumerate(self.column_names)},
+                            columns=list(self.column_names))
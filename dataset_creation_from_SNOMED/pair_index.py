@@ -0,0 +1,282 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Persisted index for looking up term pairs of the created datasets
+
+Build the index from the output folder of create_datasets.py and serve it locally:
+    python3 pair_index.py build --dataset_path SNOMED_datasets/ --index_path SNOMED_pair_index/
+    python3 pair_index.py serve --index_path SNOMED_pair_index/ --port 8080
+
+Queries (all terms are URL encoded):
+    /pair?term1=...&term2=...       datasets with the pair as positive and as negative instance
+    /neighbours?term=...&kind=...   all terms forming a positive (or negative) pair with the term
+"""
+
+import argparse
+import csv
+import glob
+import json
+import mmap
+import os
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+
+
+INDEX_METADATA_FILE = "index.json"
+TERMS_FILE = "terms.bin"
+
+POSITIVE = 'positive'
+NEGATIVE = 'negative'
+
+# datasets: names of the indexed datasets, bit i % 64 of word i // 64 of the pair flags stands for datasets[i]
+# term_offsets, terms: UTF-8 encoded terms sorted by their encoding, concatenated,
+#                      term i is terms[term_offsets[i]:term_offsets[i + 1]]
+# adjacency: for POSITIVE and NEGATIVE pairs (indptr, neighbours, flags) in CSR form,
+#            with the sorted neighbours of each term and the datasets of each pair
+#            (flags: one row of flag_words(len(datasets)) uint64 words per pair)
+PairIndex = namedtuple('PairIndex', ['datasets', 'term_offsets', 'terms', 'adjacency'])
+
+
+def read_dataset_pairs(file_name):
+    # datasets of positive instances have a header and no scores,
+    # datasets with negative instances have no header and a score column
+    if file_name.endswith('.tsv'):
+        pairs = pd.read_csv(file_name, sep="\t", quoting=csv.QUOTE_NONE, keep_default_na=False,
+                            header=0, names=['source', 'target'])
+        pairs['trueScore'] = 1
+    else:
+        pairs = pd.read_csv(file_name, sep="\t", quoting=csv.QUOTE_NONE, keep_default_na=False,
+                            header=None, names=['source', 'target', 'trueScore'])
+    return pairs
+
+
+# number of 64 bit words needed for the flags of the given number of datasets
+def flag_words(number_of_datasets):
+    return max(1, (number_of_datasets + 63) // 64)
+
+
+def create_adjacency(sources, targets, flags, number_of_terms):
+    # pairs are stored in both directions, the flags of the same pair from different datasets are merged
+    ends = np.concatenate([sources, targets])
+    neighbours = np.concatenate([targets, sources])
+    flags = np.concatenate([flags, flags])
+
+    keys = ends * number_of_terms + neighbours
+    order = np.argsort(keys, kind='mergesort')
+    keys, flags = keys[order], flags[order]
+
+    first_of_key = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) else \
+        np.empty(0, dtype=np.int64)
+    merged_flags = np.bitwise_or.reduceat(flags, first_of_key, axis=0) if len(keys) else flags
+    unique_keys = keys[first_of_key]
+
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(unique_keys // number_of_terms,
+                                                        minlength=number_of_terms))])
+    return indptr, unique_keys % number_of_terms, merged_flags
+
+
+def build_pair_index(dataset_path, index_path):
+    dataset_files = sorted(glob.glob(os.path.join(dataset_path, '*.tsv')) +
+                           glob.glob(os.path.join(dataset_path, '*_with_neg_*.txt')))
+    if not dataset_files:
+        raise Exception('No datasets found in %s' % dataset_path)
+
+    datasets = []
+    all_pairs = []
+    for i, file_name in enumerate(dataset_files):
+        datasets.append(os.path.basename(file_name).rsplit(".", 1)[0])
+        pairs = read_dataset_pairs(file_name)
+        pairs['dataset'] = i
+        all_pairs.append(pairs)
+    all_pairs = pd.concat(all_pairs, axis=0, ignore_index=True)
+
+    # term dictionary, sorted by the UTF-8 encoding so that terms can be found by binary search
+    encoded_terms = sorted({term.encode('utf-8') for term in
+                            pd.concat([all_pairs['source'], all_pairs['target']]).unique()})
+    term_ids = {term.decode('utf-8'): i for i, term in enumerate(encoded_terms)}
+    term_offsets = np.concatenate([[0], np.cumsum([len(term) for term in encoded_terms])]).astype(np.int64)
+
+    if not os.path.isdir(index_path):
+        os.mkdir(index_path)
+    with open(os.path.join(index_path, TERMS_FILE), 'wb') as terms_file:
+        terms_file.writelines(encoded_terms)
+    np.save(os.path.join(index_path, 'term_offsets.npy'), term_offsets)
+
+    sources = all_pairs['source'].map(term_ids).values.astype(np.int64)
+    targets = all_pairs['target'].map(term_ids).values.astype(np.int64)
+    dataset_ids = all_pairs['dataset'].values
+    flags = np.zeros((len(all_pairs), flag_words(len(datasets))), dtype=np.uint64)
+    flags[np.arange(len(all_pairs)), dataset_ids // 64] = np.uint64(1) << (dataset_ids % 64).astype(np.uint64)
+    for kind, score in [(POSITIVE, 1), (NEGATIVE, 0)]:
+        selected = all_pairs['trueScore'].values == score
+        indptr, neighbours, pair_flags = create_adjacency(sources[selected], targets[selected],
+                                                          flags[selected], len(encoded_terms))
+        np.save(os.path.join(index_path, kind + '_indptr.npy'), indptr)
+        np.save(os.path.join(index_path, kind + '_neighbours.npy'), neighbours)
+        np.save(os.path.join(index_path, kind + '_flags.npy'), pair_flags)
+
+    with open(os.path.join(index_path, INDEX_METADATA_FILE), 'w') as metadata:
+        json.dump({'datasets': datasets, 'number_of_terms': len(encoded_terms)}, metadata, indent=2)
+
+
+# the arrays are memory-mapped, so opening the index does not read it
+# (plain array views of the maps are kept, scalar lookups on np.memmap objects are much slower)
+def load_array(file_name):
+    return np.asarray(np.load(file_name, mmap_mode='r'))
+
+
+def open_pair_index(index_path):
+    with open(os.path.join(index_path, INDEX_METADATA_FILE)) as metadata:
+        datasets = json.load(metadata)['datasets']
+
+    with open(os.path.join(index_path, TERMS_FILE), 'rb') as terms_file:
+        terms = mmap.mmap(terms_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(terms_file.name) else b''
+
+    adjacency = {kind: tuple(load_array(os.path.join(index_path, kind + '_' + name + '.npy'))
+                             for name in ['indptr', 'neighbours', 'flags'])
+                 for kind in [POSITIVE, NEGATIVE]}
+
+    return PairIndex(datasets, load_array(os.path.join(index_path, 'term_offsets.npy')), terms, adjacency)
+
+
+def get_term(pair_index, term_id):
+    return pair_index.terms[pair_index.term_offsets[term_id]:pair_index.term_offsets[term_id + 1]]\
+        .decode('utf-8')
+
+
+# binary search in the sorted terms, returns None for unknown terms
+def get_term_id(pair_index, term):
+    encoded_term = term.encode('utf-8')
+    low, high = 0, len(pair_index.term_offsets) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if pair_index.terms[pair_index.term_offsets[middle]:pair_index.term_offsets[middle + 1]] \
+                < encoded_term:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(pair_index.term_offsets) - 1 and \
+            pair_index.terms[pair_index.term_offsets[low]:pair_index.term_offsets[low + 1]] == encoded_term:
+        return low
+    return None
+
+
+def flags_to_datasets(pair_index, flags):
+    return [dataset for i, dataset in enumerate(pair_index.datasets) if int(flags[i // 64]) >> (i % 64) & 1]
+
+
+# names of the datasets in which (term1, term2) or (term2, term1) is a pair of the given kind
+def find_pair(pair_index, term1, term2, kind=POSITIVE):
+    term_id1 = get_term_id(pair_index, term1)
+    term_id2 = get_term_id(pair_index, term2)
+    if term_id1 is None or term_id2 is None:
+        return []
+
+    indptr, neighbours, flags = pair_index.adjacency[kind]
+    start, end = indptr[term_id1], indptr[term_id1 + 1]
+    position = start + np.searchsorted(neighbours[start:end], term_id2)
+    if position < end and neighbours[position] == term_id2:
+        return flags_to_datasets(pair_index, flags[position])
+    return []
+
+
+def is_positive_pair(pair_index, term1, term2):
+    return bool(find_pair(pair_index, term1, term2, POSITIVE))
+
+
+def is_negative_pair(pair_index, term1, term2):
+    return bool(find_pair(pair_index, term1, term2, NEGATIVE))
+
+
+# all terms forming a pair of the given kind with the term, with the datasets of each pair
+def find_neighbours(pair_index, term, kind=POSITIVE):
+    term_id = get_term_id(pair_index, term)
+    if term_id is None:
+        return []
+
+    indptr, neighbours, flags = pair_index.adjacency[kind]
+    start, end = indptr[term_id], indptr[term_id + 1]
+    return [(get_term(pair_index, neighbour), flags_to_datasets(pair_index, neighbour_flags))
+            for neighbour, neighbour_flags in zip(neighbours[start:end].tolist(), flags[start:end].tolist())]
+
+
+##################################################################
+# Local HTTP server
+##################################################################
+
+def create_request_handler(pair_index):
+
+    class PairIndexRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == '/pair':
+                    response = {kind: find_pair(pair_index, query['term1'], query['term2'], kind)
+                                for kind in [POSITIVE, NEGATIVE]}
+                elif url.path == '/neighbours':
+                    response = [{'term': term, 'datasets': datasets} for term, datasets in
+                                find_neighbours(pair_index, query['term'], query.get('kind', POSITIVE))]
+                else:
+                    self.send_error(404, 'Unknown query %s' % url.path)
+                    return
+            except KeyError as e:
+                self.send_error(400, 'Missing or invalid parameter %s' % e)
+                return
+
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return PairIndexRequestHandler
+
+
+def serve_pair_index(index_path, host, port):
+    server = ThreadingHTTPServer((host, port), create_request_handler(open_pair_index(index_path)))
+    print('Serving pair index %s on http://%s:%d' % (index_path, host, port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index of the term pairs of the created datasets')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build the index from the created datasets')
+    build_parser.add_argument("--dataset_path", type=str, default="SNOMED_datasets/",
+                              help="Path to folder containing the created datasets")
+    build_parser.add_argument("--index_path", type=str, default="SNOMED_pair_index/",
+                              help="Path to output folder for the index")
+
+    serve_parser = subparsers.add_parser('serve', help='Serve the index over HTTP')
+    serve_parser.add_argument("--index_path", type=str, default="SNOMED_pair_index/",
+                              help="Path to folder containing the index")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1",
+                              help="Host to serve the index on")
+    serve_parser.add_argument("--port", type=int, default=8080,
+                              help="Port to serve the index on")
+
+    params = parser.parse_args()
+    if params.command == 'build':
+        build_pair_index(params.dataset_path, params.index_path)
+    else:
+        serve_pair_index(params.index_path, params.host, params.port)
@@ -0,0 +1,91 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Canonical table of term pairs with the datasets each pair belongs to"""
+
+from collections import namedtuple
+import pandas as pd
+
+
+# the pairs of the datasets whose bits are set in mask
+PairSet = namedtuple('PairSet', ['store', 'mask'])
+
+
+# each distinct pair (in either order) is stored once, keyed by the ids of its terms,
+# together with a bitmask of the datasets containing it (one bit per dataset name),
+# so checking if a pair is in any of several datasets is a single lookup and bit test
+class PairStore:
+
+    def __init__(self):
+        self._terms = []
+        self._term_ids = {}
+        self._memberships = {}
+        self._dataset_bits = {}
+        self.datasets = []
+
+    def _term_id(self, term):
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = len(self._terms)
+            self._term_ids[term] = term_id
+            self._terms.append(term)
+        return term_id
+
+    # a pair and its reverse share the same key, None if a term is not in the store
+    def _pair_key(self, term1, term2):
+        term_id1 = self._term_ids.get(term1)
+        term_id2 = self._term_ids.get(term2)
+        if term_id1 is None or term_id2 is None:
+            return None
+        return (term_id1 << 32) | term_id2 if term_id1 <= term_id2 else (term_id2 << 32) | term_id1
+
+    # the bitmask of the given datasets, datasets not in the store yet get the next free bit
+    def dataset_mask(self, *dataset_names):
+        mask = 0
+        for name in dataset_names:
+            if name not in self._dataset_bits:
+                self._dataset_bits[name] = len(self.datasets)
+                self.datasets.append(name)
+            mask |= 1 << self._dataset_bits[name]
+        return mask
+
+    # adds the pairs to the dataset, returns the bitmask of the dataset
+    def add_pairs(self, dataset_name, pairs):
+        mask = self.dataset_mask(dataset_name)
+        memberships = self._memberships
+        for term1, term2 in pairs:
+            term_id1 = self._term_id(term1)
+            term_id2 = self._term_id(term2)
+            key = (term_id1 << 32) | term_id2 if term_id1 <= term_id2 else (term_id2 << 32) | term_id1
+            memberships[key] = memberships.get(key, 0) | mask
+        return mask
+
+    # bitmask of the datasets containing the pair (in either order)
+    def membership(self, term1, term2):
+        key = self._pair_key(term1, term2)
+        return 0 if key is None else self._memberships.get(key, 0)
+
+    # the pairs of the datasets whose bits are set in mask, with their terms in the order of their ids
+    def pairs(self, mask):
+        return [(self._terms[key >> 32], self._terms[key & 0xFFFFFFFF])
+                for key, membership in self._memberships.items() if membership & mask]
+
+
+def is_in_pair_set(pair_set, term1, term2):
+    return pair_set.mask != 0 and (pair_set.store.membership(term1, term2) & pair_set.mask) != 0
+
+
+def pair_set_dataframe(pair_set):
+    return pd.DataFrame(pair_set.store.pairs(pair_set.mask), columns=['source', 'target'])
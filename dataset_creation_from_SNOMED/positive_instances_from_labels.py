@@ -16,19 +16,34 @@
 """Creation of similar term pairs from SNOMED concept labels"""
 
 import itertools
-import csv
 import os
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from tqdm import tqdm
 
 from dataset_creation_from_SNOMED.snomed_id import SnomedID
+from dataset_creation_from_SNOMED.rf2_reader import read_rf2_snapshot
+from dataset_creation_from_SNOMED.reference_engine import create_pair_collection
+from dataset_creation_from_SNOMED.reference_engine import FAST_ENGINE
 from dataset_creation_from_SNOMED.positive_instances_utils import save_positive_instances
 from dataset_creation_from_SNOMED.positive_instances_utils import create_dataframes_without_duplicates
 from dataset_creation_from_SNOMED.positive_instances_utils import create_term_pairs
 from dataset_creation_from_SNOMED.positive_instances_utils import clean_pref_term
+from dataset_creation_from_SNOMED.term_features import create_term_features
+from dataset_creation_from_SNOMED.term_features import normalized_term
 
 
-def _label_sanity_check(alt, pref, concept):
+DESCRIPTION_FILE = "sct2_Description_Full-en_INT_20190131.txt"
+CONCEPT_FILE = "sct2_Concept_Full_INT_20190131.txt"
+
+# columns of the RF2 files used to create the datasets, only the latest entry of each
+# concept, description and language refset member is read (see rf2_reader)
+CONCEPT_COLUMNS = ['id', 'effectiveTime', 'active', 'moduleId']
+DESCRIPTION_COLUMNS = ['id', 'effectiveTime', 'active', 'conceptId', 'typeId', 'term']
+LANGUAGE_REFSET_COLUMNS = ['effectiveTime', 'active', 'refsetId', 'referencedComponentId', 'acceptabilityId']
+
+
+def _label_sanity_check(alt, pref, concept, term_features):
     if not isinstance(alt, str):
         raise Exception("Alt label not a string: %s \n type is: %s \n concept ID: %s"
                         % (alt, type(alt), concept))
@@ -39,7 +54,7 @@ def _label_sanity_check(alt, pref, concept):
         raise Exception("Empty string pref label of conept ID %s" % (concept))
     if alt.strip() == "":
         raise Exception("Empty string alt label of concept ID %s" % (concept))
-    if alt.lower() == pref.lower():
+    if normalized_term(term_features, alt) == normalized_term(term_features, pref):
         raise Exception('Pref and alt label are the same despite previous filtering \n pref: %s \n alt: %s' \
                         % (pref, alt))
 
@@ -76,33 +91,45 @@ def check_exactly_one_pref_label(pref_list, concept):
         raise Exception("No pref label for concept %s \n %s" %(concept, pref_list))
 
 
-def label_sanity_check(label_pairs, concept):
+def label_sanity_check(label_pairs, concept, term_features):
     for lab1, lab2 in label_pairs:
-        _label_sanity_check(lab1, lab2, concept)
+        _label_sanity_check(lab1, lab2, concept, term_features)
+
 
+# snapshot of the IDs of all active concepts which are not in the model component module,
+# computed once from the most recent entry of each concept
+def get_active_medical_concepts(concepts):
+    latest_entries = concepts.loc[concepts.groupby("id")["effectiveTime"].idxmax()]
 
-def is_active_and_medical_concept(concept, concepts):
-    concept_entries = concepts[concepts["id"] == concept]
-    return is_active_concept(concept_entries) and is_medical_concept(concept_entries)
+    # check if the concept is still active, if not, don't include this concept in dataset
+    # (descriptions may be active even if concept is inactive! they are not de-activated!)
+    active = latest_entries["active"].astype(bool)
 
+    # don't use concepts which are in the model component module (mainly relationships and
+    # descriptional concepts like 'Inactive Value')
+    medical = latest_entries["moduleId"] != SnomedID.MODEL_COMPONENT_MODULE.value
 
-# check if the concept is still active, if not, don't include this concept in dataset
-# (descriptions may be active even if concept is inactive! they are not de-activated!)
-def is_active_concept(concept_entries):
-    return concept_entries.loc[concept_entries["effectiveTime"].idxmax()].active
+    return set(latest_entries.loc[active & medical, "id"].tolist())
 
 
-# don't use concepts which are in the model component module (mainly relationships and
-# descriptional concepts like 'Inactive Value')
-def is_medical_concept(concept_entries):
-    return not concept_entries.loc[concept_entries["effectiveTime"].idxmax()].moduleId\
-               == SnomedID.MODEL_COMPONENT_MODULE.value
+# the current acceptability of each description in the given language refset,
+# descriptions whose most recent refset entry is inactive are not part of the language
+def get_language_acceptability(language_refset, refset_id):
+    members = language_refset[language_refset["refsetId"] == refset_id]
+    latest_entries = members.loc[members.groupby("referencedComponentId")["effectiveTime"].idxmax()]
+    latest_entries = latest_entries[latest_entries["active"].astype(bool)]
 
+    return dict(zip(latest_entries["referencedComponentId"].tolist(),
+                    latest_entries["acceptabilityId"].tolist()))
 
-def get_pref_and_alt_labels(labels, concept):
+
+# the pref and alt labels of a concept, in a language (given by the IDs of its preferred descriptions)
+# None if the concept has neither a fully specified name nor a preferred synonym
+def get_pref_and_alt_labels(labels, concept, preferred_label_ids=None):
     # get all labels and their IDs for the concept
     concept_labels = labels[labels['conceptId'] == concept]
     concept_label_dict = {'pref': [], 'alt': []}
+    preferred_alt_terms = []
 
     # extract all current labels of this concept and split them into pref and alt
     for label_id in concept_labels.id.unique():
@@ -140,87 +167,253 @@ def get_pref_and_alt_labels(labels, concept):
             concept_label_dict['alt'].extend(label_id_alt_terms)
             concept_label_dict['pref'].extend(label_id_pref_terms)
 
+            if preferred_label_ids is not None and label_id in preferred_label_ids:
+                preferred_alt_terms.extend(label_id_alt_terms)
+
+    # some languages have no fully specified names, then the preferred synonym is used instead
+    if not concept_label_dict['pref'] and preferred_alt_terms:
+        concept_label_dict['pref'].append(preferred_alt_terms[0])
+        concept_label_dict['alt'].remove(preferred_alt_terms[0])
+
+    # a partially translated concept may only have acceptable synonyms in a language,
+    # it has no label to pair the synonyms with
+    if not concept_label_dict['pref'] and preferred_label_ids is not None:
+        return None
+
     check_exactly_one_pref_label(concept_label_dict['pref'], concept)
 
     return concept_label_dict
 
 
+# label pairs of the given concepts, as pair collections (syn_syn, syn_syn_easy, fsn_syn, fsn_syn_easy)
+def create_label_pairs(labels,
+                       concept_ids,
+                       active_medical_concepts,
+                       easy_hard_split,
+                       split_distance,
+                       preferred_label_ids=None,
+                       engine=FAST_ENGINE):
 
-##################################################################
-# MAIN
-##################################################################
+    # group the labels of the given concepts by concept once (keeping their order)
+    # instead of searching all labels for each concept
+    labels = labels[labels["conceptId"].isin(concept_ids)].sort_values("conceptId", kind="mergesort")
+    label_concept_ids = labels["conceptId"].values
 
-def positive_instances_from_labels(easy_hard_split,
-                                   split_distance,
-                                   snomed_path,
-                                   dataset_path):
-    # input SNOMED files
-    labels = pd.read_csv(os.path.join(snomed_path, "sct2_Description_Full-en_INT_20190131.txt"),
-                         sep="\t", header=0,
-                         quoting=csv.QUOTE_NONE, keep_default_na=False)
-    concepts = pd.read_csv(os.path.join(snomed_path, "sct2_Concept_Full_INT_20190131.txt"),
-                           sep="\t", header=0,
-                           quoting=csv.QUOTE_NONE, keep_default_na=False)
-
-    fsn_syn = {'pref':[], 'alt':[]}
-    fsn_syn_easy = {'pref':[], 'alt':[]}
-    syn_syn = {'label1':[], 'label2':[]}
-    syn_syn_easy = {'label1':[], 'label2':[]}
+    # lowercased terms and distance features of these labels and cleaned pref labels, computed once
+    term_features = create_term_features(itertools.chain(labels.term, map(clean_pref_term, labels.term)))
+
+    fsn_syn = create_pair_collection(['pref', 'alt'], engine)
+    fsn_syn_easy = create_pair_collection(['pref', 'alt'], engine)
+    syn_syn = create_pair_collection(['label1', 'label2'], engine)
+    syn_syn_easy = create_pair_collection(['label1', 'label2'], engine)
+
+    # label pairs of all concepts, split into easy and hard pairs at once
+    fsn_syn_label_pairs = []
+    syn_syn_label_pairs = []
+
+    concepts_without_pref_label = 0
 
     # create fsn-syn and syn-syn label pairs for all concepts (concept IDs)
-    for concept in tqdm(concepts.id.unique()):
+    for concept in tqdm(concept_ids):
 
-        if not is_active_and_medical_concept(concept, concepts):
+        if concept not in active_medical_concepts:
             continue
 
+        concept_labels = labels.iloc[np.searchsorted(label_concept_ids, concept, side='left'):
+                                     np.searchsorted(label_concept_ids, concept, side='right')]
+
         # extract all current labels of this concept and split them into pref and alt
-        concept_label_dict = get_pref_and_alt_labels(labels, concept)
+        concept_label_dict = get_pref_and_alt_labels(concept_labels, concept, preferred_label_ids)
+        if concept_label_dict is None:
+            concepts_without_pref_label += 1
+            continue
 
         pref_label = clean_pref_term(concept_label_dict['pref'][0])
+        pref_label_normalized = normalized_term(term_features, pref_label)
 
         concept_label_dict['alt'] =\
-            [l for l in concept_label_dict['alt'] if l.lower() != pref_label.lower()]
+            [l for l in concept_label_dict['alt'] if normalized_term(term_features, l) != pref_label_normalized]
 
-        label_sanity_check(itertools.product(concept_label_dict['alt'], [pref_label]), concept)
+        label_sanity_check(itertools.product(concept_label_dict['alt'], [pref_label]), concept, term_features)
 
         # construct fsn-syn positive instances
-        fsn_syn_label_pairs = itertools.product(concept_label_dict['alt'], [pref_label])
-        fsn_syn, fsn_syn_easy = create_term_pairs(fsn_syn_label_pairs,
-                                                  easy_hard_split,
-                                                  split_distance,
-                                                  'alt',
-                                                  'pref',
-                                                  fsn_syn,
-                                                  fsn_syn_easy)
-        
+        fsn_syn_label_pairs.extend(itertools.product(concept_label_dict['alt'], [pref_label]))
+
         # add pref label to the other alt labels to create syn-syn instances
         concept_label_dict['alt'].insert(0, pref_label)
 
         # construct syn-syn positive instances
-        syn_syn_label_pairs = itertools.combinations(concept_label_dict['alt'], 2)
-        syn_syn, syn_syn_easy = create_term_pairs(syn_syn_label_pairs,
-                                                  easy_hard_split,
-                                                  split_distance,
-                                                  'label1',
-                                                  'label2',
-                                                  syn_syn,
-                                                  syn_syn_easy)
+        syn_syn_label_pairs.extend(itertools.combinations(concept_label_dict['alt'], 2))
+
+    if concepts_without_pref_label:
+        print('Skipped %d concepts without fully specified name or preferred synonym'
+              % concepts_without_pref_label)
+
+    fsn_syn, fsn_syn_easy = create_term_pairs(fsn_syn_label_pairs,
+                                              easy_hard_split,
+                                              split_distance,
+                                              'alt',
+                                              'pref',
+                                              fsn_syn,
+                                              fsn_syn_easy,
+                                              term_features)
+
+    syn_syn, syn_syn_easy = create_term_pairs(syn_syn_label_pairs,
+                                              easy_hard_split,
+                                              split_distance,
+                                              'label1',
+                                              'label2',
+                                              syn_syn,
+                                              syn_syn_easy,
+                                              term_features)
+
+    return syn_syn, syn_syn_easy, fsn_syn, fsn_syn_easy
+
+
+def save_label_datasets(label_pairs,
+                        easy_hard_split,
+                        split_distance,
+                        dataset_path,
+                        writer=None):
+    syn_syn, syn_syn_easy, fsn_syn, fsn_syn_easy = label_pairs
 
     [syn_syn_dataframe], [syn_syn_easy_dataframe] = \
-        create_dataframes_without_duplicates(zip([syn_syn], [syn_syn_easy]),
-                                             easy_hard_split,
-                                             'label1',
-                                             'label2')
+        create_dataframes_without_duplicates(zip([syn_syn], [syn_syn_easy]))
 
     [fsn_syn_dataframe], [fsn_syn_easy_dataframe] = \
-        create_dataframes_without_duplicates(zip([fsn_syn], [fsn_syn_easy]),
-                                             easy_hard_split,
-                                             'pref',
-                                             'alt')
+        create_dataframes_without_duplicates(zip([fsn_syn], [fsn_syn_easy]))
 
     save_positive_instances(dataset_path,
                             easy_hard_split,
                             split_distance,
                             [syn_syn_dataframe, fsn_syn_dataframe],
                             [syn_syn_easy_dataframe, fsn_syn_easy_dataframe],
-                            ['SYN_SYN', 'FSN_SYN'])
+                            ['SYN_SYN', 'FSN_SYN'],
+                            writer)
+
+
+def create_label_datasets(labels,
+                          concept_ids,
+                          active_medical_concepts,
+                          easy_hard_split,
+                          split_distance,
+                          dataset_path,
+                          writer=None,
+                          preferred_label_ids=None,
+                          engine=FAST_ENGINE):
+    label_pairs = create_label_pairs(labels,
+                                     concept_ids,
+                                     active_medical_concepts,
+                                     easy_hard_split,
+                                     split_distance,
+                                     preferred_label_ids,
+                                     engine)
+    save_label_datasets(label_pairs, easy_hard_split, split_distance, dataset_path, writer)
+
+
+# all concept IDs (in order of the concept files) and the IDs of the active medical concepts
+def read_concepts(snomed_path, concept_files=(CONCEPT_FILE,)):
+    concepts = read_rf2_snapshot(snomed_path, concept_files, usecols=CONCEPT_COLUMNS)
+    return concepts.id.values, get_active_medical_concepts(concepts)
+
+
+# builds the label datasets of one language into its own directory,
+# using only the descriptions that are part of the language refset
+def positive_instances_for_language(language_name,
+                                    language_refset_id,
+                                    concept_ids,
+                                    active_medical_concepts,
+                                    easy_hard_split,
+                                    split_distance,
+                                    snomed_path,
+                                    dataset_path,
+                                    description_files,
+                                    language_refset_files,
+                                    engine=FAST_ENGINE):
+
+    language_refset = read_rf2_snapshot(snomed_path,
+                                        language_refset_files,
+                                        id_column='referencedComponentId',
+                                        usecols=LANGUAGE_REFSET_COLUMNS,
+                                        row_filter=lambda chunk: chunk["refsetId"] == language_refset_id)
+    acceptability = get_language_acceptability(language_refset, language_refset_id)
+
+    # only the descriptions of the language are kept while reading the description files
+    member_ids = np.fromiter(acceptability.keys(), dtype=np.int64, count=len(acceptability))
+    labels = read_rf2_snapshot(snomed_path,
+                               description_files,
+                               usecols=DESCRIPTION_COLUMNS,
+                               row_filter=lambda chunk: chunk["id"].isin(member_ids))
+
+    preferred_label_ids = {label_id for label_id, acceptability_id in acceptability.items()
+                           if acceptability_id == SnomedID.PREFERRED_ACCEPTABILITY.value}
+
+    # languages and extensions may only describe some of the concepts
+    active_medical_concepts = active_medical_concepts.intersection(labels["conceptId"].tolist())
+
+    language_dataset_path = os.path.join(dataset_path, language_name)
+    if not os.path.isdir(language_dataset_path):
+        os.mkdir(language_dataset_path)
+
+    print('Creating positive instances for language %s' % language_name)
+    create_label_datasets(labels,
+                          concept_ids,
+                          active_medical_concepts,
+                          easy_hard_split,
+                          split_distance,
+                          language_dataset_path,
+                          preferred_label_ids=preferred_label_ids,
+                          engine=engine)
+
+
+##################################################################
+# MAIN
+##################################################################
+
+# languages: (name, language refset ID) tuples, the datasets of each language are created
+# in parallel processes in a subdirectory of dataset_path named after the language,
+# without languages one set of datasets is created from all descriptions in dataset_path
+def positive_instances_from_labels(easy_hard_split,
+                                   split_distance,
+                                   snomed_path,
+                                   dataset_path,
+                                   writer=None,
+                                   description_files=(DESCRIPTION_FILE,),
+                                   concept_files=(CONCEPT_FILE,),
+                                   language_refset_files=(),
+                                   languages=(),
+                                   processes=None,
+                                   engine=FAST_ENGINE):
+    # the concept snapshot is computed once and shared by all languages
+    concept_ids, active_medical_concepts = read_concepts(snomed_path, concept_files)
+
+    if not languages:
+        labels = read_rf2_snapshot(snomed_path, description_files, usecols=DESCRIPTION_COLUMNS)
+        create_label_datasets(labels,
+                              concept_ids,
+                              active_medical_concepts,
+                              easy_hard_split,
+                              split_distance,
+                              dataset_path,
+                              writer,
+                              engine=engine)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes or len(languages)) as executor:
+        language_builds = [executor.submit(positive_instances_for_language,
+                                           language_name,
+                                           language_refset_id,
+                                           concept_ids,
+                                           active_medical_concepts,
+                                           easy_hard_split,
+                                           split_distance,
+                                           snomed_path,
+                                           dataset_path,
+                                           description_files,
+                                           language_refset_files,
+                                           engine)
+                           for language_name, language_refset_id in languages]
+
+        # raises the error of a failed language build
+        for language_build in language_builds:
+            language_build.result()
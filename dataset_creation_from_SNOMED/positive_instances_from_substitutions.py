@@ -18,44 +18,67 @@
 import csv
 import os
 import glob
+from collections import namedtuple
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from dataset_creation_from_SNOMED.snomed_id import SnomedID
+from dataset_creation_from_SNOMED.rf2_reader import read_rf2_snapshot
+from dataset_creation_from_SNOMED.positive_instances_from_labels import DESCRIPTION_FILE
+from dataset_creation_from_SNOMED.positive_instances_from_labels import CONCEPT_FILE
+from dataset_creation_from_SNOMED.positive_instances_from_labels import DESCRIPTION_COLUMNS
+from dataset_creation_from_SNOMED.positive_instances_from_labels import read_concepts
+from dataset_creation_from_SNOMED.background_writer import wait_for_writes
+from dataset_creation_from_SNOMED.reference_engine import create_pair_collection
+from dataset_creation_from_SNOMED.reference_engine import FAST_ENGINE
 from dataset_creation_from_SNOMED.positive_instances_utils import create_term_pairs
 from dataset_creation_from_SNOMED.positive_instances_utils import save_positive_instances
 from dataset_creation_from_SNOMED.positive_instances_utils import create_dataframes_without_duplicates
 from dataset_creation_from_SNOMED.positive_instances_utils import clean_pref_term
+from dataset_creation_from_SNOMED.term_features import create_term_features
+from dataset_creation_from_SNOMED.term_features import normalized_term
+from dataset_creation_from_SNOMED.substitution_chains import get_active_substitutions
+from dataset_creation_from_SNOMED.substitution_chains import create_substitution_chains
+from dataset_creation_from_SNOMED.substitution_chains import resolve_substitution_chains
+from dataset_creation_from_SNOMED.pair_store import PairStore
+from dataset_creation_from_SNOMED.pair_store import PairSet
+from dataset_creation_from_SNOMED.pair_store import is_in_pair_set
 
 
-def get_pref_label(concept, label_table):
-    concept_labels = label_table[label_table["conceptId"] == concept]
+ASSOCIATION_FILE = "der2_cRefset_AssociationFull_INT_20190131.txt"
 
-    # sometimes the label is changed throughout the years, i.e. there are multiple entries for
-    # a concept with multiple different labels
-    # in this case choose the most recent one that is active and a pref label
-    concept_pref_labels = []
+# dataset of deleted concepts and the terminal active concepts of their substitution chains
+RESOLVED_SUBSTITUTIONS = 'resolved_substitutions'
 
-    for label_id in concept_labels.id.unique():
 
-        # get all entries of a label ID
-        label_id_entries = concept_labels[concept_labels["id"] == label_id]
+# concept_ids: sorted IDs of the concepts of all current pref labels
+# terms: the pref label of each of these concepts
+PrefLabels = namedtuple('PrefLabels', ['concept_ids', 'terms'])
 
-        # row index where this label was last updated (has the max effective time)
-        last_update_entry = label_id_entries['effectiveTime'].idxmax()
 
-        # if most recent entry of label is active and states it is the pref label, use this label
-        if label_id_entries.loc[last_update_entry, 'active'] and \
-                label_id_entries.loc[last_update_entry, 'typeId'] == SnomedID.FSN_DESCRIPTION.value:
-            concept_pref_labels.append(label_id_entries.loc[last_update_entry].term)
+# the current pref labels of all concepts, from the most recent entry of each label
+# (sometimes the label is changed throughout the years, i.e. there are multiple entries for
+# a concept with multiple different labels, only a label whose most recent entry is active
+# and states it is the pref label is used)
+def get_pref_labels(labels):
+    pref_labels = labels[labels['active'].astype(bool) &
+                         (labels['typeId'] == SnomedID.FSN_DESCRIPTION.value)]
+    pref_labels = pref_labels.sort_values('conceptId', kind='mergesort')
+    return PrefLabels(pref_labels['conceptId'].values, pref_labels['term'].values)
+
+
+def get_pref_label(concept, pref_labels):
+    start = np.searchsorted(pref_labels.concept_ids, concept, side='left')
+    end = np.searchsorted(pref_labels.concept_ids, concept, side='right')
 
     # make sure there is exactly one pref label
-    if len(concept_pref_labels) == 0:
+    if start == end:
         raise Exception("No pref label found for concept: %s" %(concept))
-    if len(concept_pref_labels) > 1:
-        raise Exception("Multiple pref labels found for concept: %s" %(concept_pref_labels))
+    if end - start > 1:
+        raise Exception("Multiple pref labels found for concept: %s" %(pref_labels.terms[start:end].tolist()))
 
-    return concept_pref_labels[0]
+    return pref_labels.terms[start]
 
 
 def clean_term(label):
@@ -70,23 +93,20 @@ def clean_term(label):
     return label_cleaned
 
 
+# the pairs of the SYN_SYN datasets, kept once in a pair store
 def read_syn_syn_instances(path):
-    syn_syn_datasets = []
+    pair_store = PairStore()
+    mask = 0
     for f in glob.glob(os.path.join(path, 'SYN_SYN*')):
         df = pd.read_csv(f, sep="\t", quoting=csv.QUOTE_NONE,
                          keep_default_na=False, header=0,
                          names=['source', 'target'])
-        syn_syn_datasets.append(df)
-    return pd.concat(syn_syn_datasets, axis=0, ignore_index=True)
+        mask |= pair_store.add_pairs(os.path.basename(f), zip(df['source'].values, df['target'].values))
+    return PairSet(pair_store, mask)
 
 
 def is_pair_in_syn_syn(syn_syn_instances, source_label_text, target_label_text):
-    return is_same_pair(syn_syn_instances, source_label_text, target_label_text) or \
-           is_same_pair(syn_syn_instances, target_label_text, source_label_text)
-
-def is_same_pair(syn_syn_instances, label1, label2):
-    return not syn_syn_instances[(syn_syn_instances['source'] == label1)
-                                 & (syn_syn_instances['target'] == label2)].empty
+    return is_in_pair_set(syn_syn_instances, source_label_text, target_label_text)
 
 
 def is_active(substitutes_core_module, source_id, target_id, deletion_reason):
@@ -99,6 +119,82 @@ def is_active(substitutes_core_module, source_id, target_id, deletion_reason):
     return substitution_pair_rows.loc[substitution_pair_rows["effectiveTime"].idxmax()].active
 
 
+# the cleaned up pref labels of a source and target concept,
+# or None if the pair is not used as positive instance
+# term_features: features of the cleaned up pref labels (see term_features)
+def get_substitution_label_pair(source_id, target_id, pref_labels, syn_syn_instances, term_features):
+    # get pref label of source and target concept
+    source_label = get_pref_label(source_id, pref_labels)
+    target_label = get_pref_label(target_id, pref_labels)
+
+    # the SNOMED substitution file contains some strange entries of e.g.
+    # possEquivTo where the target is a namespace concept, these should be ignored
+    if "namespace" in target_label:
+        return None
+
+    # get cleaned up labels of source and target
+    source_label_cleaned = clean_term(source_label)
+    target_label_cleaned = clean_term(target_label)
+
+    # if the source and target labels are the same, ignore them
+    if normalized_term(term_features, source_label_cleaned) == \
+            normalized_term(term_features, target_label_cleaned):
+        return None
+
+    # check if the current concept pair (or its reverse)
+    # is already in the dataset of synonym labels
+    if is_pair_in_syn_syn(syn_syn_instances, source_label_cleaned, target_label_cleaned):
+        return None
+
+    return source_label_cleaned, target_label_cleaned
+
+
+# get_substitution_label_pair(), computed once per source and target concept
+# (label_pairs: the label pairs computed so far)
+def get_known_substitution_label_pair(source_id, target_id, pref_labels, syn_syn_instances, term_features,
+                                      label_pairs):
+    concept_pair = (int(source_id), int(target_id))
+    if concept_pair not in label_pairs:
+        label_pairs[concept_pair] = \
+            get_substitution_label_pair(source_id, target_id, pref_labels, syn_syn_instances, term_features)
+    return label_pairs[concept_pair]
+
+
+# pairs of each deleted concept and the terminal active concept of its chain of substitutions
+# (see substitution_chains), whatever the reasons of the substitutions,
+# label_pairs: label pairs of concept pairs known already (e.g. of the direct substitutions)
+def create_resolved_substitution_pairs(substitutes_core_module,
+                                       pref_labels,
+                                       active_concepts,
+                                       syn_syn_instances,
+                                       term_features,
+                                       easy_hard_split,
+                                       split_distance,
+                                       engine=FAST_ENGINE,
+                                       label_pairs=None):
+    if label_pairs is None:
+        label_pairs = {}
+
+    source_ids, target_ids = get_active_substitutions(substitutes_core_module)
+    chains = create_substitution_chains(source_ids, target_ids, active_concepts)
+
+    resolved_substitutions = create_pair_collection(['source', 'target'], engine)
+    resolved_substitutions_easy = create_pair_collection(['source', 'target'], engine)
+
+    # label pairs of all resolved substitutions, split into easy and hard pairs at once
+    resolved_label_pairs = []
+    for source_id, target_id in tqdm(resolve_substitution_chains(chains).items()):
+        label_pair = get_known_substitution_label_pair(source_id, target_id, pref_labels,
+                                                       syn_syn_instances, term_features, label_pairs)
+        if label_pair is not None:
+            resolved_label_pairs.append(label_pair)
+
+    return create_term_pairs(resolved_label_pairs,
+                             easy_hard_split, split_distance,
+                             'source', 'target', resolved_substitutions, resolved_substitutions_easy,
+                             term_features)
+
+
 
 ##################################################################
 # MAIN
@@ -108,27 +204,40 @@ def is_active(substitutes_core_module, source_id, target_id, deletion_reason):
 def positive_instances_from_substitutions(easy_hard_split,
                                           split_distance,
                                           snomed_path,
-                                          dataset_path):
+                                          dataset_path,
+                                          writer=None,
+                                          engine=FAST_ENGINE,
+                                          resolve_chains=False,
+                                          description_files=(DESCRIPTION_FILE,),
+                                          concept_files=(CONCEPT_FILE,)):
     # input SNOMED files
-    labels = \
-        pd.read_csv(os.path.join(snomed_path, "sct2_Description_Full-en_INT_20190131.txt"),
-                    sep="\t", header=0,
-                    quoting=csv.QUOTE_NONE, keep_default_na=False)
+    labels = read_rf2_snapshot(snomed_path, description_files, usecols=DESCRIPTION_COLUMNS)
+    pref_labels = get_pref_labels(labels)
     substitutes = \
-        pd.read_csv(os.path.join(snomed_path, "der2_cRefset_AssociationFull_INT_20190131.txt"),
+        pd.read_csv(os.path.join(snomed_path, ASSOCIATION_FILE),
                     sep="\t", header=0,
                     quoting=csv.QUOTE_NONE, keep_default_na=False)
 
     # get already created positive instances from labels to avoid duplicate term pairs
+    # (they may still be being written in the background)
+    wait_for_writes(writer)
     syn_syn_instances = read_syn_syn_instances(dataset_path)
 
-    # dictionaries to capture extracted label pairs
-    possibly_equivalent_to = {'source':[], 'target':[]}
-    same_as = {'source':[], 'target':[]}
-    replaced_by = {'source':[], 'target':[]}
-    possibly_equivalent_to_easy = {'source': [], 'target': []}
-    same_as_easy = {'source': [], 'target': []}
-    replaced_by_easy = {'source': [], 'target': []}
+    # collections to capture extracted label pairs
+    possibly_equivalent_to = create_pair_collection(['source', 'target'], engine)
+    same_as = create_pair_collection(['source', 'target'], engine)
+    replaced_by = create_pair_collection(['source', 'target'], engine)
+    possibly_equivalent_to_easy = create_pair_collection(['source', 'target'], engine)
+    same_as_easy = create_pair_collection(['source', 'target'], engine)
+    replaced_by_easy = create_pair_collection(['source', 'target'], engine)
+
+    # label pairs of each dataset, split into easy and hard pairs at once
+    possibly_equivalent_to_label_pairs = []
+    same_as_label_pairs = []
+    replaced_by_label_pairs = []
+
+    # lowercased terms and distance features of all cleaned pref labels, computed once
+    term_features = create_term_features(map(clean_term, pref_labels.terms))
 
     # only use core module (rather than model componenent module)
     substitutes_core_module = substitutes[substitutes["moduleId"] !=
@@ -145,20 +254,18 @@ def positive_instances_from_substitutions(easy_hard_split,
     # go through all the associations and
     # select the relevant ones between replaced concept pairs
     # with the desired reasons
+    label_pairs = {}
     for index, substitution_pair in tqdm(substitution_pairs.iterrows(),
                                          total=substitution_pairs.shape[0]):
 
         # check if a source - target pair has one of the desired deletion reasons
         deletion_reason = substitution_pair.loc['refsetId']
         if deletion_reason == SnomedID.POSSIBLY_EQUIVALENT_TO_REFSET.value:
-            add_to = possibly_equivalent_to
-            add_to_easy = possibly_equivalent_to_easy
+            add_to = possibly_equivalent_to_label_pairs
         elif deletion_reason == SnomedID.SAME_AS_REFSET.value:
-            add_to = same_as
-            add_to_easy = same_as_easy
+            add_to = same_as_label_pairs
         elif deletion_reason == SnomedID.REPLACED_BY_REFSET.value:
-            add_to = replaced_by
-            add_to_easy = replaced_by_easy
+            add_to = replaced_by_label_pairs
         else:
             continue
 
@@ -170,44 +277,56 @@ def positive_instances_from_substitutions(easy_hard_split,
         if not is_active(substitutes_core_module, source_id, target_id, deletion_reason):
             continue
 
-        # get pref label of source and target concept
-        source_label = get_pref_label(source_id, labels)
-        target_label = get_pref_label(target_id, labels)
-
-        # the SNOMED substitution file contains some strange entries of e.g.
-        # possEquivTo where the target is a namespace concept, these should be ignored
-        if "namespace" in target_label:
+        label_pair = get_known_substitution_label_pair(source_id, target_id, pref_labels,
+                                                       syn_syn_instances, term_features, label_pairs)
+        if label_pair is None:
             continue
 
-        # get cleaned up labels of source and target
-        source_label_cleaned = clean_term(source_label)
-        target_label_cleaned = clean_term(target_label)
-
-        # if the source and target labels are the same, ignore them
-        if source_label_cleaned.lower() == target_label_cleaned.lower():
-            continue
-
-        # check if the current concept pair (or its reverse)
-        # is already in the dataset of synonym labels
-        if is_pair_in_syn_syn(syn_syn_instances, source_label_cleaned, target_label_cleaned):
-            continue
+        add_to.append(label_pair)
 
-        __add_to, _add_to_easy = \
-            create_term_pairs([(source_label_cleaned, target_label_cleaned)],
-                              easy_hard_split, split_distance,
-                              'source', 'target', add_to, add_to_easy)
+    for dataset_label_pairs, add_to, add_to_easy in \
+            [(possibly_equivalent_to_label_pairs, possibly_equivalent_to, possibly_equivalent_to_easy),
+             (same_as_label_pairs, same_as, same_as_easy),
+             (replaced_by_label_pairs, replaced_by, replaced_by_easy)]:
+        create_term_pairs(dataset_label_pairs,
+                          easy_hard_split, split_distance,
+                          'source', 'target', add_to, add_to_easy, term_features)
 
 
     normal_datasets, easy_datasets = \
         create_dataframes_without_duplicates(zip([possibly_equivalent_to, same_as, replaced_by],
                                                  [possibly_equivalent_to_easy,
                                                   same_as_easy,
-                                                  replaced_by_easy]),
-                                             easy_hard_split, 'source', 'target')
+                                                  replaced_by_easy]))
 
     save_positive_instances(dataset_path,
                             easy_hard_split,
                             split_distance,
                             normal_datasets,
                             easy_datasets,
-                            ['possibly_equivalent_to', 'same_as', 'replaced_by'])
+                            ['possibly_equivalent_to', 'same_as', 'replaced_by'],
+                            writer)
+
+    if resolve_chains:
+        print('*** Resolving chains of concept substitutions ***\n')
+        resolved_substitutions, resolved_substitutions_easy = \
+            create_resolved_substitution_pairs(substitutes_core_module,
+                                               pref_labels,
+                                               read_concepts(snomed_path, concept_files)[1],
+                                               syn_syn_instances,
+                                               term_features,
+                                               easy_hard_split,
+                                               split_distance,
+                                               engine,
+                                               label_pairs)
+
+        [resolved_dataset], [resolved_easy_dataset] = \
+            create_dataframes_without_duplicates(zip([resolved_substitutions], [resolved_substitutions_easy]))
+
+        save_positive_instances(dataset_path,
+                                easy_hard_split,
+                                split_distance,
+                                [resolved_dataset],
+                                [resolved_easy_dataset],
+                                [RESOLVED_SUBSTITUTIONS],
+                                writer)
@@ -17,8 +17,15 @@
 
 import os
 import csv
-import pandas as pd
-from Levenshtein import distance as levenshtein_distance
+import numpy as np
+
+from dataset_creation_from_SNOMED.term_features import distance_lower_bounds
+from dataset_creation_from_SNOMED.distance_cache import cached_distance
+from dataset_creation_from_SNOMED.background_writer import write_in_background
+
+
+def write_dataset(dataset, file_name):
+    dataset.to_csv(file_name, sep="\t", index=False, quoting=csv.QUOTE_NONE)
 
 
 def save_positive_instances(dataset_path,
@@ -26,7 +33,8 @@ def save_positive_instances(dataset_path,
                             split_distance,
                             datasets,
                             datasets_easy,
-                            dataset_names):
+                            dataset_names,
+                            writer=None):
 
     for i, name in enumerate(dataset_names):
 
@@ -34,11 +42,11 @@ def save_positive_instances(dataset_path,
         if easy_hard_split:
             file_name_easy = file_name + "_easy_distance" + str(split_distance) + ".tsv"
             file_name = file_name + "_hard_distance" + str(split_distance) + ".tsv"
-            datasets_easy[i].to_csv(file_name_easy, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+            write_in_background(writer, write_dataset, datasets_easy[i], file_name_easy)
         else:
             file_name = file_name + ".tsv"
 
-        datasets[i].to_csv(file_name, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+        write_in_background(writer, write_dataset, datasets[i], file_name)
 
         # print statistics about new datasets
         if easy_hard_split:
@@ -55,94 +63,56 @@ def save_positive_instances(dataset_path,
 
 
 
-def create_dataframes_without_duplicates(zipped_datasets, easy_hard_split, lab1, lab2):
+# the pair collections (see reference_engine.create_pair_collection) create dataframes
+# without duplicates or reverse duplicates
+def create_dataframes_without_duplicates(zipped_datasets):
 
     datasets = []
     datasets_easy = []
 
     for dataset, dataset_easy in zipped_datasets:
-        dataset_dataframe = pd.DataFrame(dataset)
-        dataset_easy_dataframe = pd.DataFrame(dataset_easy)
-
-        remove_duplicates(dataset_dataframe, lab1, lab2)
-        if easy_hard_split:
-            remove_duplicates(dataset_easy_dataframe, lab1, lab2)
-
-        datasets.append(dataset_dataframe)
-        datasets_easy.append(dataset_easy_dataframe)
+        datasets.append(dataset.to_dataframe())
+        datasets_easy.append(dataset_easy.to_dataframe())
 
     return datasets, datasets_easy
 
 
-def remove_duplicates(dataframe, lab1, lab2):
-    deletion_list = []
-    # remove normal duplicates
-    dataframe.drop_duplicates(inplace=True)
-
-    # create table with column labels switched
-    dataframe_switch = dataframe.copy()
-    dataframe_switch.rename({lab1 : lab2, lab2 : lab1}, axis=1, inplace=True)
-
-    # find all rows which are reverse duplicates
-    # (each pair will occur as lab1 - lab2 and lab2, lab1)
-    # by merging the original and the reversed tables on the source and target labels
-    # since by default the merge mode is 'inner',
-    # the merged table only contains lab1-lab2 pairs that occur in
-    # both tables (all others are ignored)
-    # --> the merged table only contains reverse duplicates
-    # 1 instance for each duplicate
-    # - if a table contains the same lab1-lab2 twice, then 2 instances in the new table
-    dataframe_merge = \
-        dataframe.merge(dataframe_switch, on=[lab1, lab2], right_index=True)
-    index_list = dataframe_merge.index.values.tolist()
-
-    # go through all indices of the original table that have reverse duplicates
-    # (i.e. all indices in the merged table)
-    while index_list != []:
-
-        # concept pair that has a reverse duplicate
-        l1 = dataframe_merge.loc[index_list[0], lab1]
-        l2 = dataframe_merge.loc[index_list[0], lab2]
-
-        # index of reverse duplicate
-        # (should have exactly one element, but for generality this can be applied to multiple ones)
-        to_delete = dataframe_merge[(dataframe_merge[lab2] == l1)
-                                    & (dataframe_merge[lab1] == l2)].index.values.tolist()
-
-        # add index to rows to be deleted and
-        # delete it from the indexes to be further investigated
-        # (each pair should only be investigated once,
-        # but reverse duplicates of course all occur twice)
-        for i in to_delete:
-            index_list.remove(i)
-            deletion_list.append(i)
-        index_list.pop(0)
-
-    # delete all reverse duplicates from the table
-    dataframe.drop(deletion_list, inplace=True)
-
-
+# term_features: features of a vocabulary containing all labels of the pairs (see term_features)
 def create_term_pairs(pairs,
                       easy_hard_split,
                       split_distance,
                       label1_name,
                       label2_name,
                       pairs_set,
-                      pairs_set_easy):
-
-    for lab1, lab2 in pairs:
-        if lab1.lower() == lab2.lower():
+                      pairs_set_easy,
+                      term_features):
+
+    # the pairs are stored in the column order of the collections
+    if pairs_set.column_names.index(label1_name) == 1:
+        pairs = [(lab2, lab1) for lab1, lab2 in pairs]
+    else:
+        pairs = list(pairs)
+    label1_ids = np.fromiter((term_features.index[lab1] for lab1, _ in pairs), dtype=np.int64, count=len(pairs))
+    label2_ids = np.fromiter((term_features.index[lab2] for _, lab2 in pairs), dtype=np.int64, count=len(pairs))
+
+    # pairs whose lower bound exceeds the split distance are hard without computing their distance
+    lower_bounds = distance_lower_bounds(term_features, label1_ids, label2_ids)
+
+    for (lab1, lab2), label1_id, label2_id, lower_bound in \
+            zip(pairs, label1_ids.tolist(), label2_ids.tolist(), lower_bounds.tolist()):
+        lab1_normalized = term_features.normalized[label1_id]
+        lab2_normalized = term_features.normalized[label2_id]
+        if lab1_normalized == lab2_normalized:
             continue
 
         # check if Levenstein distance between the two labels
         # is smaller or equal to the max distance defined
         # if a dataset split into easy/hard is desired
-        if easy_hard_split and levenshtein_distance(lab1.lower(), lab2.lower()) <= split_distance:
-            pairs_set_easy[label1_name].append(lab1)
-            pairs_set_easy[label2_name].append(lab2)
+        if easy_hard_split and lower_bound <= split_distance and \
+                cached_distance(lab1_normalized, lab2_normalized) <= split_distance:
+            pairs_set_easy.add(lab1, lab2)
         else:
-            pairs_set[label1_name].append(lab1)
-            pairs_set[label2_name].append(lab2)
+            pairs_set.add(lab1, lab2)
     return pairs_set, pairs_set_easy
 
 
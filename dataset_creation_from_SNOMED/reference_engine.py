@@ -0,0 +1,309 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Reference implementations of duplicate removal and negative sampling
+
+These are the implementations the published datasets were created with. They are kept unchanged
+(apart from their interface) so that the optimised implementations used by the 'fast' engine
+can be checked against them, see engine_verification.
+"""
+
+import random
+import operator
+from collections import OrderedDict
+from tqdm import tqdm
+from Levenshtein import distance as levenshtein_distance
+import pandas as pd
+
+from dataset_creation_from_SNOMED.pair_accumulator import PairAccumulator
+from dataset_creation_from_SNOMED.pair_store import pair_set_dataframe
+
+
+REFERENCE_ENGINE = 'reference'
+FAST_ENGINE = 'fast'
+ENGINES = [REFERENCE_ENGINE, FAST_ENGINE]
+
+
+def is_existing_pair(existing_pairs, label1, label2):
+    return (not existing_pairs.loc[
+        (existing_pairs['source'] == label1) & (existing_pairs['target'] == label2)].empty or \
+    not existing_pairs.loc[
+        (existing_pairs['target'] == label1) & (existing_pairs['source'] == label2)].empty)
+
+
+##################################################################
+# Duplicate removal of positive instances
+##################################################################
+
+# reference counterpart of PairAccumulator: all pairs are kept as added,
+# duplicates and reverse duplicates are only removed when the dataframe is created
+class PairList:
+
+    def __init__(self, column_names):
+        self.column_names = tuple(column_names)
+        self._columns = {name: [] for name in self.column_names}
+
+    def __len__(self):
+        return len(self._columns[self.column_names[0]])
+
+    def add(self, term1, term2):
+        self._columns[self.column_names[0]].append(term1)
+        self._columns[self.column_names[1]].append(term2)
+        return True
+
+    def to_dataframe(self):
+        dataframe = pd.DataFrame(self._columns, columns=list(self.column_names))
+        remove_duplicates(dataframe, *self.column_names)
+        return dataframe
+
+
+# collection of positive term pairs without duplicates for the given engine
+def create_pair_collection(column_names, engine=FAST_ENGINE):
+    if engine == REFERENCE_ENGINE:
+        return PairList(column_names)
+    return PairAccumulator(column_names)
+
+
+def remove_duplicates(dataframe, lab1, lab2):
+    deletion_list = []
+    # remove normal duplicates
+    dataframe.drop_duplicates(inplace=True)
+
+    # create table with column labels switched
+    dataframe_switch = dataframe.copy()
+    dataframe_switch.rename({lab1 : lab2, lab2 : lab1}, axis=1, inplace=True)
+
+    # find all rows which are reverse duplicates
+    # (each pair will occur as lab1 - lab2 and lab2, lab1)
+    # by merging the original and the reversed tables on the source and target labels
+    # since by default the merge mode is 'inner',
+    # the merged table only contains lab1-lab2 pairs that occur in
+    # both tables (all others are ignored)
+    # --> the merged table only contains reverse duplicates
+    # 1 instance for each duplicate
+    # - if a table contains the same lab1-lab2 twice, then 2 instances in the new table
+    dataframe_merge = \
+        dataframe.merge(dataframe_switch, on=[lab1, lab2], right_index=True)
+    index_list = dataframe_merge.index.values.tolist()
+
+    # go through all indices of the original table that have reverse duplicates
+    # (i.e. all indices in the merged table)
+    while index_list != []:
+
+        # concept pair that has a reverse duplicate
+        l1 = dataframe_merge.loc[index_list[0], lab1]
+        l2 = dataframe_merge.loc[index_list[0], lab2]
+
+        # index of reverse duplicate
+        # (should have exactly one element, but for generality this can be applied to multiple ones)
+        to_delete = dataframe_merge[(dataframe_merge[lab2] == l1)
+                                    & (dataframe_merge[lab1] == l2)].index.values.tolist()
+
+        # add index to rows to be deleted and
+        # delete it from the indexes to be further investigated
+        # (each pair should only be investigated once,
+        # but reverse duplicates of course all occur twice)
+        for i in to_delete:
+            index_list.remove(i)
+            deletion_list.append(i)
+        index_list.pop(0)
+
+    # delete all reverse duplicates from the table
+    dataframe.drop(deletion_list, inplace=True)
+
+
+##################################################################
+# Random strategy for negative sampling
+##################################################################
+
+# positive_pairs_all_datasets, existing_negatives: the pair sets passed to the fast implementation
+def create_random_pairs(positive_instances,
+                        positive_pairs_all_datasets,
+                        existing_negatives):
+
+    positive_pairs_all_datasets = pair_set_dataframe(positive_pairs_all_datasets)
+    existing_negatives = pair_set_dataframe(existing_negatives)
+
+    random.seed(42)
+    # holds the Levenshtein distance of each concept pair
+    distances = []
+
+    # tracks already created negative pairs as tuples, i.e. (l1,l2), to avoid duplicate creation
+    new_negative_pairs = []
+
+    for i, row in tqdm(positive_instances.iterrows(), total=positive_instances.shape[0]):
+        label1 = row['source']
+
+        # initialise random index
+        random_index = i
+
+        # make sure that no term pair duplicates or reverse duplicates are created
+        # comparing to both positive and negative concept pairs
+        while random_index == i or\
+            is_existing_pair(positive_pairs_all_datasets, label1, label2) or\
+            is_existing_pair(existing_negatives, label1, label2) or\
+            (label1, label2) in new_negative_pairs or (label2, label1) in new_negative_pairs\
+            or label1.lower() == label2.lower():
+
+            # choose a new random index and source vs target and get a new pairing term
+
+            random_index = random.randint(0, positive_instances.shape[0]-1)
+            source_or_target = random.choice(['source', 'target'])
+            label2 = positive_instances.loc[random_index][source_or_target]
+
+        distances.append(levenshtein_distance(label1.lower(), label2.lower()))
+        new_negative_pairs.append((label1, label2))
+
+    return new_negative_pairs, distances
+
+
+##################################################################
+# Levenshtein strategy for negative sampling
+##################################################################
+
+# positive_pairs_all_datasets, existing_negatives: the pair sets passed to the fast implementation
+def create_minimal_distance_pairs(positive_instances,
+                                  positive_pairs_all_datasets,
+                                  existing_negatives):
+
+    positive_pairs_all_datasets = pair_set_dataframe(positive_pairs_all_datasets)
+    existing_negatives = pair_set_dataframe(existing_negatives)
+
+    random.seed(42)
+
+    # holds the Levenshtein distance of each concept pair
+    distances = []
+
+    # tracks already created negative pairs as tuples, i.e. (l1,l2), to avoid duplicate creation
+    new_negative_pairs = []
+
+    # find all instances of each source concept
+    unique_source_concepts = positive_instances.groupby('source')
+
+    # for each concept, create a list of usable concepts that are not positive similarity instances
+    # and choose the ones with smallest Levenshtein distance as a difficult negative sample
+    for label1, group in tqdm(unique_source_concepts, total=unique_source_concepts.ngroups):
+
+        possible_targets = get_possible_targets(group, new_negative_pairs, positive_instances)
+        distances_possible_terms, possible_targets = \
+            get_levenshtein_possible_targets(possible_targets, label1)
+
+        # find the N minimal distances (for N positive pairs of the concept)
+        # and the respective pairing concept with this minimal distance
+        sorted_targets_and_distances = \
+            [(label, d) for d, label in sorted(zip(distances_possible_terms, possible_targets),
+                                               key=operator.itemgetter(0))]
+
+        min_dist_tuples = []
+        for i in range(0, len(group)):
+
+            # get the smallest Levenshtein distance
+            if not min_dist_tuples:
+                min_dist_tuples, sorted_targets_and_distances = \
+                    get_min_distance_tuples(sorted_targets_and_distances)
+
+            # choose a random term with minimal distance
+            label2, distance = min_dist_tuples.pop(random.randint(0, len(min_dist_tuples)-1))
+
+            while is_existing_pair(positive_pairs_all_datasets, label1, label2) or \
+            is_existing_pair(existing_negatives, label1, label2):
+
+                if not min_dist_tuples:
+                    min_dist_tuples, sorted_targets_and_distances = \
+                        get_min_distance_tuples(sorted_targets_and_distances)
+
+                label2, distance = min_dist_tuples.pop(random.randint(0, len(min_dist_tuples) - 1))
+
+            new_negative_pairs.append((label1, label2))
+            distances.append(distance)
+
+    return new_negative_pairs, distances
+
+
+# the original stopped with an IndexError when the last distance group was taken,
+# here it only stops when no targets are left at all (as the fast implementation)
+def get_min_distance_tuples(sorted_targets_and_distances):
+    if not sorted_targets_and_distances:
+        raise Exception('No possible targets left to create a negative pair')
+
+    min_dist_tuples = []
+    min_label, min_distance = sorted_targets_and_distances.pop(0)
+    min_dist_tuples.append((min_label, min_distance))
+
+    # find all terms with the same minimal dinstance
+    while sorted_targets_and_distances and sorted_targets_and_distances[0][1] == min_distance:
+        min_dist_tuples.append(sorted_targets_and_distances.pop(0))
+
+    return min_dist_tuples, sorted_targets_and_distances
+
+
+def get_possible_targets(group, new_negative_pairs, positive_instances):
+
+    # exclude the similarity pairs of this concept from table to be used to create negative pair
+    usable_labels = positive_instances.drop(group.index)
+
+    # all targets of the current concept are synonyms
+    # that should not be paired with the current concept,
+    # so is of course the current concept itself
+    synonyms = group['target'].tolist()
+    label1 = positive_instances.loc[group.index.tolist()[0], 'source']
+    synonyms.append(label1)
+
+    # find all concepts that are paired with the synonyms (as source or target)
+    concepts_to_exclude = \
+        usable_labels[usable_labels.target.isin(synonyms)]['source'].tolist()
+    concepts_to_exclude = \
+        concepts_to_exclude + usable_labels[usable_labels.source.isin(synonyms)]['target'].tolist()
+
+    # exclude all concept pairs containing a concept that's also paired with a synonym
+    usable_labels = usable_labels[
+        ~usable_labels.source.isin(concepts_to_exclude)]
+    usable_labels = usable_labels[~usable_labels.target.isin(concepts_to_exclude)]
+
+    # the sources and targets of the remaining pairs can be paired with the current concept
+    usable_list = \
+        usable_labels['source'].unique().tolist() + usable_labels['target'].unique().tolist()
+    usable_list = list(OrderedDict.fromkeys(usable_list))
+
+    # make sure no reverse duplicates are created,
+    # i.e. if (X, lab1) already occurs in the negative instances,
+    # exlude X - note that (lab1, X) won't occur in the neg samples
+    # since same concepts are handled together
+    labels_from_existing_negative_instances = \
+        [lab for (lab, l) in new_negative_pairs if l == label1]
+    usable_list_final = \
+        [x for x in usable_list if x not in labels_from_existing_negative_instances]
+
+    return usable_list_final
+
+
+# for each potential pairing of terms, compute their Levenshtein distance and store it in a list
+# record labels that have Levenshtein distance 0 (i.e. only the casing of the concepts is different)
+# to exlcude them later
+def get_levenshtein_possible_targets(possible_targets, label1):
+
+    distances_possible_terms = []
+    distance0 = []
+
+    for i, label2 in enumerate(possible_targets):
+        d = levenshtein_distance(label2.lower(), label1.lower())
+        if d == 0:
+            distance0.append(i)
+        else:
+            distances_possible_terms.append(d)
+
+    new_possible_targets = [x for i, x in enumerate(possible_targets) if i not in distance0]
+
+    return distances_possible_terms, new_possible_targets
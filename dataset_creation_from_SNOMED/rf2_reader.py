@@ -0,0 +1,96 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Chunked reading of SNOMED RF2 full files into snapshots of their most recent entries"""
+
+import csv
+import os
+import numpy as np
+import pandas as pd
+
+
+# number of rows read from an RF2 file at once
+CHUNK_SIZE = 1000000
+
+
+# indices of the most recent entry of each id, preferring the earlier row if an id has several
+# entries with the same effective time (like idxmax), and the row number of the first entry of each id
+def _latest_entries(ids, effective_times, row_numbers, first_row_numbers):
+    if len(ids) == 0:
+        return np.empty(0, dtype=np.int64), first_row_numbers
+
+    order = np.lexsort((-row_numbers, effective_times, ids))
+    sorted_ids = ids[order]
+    group_starts = np.flatnonzero(np.concatenate([[True], sorted_ids[1:] != sorted_ids[:-1]]))
+    group_ends = np.concatenate([group_starts[1:], [len(order)]])
+
+    return order[group_ends - 1], np.minimum.reduceat(first_row_numbers[order], group_starts)
+
+
+# reads RF2 files in chunks, keeping only the most recent entry of each id
+# (as given by id_column, which has to hold integer SNOMED IDs) so that memory use is bounded
+# by the size of the snapshot and a chunk instead of the full history
+# row_filter: optional function selecting the rows of a chunk to use, applied before the reduction
+# the snapshot is in the order in which the ids first occur in the files
+def read_rf2_snapshot(snomed_path,
+                      file_names,
+                      id_column='id',
+                      usecols=None,
+                      row_filter=None,
+                      chunk_size=CHUNK_SIZE):
+    if not file_names:
+        raise Exception('No RF2 files given')
+
+    snapshot = None
+    first_row_numbers = np.empty(0, dtype=np.int64)
+    rows_read = 0
+
+    for file_name in file_names:
+        chunks = pd.read_csv(os.path.join(snomed_path, file_name),
+                             sep="\t", header=0,
+                             quoting=csv.QUOTE_NONE, keep_default_na=False,
+                             usecols=usecols, chunksize=chunk_size)
+        for chunk in chunks:
+            chunk_row_numbers = np.arange(rows_read, rows_read + chunk.shape[0], dtype=np.int64)
+            rows_read += chunk.shape[0]
+            if row_filter is not None:
+                selected = row_filter(chunk).values
+                chunk, chunk_row_numbers = chunk[selected], chunk_row_numbers[selected]
+
+            if snapshot is None:
+                candidates = chunk.reset_index(drop=True)
+                candidate_row_numbers = chunk_row_numbers
+                candidate_first_row_numbers = chunk_row_numbers
+            else:
+                candidates = pd.concat([snapshot, chunk], axis=0, ignore_index=True)
+                candidate_row_numbers = np.concatenate([snapshot_row_numbers, chunk_row_numbers])
+                candidate_first_row_numbers = np.concatenate([first_row_numbers, chunk_row_numbers])
+
+            latest, first_row_numbers = _latest_entries(candidates[id_column].values.astype(np.int64),
+                                                        candidates['effectiveTime'].values.astype(np.int64),
+                                                        candidate_row_numbers,
+                                                        candidate_first_row_numbers)
+            snapshot = candidates.iloc[latest].reset_index(drop=True)
+            snapshot_row_numbers = candidate_row_numbers[latest]
+
+    # files without entries
+    if snapshot is None:
+        return pd.read_csv(os.path.join(snomed_path, file_names[0]),
+                           sep="\t", header=0,
+                           quoting=csv.QUOTE_NONE, keep_default_na=False,
+                           usecols=usecols, nrows=0)
+
+    order = np.argsort(first_row_numbers, kind='stable')
+    return snapshot.iloc[order].reset_index(drop=True)
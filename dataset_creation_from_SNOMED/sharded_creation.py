@@ -0,0 +1,287 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Creation of the datasets in shards on several machines sharing a directory
+
+The plan splits the work into shards of two stages, each shard described by a manifest:
+* positives: positive instances from the labels of a range of concepts
+* negatives: the distance groups of the advanced strategy for a range of source terms of each dataset
+Shards can be run on any machine in any order, the merge of a stage combines them in a fixed order
+and does the remaining sequential work (substitutions, negative sampling), so that the datasets are
+exactly the same as when created on a single machine.
+"""
+
+import csv
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from dataset_creation_from_SNOMED.background_writer import BackgroundWriter
+from dataset_creation_from_SNOMED.reference_engine import create_pair_collection
+from dataset_creation_from_SNOMED.reference_engine import REFERENCE_ENGINE
+from dataset_creation_from_SNOMED.positive_instances_utils import write_dataset
+from dataset_creation_from_SNOMED.positive_instances_from_labels import read_concepts
+from dataset_creation_from_SNOMED.positive_instances_from_labels import create_label_pairs
+from dataset_creation_from_SNOMED.positive_instances_from_labels import save_label_datasets
+from dataset_creation_from_SNOMED.positive_instances_from_labels import DESCRIPTION_COLUMNS
+from dataset_creation_from_SNOMED.positive_instances_from_substitutions import positive_instances_from_substitutions
+from dataset_creation_from_SNOMED.negative_sampling_from_positive_instances import negative_instances
+from dataset_creation_from_SNOMED.negative_sampling_from_positive_instances import get_positive_instance_datasets
+from dataset_creation_from_SNOMED.negative_sampling_from_positive_instances import read_positive_instances
+from dataset_creation_from_SNOMED.negative_sampling_from_positive_instances import precompute_distance_groups
+from dataset_creation_from_SNOMED.term_features import create_term_features
+from dataset_creation_from_SNOMED.rf2_reader import read_rf2_snapshot
+from dataset_creation_from_SNOMED.is_a_hierarchy import load_is_a_hierarchy
+
+
+PLAN_FILE = "plan.json"
+MANIFEST_DIR = "manifests"
+SHARD_DIR = "shards"
+POSITIVES_MERGED_FILE = "positives_merged"
+
+POSITIVES = 'positives'
+NEGATIVES = 'negatives'
+STAGES = [POSITIVES, NEGATIVES]
+
+# the label pairs of a positives shard, in the order of create_label_pairs()
+LABEL_PAIR_FILES = ['SYN_SYN', 'SYN_SYN_easy', 'FSN_SYN', 'FSN_SYN_easy']
+LABEL_PAIR_COLUMNS = [['label1', 'label2'], ['label1', 'label2'], ['pref', 'alt'], ['pref', 'alt']]
+
+
+def manifest_file(shared_path, stage, shard):
+    return os.path.join(shared_path, MANIFEST_DIR, '%s_%03d.json' % (stage, shard))
+
+
+def shard_path(shared_path, stage, shard):
+    return os.path.join(shared_path, SHARD_DIR, '%s_%03d' % (stage, shard))
+
+
+def read_json(file_name):
+    with open(file_name) as json_file:
+        return json.load(json_file)
+
+
+def write_json(content, file_name):
+    with open(file_name, 'w') as json_file:
+        json.dump(content, json_file, indent=2)
+
+
+# the dataset path of the plan is relative to the shared folder, as machines may mount it elsewhere
+def shared_dataset_path(shared_path, settings):
+    return os.path.join(shared_path, settings['dataset_path'], '')
+
+
+##################################################################
+# Plan
+##################################################################
+
+# settings: the dataset creation arguments (see create_datasets.py), used by all shards and merges
+def plan_shards(shared_path, number_of_shards, settings):
+    # negatives shards read the merged positive instances, so they have to be in the shared folder
+    dataset_path = os.path.abspath(settings['dataset_path'])
+    if os.path.commonpath([dataset_path, os.path.abspath(shared_path)]) != os.path.abspath(shared_path):
+        raise Exception('The dataset path %s is not in the shared folder %s'
+                        % (settings['dataset_path'], shared_path))
+    settings = dict(settings, dataset_path=os.path.relpath(dataset_path, os.path.abspath(shared_path)))
+
+    os.makedirs(os.path.join(shared_path, MANIFEST_DIR), exist_ok=True)
+
+    # positives shards: ranges of the concepts, in the order of the concept files
+    concept_ids, _ = read_concepts(settings['snomed_path'], settings['concept_files'])
+    boundaries = np.linspace(0, len(concept_ids), number_of_shards + 1).astype(int).tolist()
+    manifests = {POSITIVES: [{'stage': POSITIVES, 'shard': shard,
+                              'concept_range': [boundaries[shard], boundaries[shard + 1]]}
+                             for shard in range(number_of_shards)]}
+
+    # negatives shards: the i-th part of the sorted source terms of each dataset,
+    # only the advanced strategy has expensive work which can be done independently
+    # (the reference engine does not use precomputed distance groups)
+    manifests[NEGATIVES] = []
+    if 'advanced' in settings['neg_sampling_strategies'] and settings['engine'] != REFERENCE_ENGINE:
+        manifests[NEGATIVES] = [{'stage': NEGATIVES, 'shard': shard,
+                                 'source_part': shard, 'number_of_parts': number_of_shards}
+                                for shard in range(number_of_shards)]
+
+    for stage in STAGES:
+        for manifest in manifests[stage]:
+            write_json(manifest, manifest_file(shared_path, stage, manifest['shard']))
+
+    write_json({'settings': settings,
+                'shards': {stage: len(manifests[stage]) for stage in STAGES}},
+               os.path.join(shared_path, PLAN_FILE))
+
+    for stage in STAGES:
+        print('%d %s shards planned in %s' % (len(manifests[stage]), stage, shared_path))
+
+
+##################################################################
+# Shards
+##################################################################
+
+def run_positives_shard(settings, manifest, output_path):
+    concept_ids, active_medical_concepts = read_concepts(settings['snomed_path'], settings['concept_files'])
+    labels = read_rf2_snapshot(settings['snomed_path'], settings['description_files'], usecols=DESCRIPTION_COLUMNS)
+
+    start, end = manifest['concept_range']
+    label_pairs = create_label_pairs(labels,
+                                     concept_ids[start:end],
+                                     active_medical_concepts,
+                                     settings['easy_hard_split'],
+                                     settings['split_distance'],
+                                     engine=settings['engine'])
+
+    for name, accumulator in zip(LABEL_PAIR_FILES, label_pairs):
+        write_dataset(accumulator.to_dataframe(), os.path.join(output_path, name + '.tsv'))
+
+
+def run_negatives_shard(shared_path, settings, manifest, output_path):
+    dataset_path = shared_dataset_path(shared_path, settings)
+
+    positive_instance_datasets = get_positive_instance_datasets(dataset_path)
+    if not positive_instance_datasets:
+        raise Exception('No positive instance datasets found in %s' % dataset_path)
+
+    for positive_dataset in positive_instance_datasets:
+        print(positive_dataset)
+        positive_instances = read_positive_instances(dataset_path, positive_dataset)
+        term_features = create_term_features(pd.concat([positive_instances['source'],
+                                                        positive_instances['target']]))
+
+        source_labels = np.array_split(np.array(sorted(positive_instances['source'].unique()), dtype=object),
+                                       manifest['number_of_parts'])[manifest['source_part']]
+        distance_groups = precompute_distance_groups(positive_instances, term_features, source_labels.tolist())
+
+        write_json({label1: {'groups': groups, 'complete': complete}
+                    for label1, (groups, complete) in distance_groups.items()},
+                   os.path.join(output_path, positive_dataset.rsplit(".", 1)[0] + '.json'))
+
+
+# the results of a shard are written to a temporary folder that is renamed when the shard is done,
+# so a merge never sees partial results and failed shards can simply be run again
+def run_shard(shared_path, stage, shard):
+    settings = read_json(os.path.join(shared_path, PLAN_FILE))['settings']
+    manifest = read_json(manifest_file(shared_path, stage, shard))
+
+    if stage == NEGATIVES and not os.path.exists(os.path.join(shared_path, POSITIVES_MERGED_FILE)):
+        raise Exception('The positives stage has to be merged before running negatives shards')
+
+    output_path = shard_path(shared_path, stage, shard)
+    temporary_path = output_path + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    if stage == POSITIVES:
+        run_positives_shard(settings, manifest, temporary_path)
+    else:
+        run_negatives_shard(shared_path, settings, manifest, temporary_path)
+
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.rename(temporary_path, output_path)
+
+
+##################################################################
+# Merge
+##################################################################
+
+def check_shards_done(shared_path, stage, number_of_shards):
+    missing = [shard for shard in range(number_of_shards)
+               if not os.path.isdir(shard_path(shared_path, stage, shard))]
+    if missing:
+        raise Exception('Shards %s of stage %s are not done' % (missing, stage))
+
+
+# the label pairs of all shards are added in the order of the concepts,
+# so that the same duplicates are removed as on a single machine
+def merge_positives(settings, shared_path, number_of_shards):
+    label_pairs = [create_pair_collection(columns, settings['engine']) for columns in LABEL_PAIR_COLUMNS]
+    for shard in range(number_of_shards):
+        for name, accumulator in zip(LABEL_PAIR_FILES, label_pairs):
+            shard_pairs = pd.read_csv(os.path.join(shard_path(shared_path, POSITIVES, shard), name + '.tsv'),
+                                      sep="\t", quoting=csv.QUOTE_NONE, keep_default_na=False,
+                                      header=0, dtype=str)
+            for label1, label2 in zip(shard_pairs.iloc[:, 0].tolist(), shard_pairs.iloc[:, 1].tolist()):
+                accumulator.add(label1, label2)
+
+    dataset_path = shared_dataset_path(shared_path, settings)
+    if not os.path.isdir(dataset_path):
+        os.mkdir(dataset_path)
+
+    with BackgroundWriter() as writer:
+        save_label_datasets(label_pairs,
+                            settings['easy_hard_split'],
+                            settings['split_distance'],
+                            dataset_path,
+                            writer)
+
+        print('*** Starting creation of positive instances from concept substitutions ***\n')
+        positive_instances_from_substitutions(easy_hard_split=settings['easy_hard_split'],
+                                              split_distance=settings['split_distance'],
+                                              snomed_path=settings['snomed_path'],
+                                              dataset_path=dataset_path,
+                                              writer=writer,
+                                              engine=settings['engine'],
+                                              resolve_chains=settings['substitution_chains'],
+                                              description_files=settings['description_files'],
+                                              concept_files=settings['concept_files'])
+
+    with open(os.path.join(shared_path, POSITIVES_MERGED_FILE), 'w'):
+        pass
+
+
+def merge_negatives(settings, shared_path, number_of_shards):
+
+    def load_distance_groups(positive_dataset):
+        distance_groups = {}
+        for shard in range(number_of_shards):
+            shard_groups = read_json(os.path.join(shard_path(shared_path, NEGATIVES, shard),
+                                                  positive_dataset.rsplit(".", 1)[0] + '.json'))
+            distance_groups.update({label1: (label1_groups['groups'], label1_groups['complete'])
+                                    for label1, label1_groups in shard_groups.items()})
+        return distance_groups
+
+    # the is-a hierarchy is only loaded for the hierarchy-aware sampling strategies
+    hierarchy = None
+    if {'advanced_without_hierarchy', 'advanced_hierarchy_neighbours'} & set(settings['neg_sampling_strategies']):
+        print('*** Loading the is-a hierarchy ***\n')
+        hierarchy = load_is_a_hierarchy(settings['snomed_path'],
+                                        read_rf2_snapshot(settings['snomed_path'], settings['description_files'],
+                                                          usecols=DESCRIPTION_COLUMNS),
+                                        settings['relationship_file'])
+
+    with BackgroundWriter() as writer:
+        print('*** Starting creation of negative instances ***\n')
+        negative_instances(dataset_path=shared_dataset_path(shared_path, settings),
+                           strategies=settings['neg_sampling_strategies'],
+                           writer=writer,
+                           approx_candidates=settings['approx_candidates'],
+                           approx_recall_sample=settings['approx_recall_sample'],
+                           hierarchy=hierarchy,
+                           load_distance_groups=load_distance_groups if number_of_shards else None,
+                           engine=settings['engine'])
+
+
+def merge_shards(shared_path, stage):
+    plan = read_json(os.path.join(shared_path, PLAN_FILE))
+    number_of_shards = plan['shards'][stage]
+    check_shards_done(shared_path, stage, number_of_shards)
+
+    if stage == POSITIVES:
+        merge_positives(plan['settings'], shared_path, number_of_shards)
+    else:
+        if not os.path.exists(os.path.join(shared_path, POSITIVES_MERGED_FILE)):
+            raise Exception('The positives stage has to be merged before the negatives stage')
+        merge_negatives(plan['settings'], shared_path, number_of_shards)
@@ -24,3 +24,5 @@ class SnomedID(Enum):
     POSSIBLY_EQUIVALENT_TO_REFSET = 900000000000523009
     SAME_AS_REFSET = 900000000000527005
     REPLACED_BY_REFSET = 900000000000526001
+    IS_A = 116680003
+    PREFERRED_ACCEPTABILITY = 900000000000548007
@@ -0,0 +1,101 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Resolution of chains of concept substitutions to their terminal active concept
+
+If A is replaced by B and B by C, both A and B are resolved to C. The substitutions form a
+forest over integer concept ids, in which each deleted concept is linked to the concept
+substituting it. Finding the root of a concept with path compression resolves all chains
+in near-linear time.
+"""
+
+from collections import namedtuple
+import numpy as np
+
+from dataset_creation_from_SNOMED.snomed_id import SnomedID
+
+
+SUBSTITUTION_REFSETS = [SnomedID.POSSIBLY_EQUIVALENT_TO_REFSET.value,
+                        SnomedID.SAME_AS_REFSET.value,
+                        SnomedID.REPLACED_BY_REFSET.value]
+
+# concept_ids: sorted SNOMED IDs of all concepts in a substitution, the integer id of a concept
+#     is its position
+# parents: integer id of the concept substituting each concept (towards the root of its chain),
+#     the concept itself for roots
+# active: whether each concept is active
+SubstitutionChains = namedtuple('SubstitutionChains', ['concept_ids', 'parents', 'active'])
+
+
+# source -> target pairs of the substitutions whose most recent association is active
+# (substitutes: the core module rows of the association refset)
+def get_active_substitutions(substitutes):
+    substitutes = substitutes[substitutes['refsetId'].isin(SUBSTITUTION_REFSETS)]
+
+    # the most recent entry of each association, the first one in the file among equally recent ones
+    latest_entries = substitutes.sort_values('effectiveTime', ascending=False, kind='mergesort')\
+        .drop_duplicates(subset=['referencedComponentId', 'targetComponentId', 'refsetId'])
+    latest_entries = latest_entries[latest_entries['active'].astype(bool)]
+
+    return latest_entries['referencedComponentId'].values, latest_entries['targetComponentId'].values
+
+
+# root of a concept with path compression, i.e. all concepts on the path are linked to the root
+def find_root(parents, concept):
+    root = concept
+    while parents[root] != root:
+        root = parents[root]
+
+    while parents[concept] != root:
+        parents[concept], concept = root, parents[concept]
+
+    return root
+
+
+# links each inactive concept to the concept substituting it, if it is substituted by exactly one concept,
+# active concepts end a chain, and links closing a cycle are left out
+def create_substitution_chains(source_ids, target_ids, active_concepts):
+    concept_ids = np.unique(np.concatenate([source_ids, target_ids]).astype(np.int64))
+    active = np.isin(concept_ids, np.fromiter(active_concepts, dtype=np.int64, count=len(active_concepts)))
+    sources = np.searchsorted(concept_ids, np.asarray(source_ids, dtype=np.int64))
+    targets = np.searchsorted(concept_ids, np.asarray(target_ids, dtype=np.int64))
+
+    # concepts substituted by different concepts (e.g. possibly equivalent to several) are ambiguous
+    pairs = np.unique(np.stack([sources, targets], axis=1), axis=0)
+    source_counts = np.bincount(pairs[:, 0], minlength=len(concept_ids))
+    pairs = pairs[(source_counts[pairs[:, 0]] == 1) & ~active[pairs[:, 0]]]
+
+    parents = list(range(len(concept_ids)))
+    for source, target in pairs.tolist():
+        # each source is still the root of its tree, so linking it to a concept
+        # of its own tree would close a cycle
+        if find_root(parents, target) != source:
+            parents[source] = target
+
+    return SubstitutionChains(concept_ids, parents, active)
+
+
+# SNOMED ID of the terminal active concept of each deleted concept, for all deleted concepts
+# whose chain ends in an active concept, in the order of their SNOMED IDs
+def resolve_substitution_chains(chains):
+    resolved = {}
+    for concept in range(len(chains.concept_ids)):
+        if chains.active[concept]:
+            continue
+        root = find_root(chains.parents, concept)
+        if root != concept and chains.active[root]:
+            resolved[int(chains.concept_ids[concept])] = int(chains.concept_ids[root])
+
+    return resolved
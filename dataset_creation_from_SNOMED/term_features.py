@@ -0,0 +1,169 @@
+# Copyright 2020 Babylon Partners. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Precomputed term features for fast filtering and Levenshtein distance computation"""
+
+from collections import namedtuple
+import numpy as np
+
+from dataset_creation_from_SNOMED.distance_cache import active_distance_cache
+from dataset_creation_from_SNOMED.distance_cache import cached_distance
+from dataset_creation_from_SNOMED.levenshtein_kernel import one_to_many_distances
+
+
+# number of character buckets in the histogram signature of a term
+HISTOGRAM_SIZE = 64
+
+# number of candidates for which lower bounds are computed at once (bounds memory use)
+LOWER_BOUND_CHUNK_SIZE = 65536
+
+# terms: term for each term id
+# index: term -> term id
+# normalized: lowercased term for each term id
+# lengths: number of characters of each normalized term
+# histograms: character histogram of each normalized term (HISTOGRAM_SIZE buckets)
+# code_points: code points of all normalized terms concatenated
+# offsets: start of each normalized term in code_points, followed by the end of the last one
+TermFeatures = namedtuple('TermFeatures', ['terms', 'index', 'normalized', 'lengths', 'histograms',
+                                           'code_points', 'offsets'])
+
+
+def _character_buckets(code_points):
+    # a-z, 0-9 and space get their own bucket, other ASCII characters share the
+    # buckets 37-62 and all non-ASCII characters are put into the last bucket
+    buckets = np.full(code_points.shape, HISTOGRAM_SIZE - 1, dtype=np.int64)
+    ascii_chars = code_points < 128
+    buckets[ascii_chars] = 37 + code_points[ascii_chars] % 26
+    letters = (code_points >= ord('a')) & (code_points <= ord('z'))
+    buckets[letters] = code_points[letters] - ord('a')
+    digits = (code_points >= ord('0')) & (code_points <= ord('9'))
+    buckets[digits] = 26 + code_points[digits] - ord('0')
+    buckets[code_points == ord(' ')] = 36
+    return buckets
+
+
+def create_term_features(terms):
+    # the features are computed once per vocabulary, the order of the terms defines the term ids
+    terms = list(dict.fromkeys(terms))
+    index = {term: i for i, term in enumerate(terms)}
+    normalized = [term.lower() for term in terms]
+    lengths = np.fromiter((len(term) for term in normalized), dtype=np.int64, count=len(terms))
+
+    # character histograms of all terms, computed in one go over the concatenated terms
+    code_points = np.frombuffer("".join(normalized).encode('utf-32-le'), dtype=np.uint32)
+    term_ids = np.repeat(np.arange(len(terms)), lengths)
+    counts = np.bincount(term_ids * HISTOGRAM_SIZE + _character_buckets(code_points.astype(np.int64)),
+                         minlength=len(terms) * HISTOGRAM_SIZE)
+    # saturating the counts keeps the lower bounds valid
+    histograms = np.minimum(counts, 255).astype(np.uint8).reshape(len(terms), HISTOGRAM_SIZE)
+
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    return TermFeatures(terms, index, normalized, lengths, histograms, code_points, offsets)
+
+
+def normalized_term(term_features, term):
+    return term_features.normalized[term_features.index[term]]
+
+
+# every insertion, deletion or substitution changes the number of surplus characters
+# on either side of the histogram difference by at most one,
+# so the larger of the two surpluses is a lower bound of the Levenshtein distance
+# (and never smaller than the difference in length of the terms)
+# term_id is either one term id or an array with a term id per target
+def distance_lower_bounds(term_features, term_id, target_ids):
+    lower_bounds = np.empty(len(target_ids), dtype=np.int64)
+    pairwise = np.ndim(term_id) > 0
+    if not pairwise:
+        histogram = term_features.histograms[term_id].astype(np.int16)
+
+    for start in range(0, len(target_ids), LOWER_BOUND_CHUNK_SIZE):
+        chunk = target_ids[start:start + LOWER_BOUND_CHUNK_SIZE]
+        if pairwise:
+            histogram = term_features.histograms[term_id[start:start + LOWER_BOUND_CHUNK_SIZE]].astype(np.int16)
+        difference = term_features.histograms[chunk].astype(np.int16) - histogram
+        surplus_targets = np.clip(difference, 0, None).sum(axis=1)
+        surplus_term = np.clip(-difference, 0, None).sum(axis=1)
+        lower_bounds[start:start + len(chunk)] = np.maximum(surplus_targets, surplus_term)
+
+    return lower_bounds
+
+
+# yields the possible targets (term ids) of the term with term_id grouped by their Levenshtein distance
+# to the term, in increasing order of distance, each group as a list of (label, distance) tuples
+# in the order of the possible targets
+# targets with distance 0 (i.e. only the casing of the terms is different) are excluded
+def levenshtein_distance_groups(term_features, term_id, target_ids):
+    target_ids = np.asarray(target_ids, dtype=np.int64)
+    for distance, positions in distance_position_groups(term_features, term_id, target_ids):
+        yield [(term_features.terms[target_id], distance) for target_id in target_ids[positions].tolist()]
+
+
+# (distance, positions) of the target ids in increasing order of distance, positions in increasing order,
+# all distances are computed in one call of the native kernel if it is available
+# (which is cheaper than looking them up in the distance cache one by one)
+def distance_position_groups(term_features, term_id, target_ids):
+    distances = one_to_many_distances(term_features.code_points, term_features.offsets, term_id, target_ids)
+    if distances is None:
+        return bounded_distance_groups(term_features, term_id, target_ids)
+    return remembered_distance_groups(term_features, term_id, target_ids, sorted_distance_groups(distances))
+
+
+# (distance, positions) of the known distances in increasing order of distance, positions in increasing order,
+# the positions of a distance are only looked up when its group is requested
+def sorted_distance_groups(distances):
+    counts = np.bincount(distances) if len(distances) else []
+    for distance in np.flatnonzero(counts).tolist():
+        if distance > 0:
+            yield distance, np.flatnonzero(distances == distance).tolist()
+
+
+# passes on the groups, keeping the distances of the requested groups in the open distance cache
+# (e.g. for the dataset statistics of the chosen pairs)
+def remembered_distance_groups(term_features, term_id, target_ids, position_groups):
+    term = term_features.normalized[term_id]
+    for distance, positions in position_groups:
+        cache = active_distance_cache()
+        if cache is not None:
+            for target_id in target_ids[positions].tolist():
+                cache.remember(term, term_features.normalized[target_id], distance)
+        yield distance, positions
+
+
+# (distance, positions) of the target ids in increasing order of distance, positions in increasing order,
+# exact distances are only computed for targets whose lower bound does not exceed
+# the distance of the group currently requested
+def bounded_distance_groups(term_features, term_id, target_ids):
+    term = term_features.normalized[term_id]
+    lower_bounds = distance_lower_bounds(term_features, term_id, target_ids)
+    order = np.argsort(lower_bounds, kind='stable')
+
+    # positions of possible targets by distance, for targets whose distance is already known
+    positions_by_distance = {}
+    next_position = 0
+    distance = 0
+
+    while next_position < len(order) or positions_by_distance:
+        while next_position < len(order) and lower_bounds[order[next_position]] <= distance:
+            position = order[next_position]
+            d = cached_distance(term, term_features.normalized[target_ids[position]])
+            if d > 0:
+                positions_by_distance.setdefault(d, []).append(position)
+            next_position += 1
+
+        positions = positions_by_distance.pop(distance, None)
+        if positions:
+            yield distance, sorted(positions)
+        distance += 1